@@ -1,17 +1,25 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, render_template, request, jsonify, session
+import json
 import threading
 import time
-from collections import deque
 import secrets
-from typing import List # Added for type hint
+from typing import List, Optional, Tuple # Added for type hint
 
 # Import your RAG logic module
 import rag
 import os
+from burst_aggregator import BurstAggregator
+from burst_window import create_burst_window
+from scheduler import BurstScheduler
+from speculation import create_speculator, speculation_fingerprint
+from session_manager import create_session_manager
+from session_store import create_session_store
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(16) # Make sure this is strong for production
+# Must be shared by all worker processes (set FLASK_SECRET_KEY), or each worker rejects
+# the others' session cookies.
+app.secret_key = os.environ.get("FLASK_SECRET_KEY") or secrets.token_hex(16) # Make sure this is strong for production
 
 # --- Session-based Global-like Variables ---
 # We will store these in the Flask session object where appropriate,
@@ -23,25 +31,44 @@ app.secret_key = secrets.token_hex(16) # Make sure this is strong for production
 # _pending_bot_responses = {}# Now session-specific
 # _processing_locks = {}    # Now session-specific, one lock per session
 
-BURST_DELAY_SECONDS = 5 # Keep this global
+RAG_WORKERS = int(os.environ.get("FLOW_RAG_WORKERS", "4")) # Concurrent RAG jobs (and LLM calls)
+RAG_MAX_QUEUE = int(os.environ.get("FLOW_RAG_MAX_QUEUE", "32")) # Due jobs waiting for a worker
+MAX_PENDING_BURSTS = int(os.environ.get("FLOW_MAX_PENDING_BURSTS", "1000")) # Sessions waiting out a burst window
+
+# One timer thread + a fixed worker pool for all sessions (see scheduler.py), instead of a
+# threading.Timer thread per message.
+burst_scheduler = BurstScheduler(workers=RAG_WORKERS, max_queue=RAG_MAX_QUEUE, max_pending=MAX_PENDING_BURSTS)
+# The burst window adapts to each sender (FLOW_BURST_MIN_DELAY..FLOW_BURST_MAX_DELAY seconds):
+# it closes early after an end-of-thought message and otherwise follows their typing rhythm.
+burst_window = create_burst_window()
+# While a window is open, retrieval (or with FLOW_SPECULATE=full the whole pipeline) already
+# runs on the partial burst; a newer message supersedes it (see speculation.py).
+speculator = create_speculator()
+SSE_KEEPALIVE_SECONDS = 15 # Comment line sent on idle streams so dead connections are noticed
+LONG_POLL_MAX_WAIT_SECONDS = 25
+HISTORY_SUMMARY_DELAY_SECONDS = 1 # Summaries run on the worker pool shortly after a reply is queued
+
+# --- Server-side session state ---
+# Chat history, burst buffer, queued bot bubbles and RAG settings live in the session store
+# (see session_store.py); the cookie only carries session_id. With FLOW_SESSION_STORE=sqlite
+# the state outlives a restart and is shared by worker processes, but the burst scheduler
+# and session locks below are per process: several workers need session-affinity routing.
+session_store = create_session_store(max_history=rag.HISTORY_PROMPT_TURNS)
+# Per-session locks and idle-TTL eviction of everything kept per session (see session_manager.py).
+session_manager = create_session_manager(session_store)
+
+# Load NLTK punkt, the text splitter and caches now, not on the first user's request.
+rag.warm_up()
 
 # --- Helper to initialize session data ---
 def initialize_session_vars(session_id):
-    if session_id not in app.config.get('APP_PROCESSING_LOCKS', {}):
-        if 'APP_PROCESSING_LOCKS' not in app.config:
-            app.config['APP_PROCESSING_LOCKS'] = {}
-        app.config['APP_PROCESSING_LOCKS'][session_id] = threading.Lock()
-    
-    if 'message_burst_buffer' not in session:
-        session['message_burst_buffer'] = [] # Use list, convert to deque later if needed
-    if 'pending_bot_responses' not in session:
-        session['pending_bot_responses'] = [] # Use list
-    if 'chat_history' not in session:
-        session['chat_history'] = []
-    # Timers are harder to store in session directly as they are not JSON serializable.
-    # We'll manage them in a global dict keyed by session_id for now.
-    if 'APP_BURST_TIMERS' not in app.config:
-        app.config['APP_BURST_TIMERS'] = {}
+    # Called by every request: keeps the session from being evicted as idle.
+    session_manager.touch(session_id)
+
+def get_session_lock(session_id) -> threading.Lock:
+    # Guards short read-modify-write steps on one session's state. Never held across
+    # a provider call: RAG work runs unlocked and publishes through publish_reply().
+    return session_manager.lock(session_id)
 
 
 @app.route('/')
@@ -53,119 +80,7 @@ def index():
     initialize_session_vars(session_id)
     
     # Render with the current session's chat history
-    return render_template('index.html', chat_history=session.get('chat_history', []))
-
-# --- RAG Processing Function (Adapted for Flask session) ---
-def process_rag_for_session(session_id_to_process, api_key, profile, persona, history_snapshot_for_rag):
-    # This function will be called by the timer. It needs access to app.config for locks/timers
-    # and will modify session data. This is tricky because timers run in separate threads
-    # and Flask session is typically available only within a request context.
-    # For simplicity, we'll pass necessary data and assume this function can update a
-    # shared structure (like app.config for pending responses) keyed by session_id.
-
-    session_lock = app.config.get('APP_PROCESSING_LOCKS', {}).get(session_id_to_process)
-    if not session_lock:
-        print(f"FLASK_RAG_THREAD: No lock for session {session_id_to_process}.")
-        return
-
-    with session_lock:
-        # Get burst buffer from app.config or a shared dict if not using session directly here
-        # For this example, we assume the /chat endpoint placed data in a shared structure
-        # before starting the timer, or we pass it all in.
-        # Let's assume the buffer was cleared by /chat after scheduling this.
-        # The `combined_message_for_rag` would have been formed by the /chat endpoint
-        # that scheduled this timer.
-
-        # The challenge: `session` object is not directly available in a thread started by Timer.
-        # So, the /chat endpoint needs to prepare all data for this function.
-        # Let's assume 'profile', 'persona', 'api_key', 'history_snapshot_for_rag'
-        # and 'combined_message_for_rag' (which isn't passed here yet) are correctly provided.
-        
-        # The `message_burst_buffer` needs to be read and cleared by the /chat endpoint
-        # before this timer function is scheduled. This function receives the combined message.
-        # This function's primary role is to call RAG and queue the response.
-
-        # Simplified: Let's assume combined_message_for_rag was passed or retrieved from a shared dict
-        # For this to work, the /chat route needs to pass the actual combined message.
-        # The current app.py code structure for process_rag_for_session has combined_message
-        # formed *inside* it from a buffer. This needs adjustment.
-
-        # For now, let's simulate that the /chat endpoint already prepared combined_message
-        # and we receive it here. We will need to adjust the /chat endpoint.
-        # Let's assume `combined_message_for_rag` IS the combined message.
-        # We'll need to modify the call to this function from /chat.
-
-        print(f"FLASK_RAG_THREAD: Processing RAG for session {session_id_to_process}")
-        # The original process_rag_for_session used its own buffer. This needs to change.
-        # The `combined_message_for_rag` parameter will now be the ACTUAL combined message.
-
-        chat_history_for_rag_flat = []
-        for item in history_snapshot_for_rag: # This history is from the session at timer start
-            if item["role"] == "user": chat_history_for_rag_flat.append(f"Sender: {item['content']}")
-            elif item["role"] == "assistant": chat_history_for_rag_flat.append(f"Flow: {item['content']}")
-            else: chat_history_for_rag_flat.append(f"System: {item['content']}")
-        
-        # Ensure original_user_query for format_response_as_burst_by_llm is the combined message
-        # This parameter is missing in the current `process_rag_for_session` signature for the timer.
-        # We need to pass it from the /chat endpoint.
-        # Let's assume it's part of the arguments now.
-        # For now, I'll use a placeholder for `combined_message_for_rag_processing`.
-        # This indicates a structural change is needed in how /chat calls this.
-
-        # Assuming the call from /chat is now:
-        # args=[session_id, current_api_key, current_profile, current_persona, 
-        #       history_snapshot_for_timer, combined_messages_from_buffer]
-        # So, the signature of this function needs to change if we follow this.
-        # For this refactor, I will assume the RAG pipeline gets the combined message
-        # from its arguments, which means the `combined_message_for_rag` in `run_rag_pipeline`
-        # IS the correct combined user input.
-
-        rag_result = rag.run_rag_pipeline(
-            api_key, profile, persona, 
-            "Placeholder for combined message - this needs to be passed to process_rag_for_session", # THIS IS A KEY MISSING PIECE
-            chat_history_for_rag_flat
-        )
-
-        bot_response_parts: List[str] = []
-        if rag_result.get("error_message"):
-            bot_response_parts = [f"Flow Error: {rag_result['error_message']}"]
-        elif rag_result.get("generated_response"):
-            complete_thought = rag_result["generated_response"]
-            if complete_thought.strip():
-                try:
-                    # The original_user_query here should be the combined messages from the user's burst
-                    # This also needs to be passed correctly to this function.
-                    bot_response_parts = rag.format_response_as_burst_by_llm(
-                        api_key=api_key,
-                        full_response_content=complete_thought,
-                        persona_description=persona,
-                        original_user_query="Placeholder for combined message" # ANOTHER KEY MISSING PIECE
-                    )
-                    if not bot_response_parts: bot_response_parts = [complete_thought]
-                except Exception as e_format:
-                    print(f"FLASK_RAG_THREAD: Error formatting burst: {e_format}")
-                    bot_response_parts = [complete_thought]
-            else:
-                bot_response_parts = ["Flow: (No response generated)"]
-        else:
-            bot_response_parts = ["Flow Error: No response content from RAG."]
-
-        # Store pending responses in app.config or a globally accessible dict keyed by session_id
-        if 'APP_PENDING_BOT_RESPONSES' not in app.config:
-            app.config['APP_PENDING_BOT_RESPONSES'] = {}
-        if session_id_to_process not in app.config['APP_PENDING_BOT_RESPONSES']:
-             app.config['APP_PENDING_BOT_RESPONSES'][session_id_to_process] = deque()
-        
-        for part in bot_response_parts:
-            app.config['APP_PENDING_BOT_RESPONSES'][session_id_to_process].append(part)
-
-        print(f"FLASK_RAG_THREAD: Queued {len(bot_response_parts)} response parts for {session_id_to_process}.")
-    
-    # Clear timer from global dict
-    app_burst_timers = app.config.get('APP_BURST_TIMERS', {})
-    if session_id_to_process in app_burst_timers:
-        del app_burst_timers[session_id_to_process]
-
+    return render_template('index.html', chat_history=session_store.get_history(session_id))
 
 # --- NEW /reset_session ENDPOINT ---
 @app.route('/reset_session', methods=['POST'])
@@ -173,79 +88,66 @@ def reset_session_api():
     session_id = session.get('session_id')
     if not session_id:
         return jsonify({'error': 'No active session to reset.'}), 400
+    initialize_session_vars(session_id)
 
-    initialize_session_vars(session_id) # Ensure session structures exist
-
-    session_lock = app.config.get('APP_PROCESSING_LOCKS', {}).get(session_id)
-    if not session_lock:
-        return jsonify({'error': 'Internal server error: session lock missing for reset'}), 500
+    with get_session_lock(session_id):
+        # 1-3. Clear chat history, message burst buffer and pending bot responses. Bumping
+        # the reply epoch makes replies still being generated for the old chat stale.
+        session_store.reset(session_id)
+        reply_epoch = session_store.get_settings(session_id).get('reply_epoch', 0) + 1
+        session_store.update_settings(session_id, history_summary="", reply_epoch=reply_epoch)
+        print(f"FLASK_RESET_API: History, burst buffer and pending responses cleared for session {session_id}.")
+
+        # 4. Cancel any pending burst deadline for this session
+        if burst_aggregator.cancel(session_id):
+            print(f"FLASK_RESET_API: Pending burst cancelled for session {session_id}.")
+        burst_scheduler.cancel(("summary", session_id))
+        speculator.discard(session_id)
+
+    # 5. Re-initialize RAG components if API key or profile changes significantly. This may call
+    # the providers, so it runs after the session lock is released.
+    # This is crucial. The RAG module caches clients per API key and vector stores per profile.
+    # We need to tell it to update if the core inputs (API key, profile for vector store) change.
+    data = request.json
+    new_api_key = data.get('api_key')
+    new_user_profile = data.get('user_profile')
+    new_user_persona = data.get('user_persona') # Persona mainly affects prompts, not usually vector store
+
+    if new_api_key and new_user_profile:
+        try:
+            print(f"FLASK_RESET_API: Re-initializing RAG for session {session_id} due to persona change.")
+            # rag.initialize_models_node warms this key's clients and this profile's vector store.
+            # It needs a FlowState-like structure.
+            # We don't have an "incoming_message" for a reset, but it's needed by the RAG pipeline if run.
+            # For just re-initialization, we primarily care about api_key and profile_content.
+            init_state = rag.FlowState(
+                user_api_key=new_api_key,
+                user_profile_content=new_user_profile,
+                user_persona_description=new_user_persona if new_user_persona else "", # Ensure it's a string
+                incoming_message="", # Not used for init only, but good to provide
+                chat_history=[], # Reset history
+                retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None,
+                _stage_timings=None, burst_parts=None, history_summary=None, _query_vector=None
+            )
+            result_state = rag.initialize_models_node(init_state)
+            if result_state.get("error_message"):
+                print(f"FLASK_RESET_API: Error re-initializing RAG: {result_state['error_message']}")
+                # Don't raise HTTP error here, just log. Frontend will see cleared chat.
+                # The next /chat call will attempt init again.
+            else:
+                print(f"FLASK_RESET_API: RAG components re-initialized/verified for session {session_id}.")
+                # Update session with new RAG config if needed for /chat
+                session_store.update_settings(session_id, api_key_for_rag=new_api_key, profile_for_rag=new_user_profile,
+                                              persona_for_rag=new_user_persona if new_user_persona else "")
 
-    with session_lock:
-        # 1. Clear chat history from session
-        session['chat_history'] = []
-        print(f"FLASK_RESET_API: Chat history cleared for session {session_id}.")
-
-        # 2. Clear message burst buffer from session
-        session['message_burst_buffer'] = []
-        print(f"FLASK_RESET_API: Message burst buffer cleared for session {session_id}.")
-
-        # 3. Clear pending bot responses from global dict for this session
-        app_pending_responses = app.config.get('APP_PENDING_BOT_RESPONSES', {})
-        if session_id in app_pending_responses:
-            app_pending_responses[session_id].clear()
-            print(f"FLASK_RESET_API: Pending bot responses cleared for session {session_id}.")
-        
-        # 4. Cancel any active burst timer for this session
-        app_burst_timers = app.config.get('APP_BURST_TIMERS', {})
-        if session_id in app_burst_timers and app_burst_timers[session_id].is_alive():
-            app_burst_timers[session_id].cancel()
-            del app_burst_timers[session_id] # Remove from dict
-            print(f"FLASK_RESET_API: Active burst timer cancelled for session {session_id}.")
-
-        # 5. Re-initialize RAG components if API key or profile changes significantly
-        # This is crucial. Your RAG module manages its own global state for llm, vector_store etc.
-        # We need to tell it to update if the core inputs (API key, profile for vector store) change.
-        data = request.json
-        new_api_key = data.get('api_key')
-        new_user_profile = data.get('user_profile')
-        new_user_persona = data.get('user_persona') # Persona mainly affects prompts, not usually vector store
-
-        if new_api_key and new_user_profile:
-            try:
-                print(f"FLASK_RESET_API: Re-initializing RAG for session {session_id} due to persona change.")
-                # The rag.initialize_models_node function updates its internal globals.
-                # It needs a FlowState-like structure.
-                # We don't have an "incoming_message" for a reset, but it's needed by the RAG pipeline if run.
-                # For just re-initialization, we primarily care about api_key and profile_content.
-                init_state = rag.FlowState(
-                    user_api_key=new_api_key,
-                    user_profile_content=new_user_profile,
-                    user_persona_description=new_user_persona if new_user_persona else "", # Ensure it's a string
-                    incoming_message="", # Not used for init only, but good to provide
-                    chat_history=[], # Reset history
-                    retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None
-                )
-                result_state = rag.initialize_models_node(init_state)
-                if result_state.get("error_message"):
-                    print(f"FLASK_RESET_API: Error re-initializing RAG: {result_state['error_message']}")
-                    # Don't raise HTTP error here, just log. Frontend will see cleared chat.
-                    # The next /chat call will attempt init again.
-                else:
-                    print(f"FLASK_RESET_API: RAG components re-initialized/verified for session {session_id}.")
-                    # Update session with new RAG config if needed for /chat
-                    session['api_key_for_rag'] = new_api_key
-                    session['profile_for_rag'] = new_user_profile
-                    session['persona_for_rag'] = new_user_persona if new_user_persona else ""
-
-            except Exception as e:
-                print(f"FLASK_RESET_API: Exception during RAG re-initialization: {e}")
-                # Log error, but proceed with resetting client-side view
-        else:
-            print(f"FLASK_RESET_API: API key or profile not provided for RAG re-initialization during reset.")
+        except Exception as e:
+            print(f"FLASK_RESET_API: Exception during RAG re-initialization: {e}")
+            # Log error, but proceed with resetting client-side view
+    else:
+        print(f"FLASK_RESET_API: API key or profile not provided for RAG re-initialization during reset.")
 
 
-        session.modified = True
-        return jsonify({'message': f'Session reset and RAG re-initialized for persona {data.get("new_persona_id", "N/A")}.'})
+    return jsonify({'message': f'Session reset and RAG re-initialized for persona {data.get("new_persona_id", "N/A")}.'})
 
 
 @app.route('/chat', methods=['POST'])
@@ -255,158 +157,282 @@ def chat_api():
         session['session_id'] = secrets.token_hex(16)
         session_id = session['session_id']
     
-    initialize_session_vars(session_id) # Ensure all session lists/dicts are present
-
-    session_lock = app.config.get('APP_PROCESSING_LOCKS', {}).get(session_id)
-    if not session_lock:
-        # This case should be rare if initialize_session_vars works.
-        app.config.setdefault('APP_PROCESSING_LOCKS', {})[session_id] = threading.Lock()
-        session_lock = app.config['APP_PROCESSING_LOCKS'][session_id]
+    initialize_session_vars(session_id)
+    session_lock = get_session_lock(session_id)
 
     data = request.json
     user_message = data.get('message')
     
     # Store/update RAG parameters in session for the timer to use
-    session['api_key_for_rag'] = data.get('api_key')
-    session['profile_for_rag'] = data.get('user_profile')
-    session['persona_for_rag'] = data.get('user_persona')
+    session_store.update_settings(session_id, api_key_for_rag=data.get('api_key'), profile_for_rag=data.get('user_profile'),
+                                  persona_for_rag=data.get('user_persona'))
     
-    combined_messages_for_rag_processing = "" # Will be built here
-
     with session_lock:
-        # Use session's buffer
-        current_buffer = list(session.get('message_burst_buffer', [])) # Get a copy
-        current_buffer.append(user_message)
-        session['message_burst_buffer'] = current_buffer # Save back
-        
-        print(f"FLASK_CHAT_API: Msg added for {session_id}. Buffer: {session['message_burst_buffer']}")
-
-        history_snapshot_for_timer_arg = list(session.get('chat_history', [])) # Get current history for the RAG call
-
-        app_burst_timers = app.config.get('APP_BURST_TIMERS', {})
-        if session_id in app_burst_timers and app_burst_timers[session_id].is_alive():
-            app_burst_timers[session_id].cancel()
-            print(f"FLASK_CHAT_API: Cancelled existing timer for {session_id}")
-        
-        # Prepare data for the timer thread *before* it starts
-        api_key_for_timer = session.get('api_key_for_rag', "")
-        profile_for_timer = session.get('profile_for_rag', "")
-        persona_for_timer = session.get('persona_for_rag', "")
-        
-        # Combine messages from buffer *now* and clear it for this RAG cycle
-        combined_messages_for_rag_processing = " ".join(session['message_burst_buffer'])
-        session['message_burst_buffer'] = [] # Clear buffer as we are about to process it
-
-        app_burst_timers[session_id] = threading.Timer(
-            BURST_DELAY_SECONDS,
-            process_rag_for_session_v2, # MODIFIED: Using a new version of the RAG processor
-            args=[session_id, api_key_for_timer, profile_for_timer, persona_for_timer, 
-                  history_snapshot_for_timer_arg, combined_messages_for_rag_processing] # Pass combined message
-        )
-        app_burst_timers[session_id].start()
-        app.config['APP_BURST_TIMERS'] = app_burst_timers # Save back to app.config
-    
+        settings = session_store.get_settings(session_id)
+        burst_timing = burst_window.observe(settings.get('burst_timing'))
+        burst_delay, burst_delay_reason = burst_window.choose_delay(burst_timing, user_message)
+        session_store.update_settings(session_id, burst_timing=burst_timing)
+
+        if burst_aggregator.is_pending(session_id):
+            print(f"FLASK_CHAT_API: Extending pending burst for {session_id}")
+        # Buffered until the window closes; the whole burst then goes to RAG in one run. The
+        # history before this message is kept with the burst if the message opens it.
+        current_buffer = burst_aggregator.add(session_id, user_message, burst_delay, burst_delay_reason,
+                                              session_store.get_history(session_id))
+        if current_buffer is None:
+            # Admission control: too many bursts queued; the client may retry later.
+            print(f"FLASK_CHAT_API: Scheduler saturated, refusing message for {session_id}")
+            return jsonify({'status': 'busy', 'error': 'Flow is busy right now, please try again shortly.'}), 503
+        if speculator.enabled:
+            # The history snapshot and combined message the burst job will see if nothing else arrives.
+            history_snapshot = session_store.get_burst_history(session_id) or []
+            inputs = speculation_inputs(session_id, settings.get('api_key_for_rag') or "", settings.get('profile_for_rag') or "",
+                                        settings.get('persona_for_rag') or "", history_snapshot, " ".join(current_buffer))
+            speculator.start(session_id, speculation_fingerprint(*inputs), run_speculation, inputs)
+        print(f"FLASK_CHAT_API: Msg added for {session_id}. Burst: {current_buffer}, window {burst_delay:.1f}s ({burst_delay_reason})")
+
     # Update session chat history immediately for the user's message
-    current_chat_history = list(session.get('chat_history', []))
-    current_chat_history.append({"role": "user", "content": user_message})
-    session['chat_history'] = current_chat_history
-    session.modified = True
+    session_store.append_history(session_id, [{"role": "user", "content": user_message}])
     
     return jsonify({'status': 'message_received_buffering'})
 
 
+def run_burst_for_session(session_id, burst_messages: List[str], burst_delay: float, burst_delay_reason: str,
+                          burst_history: Optional[List[dict]] = None):
+    """Called by the burst aggregator once per closed window, with every message of the burst."""
+    settings = session_store.get_settings(session_id)
+    # The snapshot taken when the burst opened; the speculative run used the same one.
+    history_snapshot = burst_history or []
+    process_rag_for_session_v2(session_id, settings.get('api_key_for_rag') or "", settings.get('profile_for_rag') or "",
+                               settings.get('persona_for_rag') or "", history_snapshot, " ".join(burst_messages),
+                               burst_delay, burst_delay_reason)
+
+burst_aggregator = BurstAggregator(session_store, burst_scheduler, run_burst_for_session)
+
+# The store rows and the session lock go with the session; these drop its in-process work.
+session_manager.add_evict_hook(burst_scheduler.cancel)
+session_manager.add_evict_hook(lambda session_id: burst_scheduler.cancel(("summary", session_id)))
+session_manager.add_evict_hook(speculator.discard)
+session_manager.add_busy_check(burst_aggregator.is_pending)
+session_manager.start()
+
+
 # --- NEW RAG Processor for Timer ---
 # This version takes the combined message directly
 def process_rag_for_session_v2(session_id_to_process, api_key, profile, persona, 
-                             history_snapshot_for_rag, combined_user_message):
-    session_lock = app.config.get('APP_PROCESSING_LOCKS', {}).get(session_id_to_process)
-    if not session_lock:
-        print(f"FLASK_RAG_V2: No lock for session {session_id_to_process}.")
-        return
-
-    with session_lock:
-        print(f"FLASK_RAG_V2: Processing RAG for session {session_id_to_process}: '{combined_user_message}'")
-        
-        chat_history_for_rag_flat = []
-        for item in history_snapshot_for_rag:
-            if item["role"] == "user": chat_history_for_rag_flat.append(f"Sender: {item['content']}")
-            elif item["role"] == "assistant": chat_history_for_rag_flat.append(f"Flow: {item['content']}")
-            else: chat_history_for_rag_flat.append(f"System: {item['content']}")
-
+                             history_snapshot_for_rag, combined_user_message, burst_delay=None, burst_delay_reason=""):
+    if burst_delay is not None:
+        burst_window.record(burst_delay, burst_delay_reason) # The window that actually closed this burst
+    # No lock is held while the providers work: the inputs are snapshots taken by the caller,
+    # and every bubble goes out through publish_reply(), which drops it if the session was
+    # reset or a newer burst has already answered in the meantime.
+    reply_epoch, reply_version = begin_reply(session_id_to_process)
+    print(f"FLASK_RAG_V2: Processing RAG for session {session_id_to_process}: '{combined_user_message}'")
+    
+    chat_history_for_rag_flat = flatten_history(history_snapshot_for_rag)
+    history_summary = session_store.get_settings(session_id_to_process).get('history_summary') or ""
+
+    speculative_result = None
+    if speculator.enabled:
+        inputs = speculation_inputs(session_id_to_process, api_key, profile, persona,
+                                    history_snapshot_for_rag, combined_user_message)
+        speculative_result = speculator.take(session_id_to_process, speculation_fingerprint(*inputs))
+    prefetched_retrieval = speculative_result if speculator.mode == "retrieval" else None
+
+    streamed_parts = 0
+    if speculator.mode == "full" and speculative_result is not None and not speculative_result.get("error_message"):
+        # The whole reply was generated while the window was open.
+        rag_result = speculative_result
+        print(f"FLASK_RAG_V2: Using speculative reply for {session_id_to_process}.")
+    elif rag.BURST_FORMAT_MODE == "single_call":
+        # Token streaming: each bubble is queued (and pushed to the browser) as soon as
+        # its separator arrives instead of after the whole reply has been generated.
+        rag_result: dict = {}
+        for event in rag.stream_rag_pipeline(api_key, profile, persona, combined_user_message, chat_history_for_rag_flat, history_summary,
+                                             prefetched_retrieval):
+            if "bubble" in event:
+                if not publish_reply(session_id_to_process, reply_epoch, reply_version, [event["bubble"]]):
+                    return # Stale: closing the stream stops the generation
+                streamed_parts += 1
+            else:
+                rag_result = event
+        first_bubble_ms = (rag_result.get("_stage_timings") or {}).get("first_bubble")
+        if first_bubble_ms is not None:
+            print(f"FLASK_RAG_V2: First bubble for {session_id_to_process} after {first_bubble_ms:.0f} ms.")
+    else:
         rag_result = rag.run_rag_pipeline(
-            api_key, profile, persona, combined_user_message, chat_history_for_rag_flat
+            api_key, profile, persona, combined_user_message, chat_history_for_rag_flat, history_summary, prefetched_retrieval
         )
 
-        bot_response_parts: List[str] = []
-        if rag_result.get("error_message"):
-            bot_response_parts = [f"Flow Error: {rag_result['error_message']}"]
-        elif rag_result.get("generated_response"):
-            complete_thought = rag_result["generated_response"]
-            if complete_thought.strip():
-                try:
-                    bot_response_parts = rag.format_response_as_burst_by_llm(
-                        api_key=api_key,
-                        full_response_content=complete_thought,
-                        persona_description=persona,
-                        original_user_query=combined_user_message # Use the actual combined query
-                    )
-                    if not bot_response_parts: bot_response_parts = [complete_thought]
-                except Exception as e_format:
-                    print(f"FLASK_RAG_V2: Error formatting burst: {e_format}")
-                    bot_response_parts = [complete_thought]
-            else:
-                bot_response_parts = ["Flow: (No response generated)"]
+    bot_response_parts: List[str] = []
+    if streamed_parts:
+        pass # Already queued while streaming
+    elif rag_result.get("error_message"):
+        bot_response_parts = [f"Flow Error: {rag_result['error_message']}"]
+    elif rag_result.get("burst_parts"):
+        # Single-call burst mode: generation already produced the message bubbles.
+        bot_response_parts = list(rag_result["burst_parts"])
+    elif rag_result.get("generated_response"):
+        complete_thought = rag_result["generated_response"]
+        if complete_thought.strip():
+            try:
+                bot_response_parts = rag.format_response_as_burst_by_llm(
+                    api_key=api_key,
+                    full_response_content=complete_thought,
+                    persona_description=persona,
+                    original_user_query=combined_user_message # Use the actual combined query
+                )
+                if not bot_response_parts: bot_response_parts = [complete_thought]
+            except Exception as e_format:
+                print(f"FLASK_RAG_V2: Error formatting burst: {e_format}")
+                bot_response_parts = [complete_thought]
         else:
-            bot_response_parts = ["Flow Error: No response content from RAG."]
+            bot_response_parts = ["Flow: (No response generated)"]
+    else:
+        bot_response_parts = ["Flow Error: No response content from RAG."]
 
-        # Store pending responses in app.config
-        app_pending_responses = app.config.setdefault('APP_PENDING_BOT_RESPONSES', {})
-        session_pending_queue = app_pending_responses.setdefault(session_id_to_process, deque())
-        
-        for part in bot_response_parts:
-            session_pending_queue.append(part)
+    # Store pending responses and wake any waiting stream/long-poll
+    if bot_response_parts and not publish_reply(session_id_to_process, reply_epoch, reply_version, bot_response_parts):
+        return
 
-        print(f"FLASK_RAG_V2: Queued {len(bot_response_parts)} response parts for {session_id_to_process}.")
-    
-    app_burst_timers = app.config.get('APP_BURST_TIMERS', {})
-    if session_id_to_process in app_burst_timers:
-        del app_burst_timers[session_id_to_process]
+    print(f"FLASK_RAG_V2: Queued {streamed_parts + len(bot_response_parts)} response parts for {session_id_to_process}.")
+
+    # Fold turns that left the verbatim window into the summary, after the reply is out.
+    burst_scheduler.schedule(("summary", session_id_to_process), HISTORY_SUMMARY_DELAY_SECONDS,
+                             summarize_history_for_session, session_id_to_process, api_key)
+
+
+# --- Reply versioning ---
+# Bursts of one session may now overlap, and a reset may land mid-generation. Each reply
+# takes a version when it starts; a reset bumps the session's epoch. A reply is published
+# only if its epoch is current and no newer reply has been published yet, so answers never
+# appear out of order or in a chat that was cleared.
+_reply_stats_lock = threading.Lock()
+_reply_stats = {"published": 0, "stale_dropped": 0}
+
+def begin_reply(session_id) -> Tuple[int, int]:
+    initialize_session_vars(session_id) # A reply in progress keeps its session alive
+    with get_session_lock(session_id):
+        settings = session_store.get_settings(session_id)
+        reply_version = settings.get('reply_started', 0) + 1
+        session_store.update_settings(session_id, reply_started=reply_version)
+        return settings.get('reply_epoch', 0), reply_version
+
+def publish_reply(session_id, reply_epoch: int, reply_version: int, parts: List[str]) -> bool:
+    with get_session_lock(session_id):
+        settings = session_store.get_settings(session_id)
+        published_version = settings.get('reply_published', 0)
+        if settings.get('reply_epoch', 0) != reply_epoch or published_version > reply_version:
+            with _reply_stats_lock:
+                _reply_stats["stale_dropped"] += 1
+            print(f"FLASK_RAG_V2: Dropping stale reply {reply_version} for {session_id}.")
+            return False
+        session_store.push_bot_responses(session_id, parts)
+        if published_version != reply_version:
+            session_store.update_settings(session_id, reply_published=reply_version)
+    with _reply_stats_lock:
+        _reply_stats["published"] += 1
+    return True
+
+
+# --- Speculative RAG ---
+def speculation_inputs(session_id, api_key, profile, persona, history_snapshot, combined_user_message) -> tuple:
+    """Arguments of the speculative run; they double as its fingerprint."""
+    if speculator.mode == "full":
+        history_summary = session_store.get_settings(session_id).get('history_summary') or ""
+        return (api_key, profile, persona, combined_user_message, flatten_history(history_snapshot), history_summary)
+    return (api_key, profile, combined_user_message)
+
+def run_speculation(inputs: tuple) -> dict:
+    if speculator.mode == "full":
+        return rag.run_rag_pipeline(*inputs)
+    return rag.run_retrieval_pipeline(*inputs)
+
+
+# --- Rolling history summary ---
+def flatten_history(entries) -> List[str]:
+    flat = []
+    for item in entries:
+        if item["role"] == "user": flat.append(f"Sender: {item['content']}")
+        elif item["role"] == "assistant": flat.append(f"Flow: {item['content']}")
+        else: flat.append(f"System: {item['content']}")
+    return flat
+
+def summarize_history_for_session(session_id, api_key):
+    settings = session_store.get_settings(session_id)
+    reply_epoch = settings.get('reply_epoch', 0)
+    overflow = session_store.take_history_overflow(session_id)
+    if not overflow:
+        return
+    summary = rag.summarize_history(api_key, settings.get('history_summary') or "", flatten_history(overflow))
+    with get_session_lock(session_id):
+        # A reset while the summary was generated starts a new chat: this one belongs to the old.
+        if session_store.get_settings(session_id).get('reply_epoch', 0) != reply_epoch:
+            print(f"FLASK_SUMMARY: Dropping summary of a reset chat for {session_id}.")
+            return
+        session_store.update_settings(session_id, history_summary=summary)
+    print(f"FLASK_SUMMARY: Folded {len(overflow)} old turns into the summary for {session_id}.")
 
 
 @app.route('/get_bot_response', methods=['GET'])
 def get_bot_response_api():
+    # Optional ?wait=N turns this into a long-poll: the request is held (without the session
+    # lock) for up to N seconds until a bubble is ready. Used when EventSource is unavailable.
     session_id = session.get('session_id')
     if not session_id: return jsonify({}), 204 # No content if no session
+    initialize_session_vars(session_id)
 
-    initialize_session_vars(session_id) # Ensure session structures exist
+    wait_seconds = min(max(request.args.get('wait', default=0.0, type=float), 0.0), LONG_POLL_MAX_WAIT_SECONDS)
+    taken = session_store.pop_bot_responses(session_id, max_items=1, timeout=wait_seconds)
+    if not taken:
+        return jsonify({}), 204 # No Content
+    bot_message_content = taken[0]
 
-    session_lock = app.config.get('APP_PROCESSING_LOCKS', {}).get(session_id)
-    if not session_lock: return jsonify({}), 204 
+    # Update session chat history
+    session_store.append_history(session_id, [{"role": "assistant", "content": bot_message_content}])
 
-    bot_message_content = None
-    with session_lock:
-        # Get pending responses from app.config's structure
-        app_pending_responses = app.config.get('APP_PENDING_BOT_RESPONSES', {})
-        session_pending_queue = app_pending_responses.get(session_id)
-
-        if session_pending_queue and len(session_pending_queue) > 0:
-            bot_message_content = session_pending_queue.popleft()
-            
-            # Update session chat history
-            current_chat_history = list(session.get('chat_history', []))
-            current_chat_history.append({"role": "assistant", "content": bot_message_content})
-            session['chat_history'] = current_chat_history
-            session.modified = True
-            
-            print(f"FLASK_GET_BOT_RESPONSE: Sent to client for {session_id}: {str(bot_message_content)[:50]}...")
-            return jsonify({'role': 'assistant', 'content': bot_message_content})
-        else:
-            return jsonify({}), 204 # No Content
+    print(f"FLASK_GET_BOT_RESPONSE: Sent to client for {session_id}: {str(bot_message_content)[:50]}...")
+    return jsonify({'role': 'assistant', 'content': bot_message_content})
+
+
+@app.route('/stream_bot_responses', methods=['GET'])
+def stream_bot_responses_api():
+    # Server-Sent Events: bubbles are pushed as soon as they are enqueued. An idle stream
+    # costs one blocked thread and a keep-alive comment every SSE_KEEPALIVE_SECONDS.
+    session_id = session.get('session_id')
+    if not session_id: return jsonify({}), 204
+
+    def event_stream():
+        yield "retry: 3000\n\n"
+        while True:
+            initialize_session_vars(session_id) # An open stream keeps its session alive
+            parts = session_store.pop_bot_responses(session_id, timeout=SSE_KEEPALIVE_SECONDS)
+            if not parts:
+                yield ": keep-alive\n\n"
+                continue
+            session_store.append_history(session_id, [{"role": "assistant", "content": part} for part in parts])
+            for part in parts:
+                print(f"FLASK_STREAM_BOT_RESPONSES: Sent to client for {session_id}: {str(part)[:50]}...")
+                yield f"data: {json.dumps({'role': 'assistant', 'content': part})}\n\n"
+
+    return Response(event_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/session_stats', methods=['GET'])
+def session_stats_api():
+    # Live sessions, queued bubbles and stored bytes, plus eviction counters; should stay flat
+    # under steady traffic.
+    return jsonify(session_manager.stats())
+
+@app.route('/scheduler_stats', methods=['GET'])
+def scheduler_stats_api():
+    # Queue depth, running jobs and queue wait times, for sizing the worker pool under load.
+    return jsonify({**burst_scheduler.stats(), "session_store": session_store.stats(),
+                    "model_registry": rag.get_model_registry_stats(),
+                    "reply_cache": rag.get_reply_cache_stats(), "burst_window": burst_window.stats(),
+                    "speculation": speculator.stats(),
+                    "bursts": burst_aggregator.stats(), "replies": dict(_reply_stats)})
 
 if __name__ == '__main__':
-    # Initialize app.config structures if they don't exist
-    app.config['APP_PROCESSING_LOCKS'] = {}
-    app.config['APP_BURST_TIMERS'] = {}
-    app.config['APP_PENDING_BOT_RESPONSES'] = {}
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port, threaded=True, use_reloader=False)  # use_reloader=False is important with threads
@@ -0,0 +1,437 @@
+# asgi.py
+# Async server for Flow: the same page and endpoints as app.py, served from one event loop.
+#
+#   hypercorn asgi:app --bind 0.0.0.0:5000
+#
+# app.py holds an OS thread for every open event stream, long-poll and running RAG job.
+# Here a waiting session is a suspended coroutine: burst windows are asyncio tasks that
+# sleep, bubble delivery waits on an asyncio.Condition, and the RAG pipeline awaits the
+# providers (rag.astream_rag_pipeline / rag.arun_rag_pipeline), so thousands of idle or
+# waiting sessions can share a single loop.
+#
+# Chat history, its rolling summary and idle-session eviction are shared with app.py
+# (session_store.py, session_manager.py); the cookie only carries the session id. Store
+# calls are short and run on the loop; with FLOW_SESSION_STORE=sqlite each is one small
+# statement.
+import asyncio
+import json
+import os
+import secrets
+from collections import deque
+from typing import Dict, List, Optional
+
+from quart import Quart, Response, jsonify, render_template, request, session
+
+import rag
+from burst_window import create_burst_window
+from session_manager import create_session_manager
+from session_store import create_session_store
+from speculation import speculation_fingerprint
+
+app = Quart(__name__)
+# As in app.py: must be shared by all worker processes and restarts (set FLASK_SECRET_KEY),
+# or session cookies stop being accepted.
+app.secret_key = os.environ.get("FLASK_SECRET_KEY") or secrets.token_hex(16)
+
+RAG_MAX_CONCURRENCY = int(os.environ.get("FLOW_ASYNC_RAG_CONCURRENCY", "64")) # Concurrent RAG jobs (and LLM calls)
+MAX_PENDING_BURSTS = int(os.environ.get("FLOW_MAX_PENDING_BURSTS", "1000")) # Sessions waiting out a burst window
+SPECULATION_MODE = os.environ.get("FLOW_SPECULATE", "retrieval").lower() # off / retrieval / full, as in app.py
+SPECULATION_MAX_CONCURRENCY = int(os.environ.get("FLOW_ASYNC_SPECULATION_CONCURRENCY", "32"))
+SSE_KEEPALIVE_SECONDS = 15
+burst_window = create_burst_window() # Adaptive burst window, as in app.py
+LONG_POLL_MAX_WAIT_SECONDS = 25
+HISTORY_SUMMARY_DELAY_SECONDS = 1 # As in app.py: summarise after the reply is out
+session_store = create_session_store(max_history=rag.HISTORY_PROMPT_TURNS)
+session_manager = create_session_manager(session_store)
+
+
+# --- Per-session state ---
+# Burst window, running work and undelivered bubbles live in process memory, keyed by the
+# session_id kept in the cookie session (as in app.py); history lives in session_store.
+class SessionState:
+    def __init__(self):
+        self.burst_buffer: List[str] = [] # User messages of the current burst window
+        self.burst_history: List[dict] = [] # Chat history when the burst's first message arrived
+        self.burst_task: Optional[asyncio.Task] = None # Waiting out the burst window; None once RAG has started
+        self.burst_timing: Optional[dict] = None # Sender's message rhythm (see burst_window.py)
+        self.speculation: Optional[tuple] = None # (fingerprint, task) of RAG work on the partial burst
+        self.jobs: set = set() # Strong references to running RAG tasks
+        self.reply_epoch = 0 # Bumped by a reset; replies started before it are stale
+        self.reply_started = 0 # Version of the newest reply that has started
+        self.reply_published = 0 # Version of the newest reply with a published bubble
+        self.pending = deque() # Bubbles not yet delivered to the browser
+        self.condition = asyncio.Condition()
+
+    def is_busy(self) -> bool:
+        return self.burst_task is not None or bool(self.jobs) or self.speculation is not None
+
+_sessions: Dict[str, SessionState] = {}
+_rag_slots = asyncio.Semaphore(RAG_MAX_CONCURRENCY)
+_speculation_slots = asyncio.Semaphore(SPECULATION_MAX_CONCURRENCY)
+_stats = {"bursts_started": 0, "bursts_completed": 0, "bursts_failed": 0, "rejected": 0,
+          "replies_published": 0, "stale_dropped": 0,
+          "speculation_started": 0, "speculation_cancelled": 0, "speculation_used": 0, "speculation_missed": 0}
+_sweeper_task: Optional[asyncio.Task] = None
+
+def get_session_state(session_id) -> SessionState:
+    state = _sessions.get(session_id)
+    if state is None:
+        state = _sessions[session_id] = SessionState()
+    session_manager.touch(session_id) # Every request keeps its session from being evicted as idle
+    return state
+
+def _pending_burst_count() -> int:
+    return sum(1 for state in _sessions.values() if state.burst_task is not None)
+
+# Idle sessions lose their store rows and their SessionState; one with a pending burst or
+# running work is kept. Sweeps run on the loop, so they never race a request.
+session_manager.add_busy_check(lambda session_id: session_id in _sessions and _sessions[session_id].is_busy())
+session_manager.add_evict_hook(lambda session_id: _sessions.pop(session_id, None))
+
+async def _sweep_idle_sessions():
+    while True:
+        await asyncio.sleep(session_manager.sweep_interval_seconds)
+        try:
+            session_manager.sweep()
+        except Exception as e:
+            print(f"ASGI_SESSIONS: Sweep failed: {e}")
+
+async def enqueue_bot_responses(state: SessionState, parts: List[str]):
+    async with state.condition:
+        state.pending.extend(parts)
+        state.condition.notify_all()
+
+# --- Reply versioning ---
+# As in app.py: a reply publishes only if no reset happened since it started and no newer
+# reply has published yet. The check and the enqueue share one step on the loop.
+def begin_reply(state: SessionState) -> tuple:
+    state.reply_started += 1
+    return state.reply_epoch, state.reply_started
+
+async def publish_reply(session_id, state: SessionState, reply_epoch: int, reply_version: int, parts: List[str]) -> bool:
+    if state.reply_epoch != reply_epoch or state.reply_published > reply_version:
+        _stats["stale_dropped"] += 1
+        print(f"ASGI_RAG: Dropping stale reply {reply_version} for {session_id}.")
+        return False
+    state.reply_published = reply_version
+    await enqueue_bot_responses(state, parts)
+    _stats["replies_published"] += 1
+    return True
+
+async def take_bot_responses(state: SessionState, max_items=None, timeout=0.0) -> List[str]:
+    """Pops up to max_items pending bubbles, waiting up to `timeout` seconds for the first one."""
+    async with state.condition:
+        if timeout > 0 and not state.pending:
+            try:
+                await asyncio.wait_for(state.condition.wait_for(lambda: len(state.pending) > 0), timeout)
+            except asyncio.TimeoutError:
+                pass
+        taken = []
+        while state.pending and (max_items is None or len(taken) < max_items):
+            taken.append(state.pending.popleft())
+        return taken
+
+def _ensure_session_id() -> str:
+    if 'session_id' not in session:
+        session['session_id'] = secrets.token_hex(16)
+    return session['session_id']
+
+
+# --- Speculative RAG ---
+# Same policy as speculation.py, but a superseded speculation is a task and is really
+# cancelled, including an in-flight provider call.
+def _flatten_history(history) -> List[str]:
+    flat = []
+    for item in history:
+        if item["role"] == "user": flat.append(f"Sender: {item['content']}")
+        elif item["role"] == "assistant": flat.append(f"Flow: {item['content']}")
+        else: flat.append(f"System: {item['content']}")
+    return flat
+
+def _speculation_inputs(session_id, api_key, profile, persona, history_snapshot, combined_user_message) -> tuple:
+    if SPECULATION_MODE == "full":
+        history_summary = session_store.get_settings(session_id).get('history_summary') or ""
+        return (api_key, profile, persona, combined_user_message, _flatten_history(history_snapshot), history_summary)
+    return (api_key, profile, combined_user_message)
+
+async def _run_speculation(inputs: tuple) -> dict:
+    async with _speculation_slots:
+        if SPECULATION_MODE == "full":
+            return await rag.arun_rag_pipeline(*inputs)
+        return await rag.arun_retrieval_pipeline(*inputs)
+
+def _cancel_speculation(state: SessionState):
+    if state.speculation is not None:
+        if state.speculation[1].cancel():
+            _stats["speculation_cancelled"] += 1
+        state.speculation = None
+
+def _start_speculation(state: SessionState, inputs: tuple):
+    if SPECULATION_MODE not in ("retrieval", "full"):
+        return
+    fingerprint = speculation_fingerprint(*inputs)
+    if state.speculation is not None and state.speculation[0] == fingerprint:
+        return
+    _cancel_speculation(state)
+    state.speculation = (fingerprint, asyncio.create_task(_run_speculation(inputs)))
+    _stats["speculation_started"] += 1
+
+async def _take_speculation(state: SessionState, inputs: tuple) -> Optional[dict]:
+    speculation, state.speculation = state.speculation, None
+    if speculation is None or speculation[0] != speculation_fingerprint(*inputs):
+        if speculation is not None and speculation[1].cancel():
+            _stats["speculation_cancelled"] += 1
+        _stats["speculation_missed"] += 1
+        return None
+    try:
+        result = await speculation[1]
+    except Exception as e:
+        print(f"ASGI_RAG: Speculative run failed: {e}")
+        _stats["speculation_missed"] += 1
+        return None
+    _stats["speculation_used"] += 1
+    return result
+
+
+# --- RAG processing ---
+async def _run_burst(session_id, state: SessionState, api_key, profile, persona, delay, delay_reason):
+    await asyncio.sleep(delay)
+    burst_window.record(delay, delay_reason)
+    # The window has closed: later messages start a new burst instead of cancelling this one.
+    burst_messages, state.burst_buffer = state.burst_buffer, []
+    combined_user_message = " ".join(burst_messages)
+    history_snapshot = state.burst_history # The snapshot the speculative run used too
+    state.burst_task = None
+    job = asyncio.current_task()
+    state.jobs.add(job)
+    _stats["bursts_started"] += 1
+    reply_epoch, reply_version = begin_reply(state)
+    try:
+        async with _rag_slots:
+            await process_rag_for_session(session_id, state, api_key, profile, persona, history_snapshot, combined_user_message,
+                                          reply_epoch, reply_version)
+        _stats["bursts_completed"] += 1
+    except Exception as e:
+        _stats["bursts_failed"] += 1
+        print(f"ASGI_RAG: Burst for {session_id} failed: {e}")
+        await publish_reply(session_id, state, reply_epoch, reply_version, [f"Flow Error: {e}"])
+    finally:
+        state.jobs.discard(job)
+
+async def process_rag_for_session(session_id, state: SessionState, api_key, profile, persona, history_snapshot_for_rag, combined_user_message,
+                                  reply_epoch: int, reply_version: int):
+    print(f"ASGI_RAG: Processing RAG for session {session_id}: '{combined_user_message}'")
+    chat_history_for_rag_flat = _flatten_history(history_snapshot_for_rag)
+    history_summary = session_store.get_settings(session_id).get('history_summary') or ""
+
+    speculative_result = None
+    if SPECULATION_MODE in ("retrieval", "full"):
+        speculative_result = await _take_speculation(
+            state, _speculation_inputs(session_id, api_key, profile, persona, history_snapshot_for_rag, combined_user_message))
+    prefetched_retrieval = speculative_result if SPECULATION_MODE == "retrieval" else None
+
+    streamed_parts = 0
+    if SPECULATION_MODE == "full" and speculative_result is not None and not speculative_result.get("error_message"):
+        rag_result = speculative_result # The whole reply was generated while the window was open
+    elif rag.BURST_FORMAT_MODE == "single_call":
+        rag_result: dict = {}
+        async for event in rag.astream_rag_pipeline(api_key, profile, persona, combined_user_message, chat_history_for_rag_flat,
+                                                    history_summary, prefetched_retrieval):
+            if "bubble" in event:
+                if not await publish_reply(session_id, state, reply_epoch, reply_version, [event["bubble"]]):
+                    return # Stale: leaving the loop closes the stream and stops the generation
+                streamed_parts += 1
+            else:
+                rag_result = event
+    else:
+        rag_result = await rag.arun_rag_pipeline(api_key, profile, persona, combined_user_message, chat_history_for_rag_flat,
+                                                 history_summary, prefetched_retrieval)
+
+    bot_response_parts: List[str] = []
+    if streamed_parts:
+        pass # Already queued while streaming
+    elif rag_result.get("error_message"):
+        bot_response_parts = [f"Flow Error: {rag_result['error_message']}"]
+    elif rag_result.get("burst_parts"):
+        bot_response_parts = list(rag_result["burst_parts"])
+    elif (rag_result.get("generated_response") or "").strip():
+        complete_thought = rag_result["generated_response"]
+        # Two-call mode only; the formatter is synchronous, so keep it off the loop.
+        bot_response_parts = await asyncio.to_thread(
+            rag.format_response_as_burst_by_llm, api_key, complete_thought, persona, combined_user_message
+        ) or [complete_thought]
+    else:
+        bot_response_parts = ["Flow Error: No response content from RAG."]
+    if bot_response_parts and not await publish_reply(session_id, state, reply_epoch, reply_version, bot_response_parts):
+        return
+    print(f"ASGI_RAG: Queued {streamed_parts + len(bot_response_parts)} response parts for {session_id}.")
+
+    # Fold turns that left the verbatim window into the summary, after the reply is out.
+    summary_job = asyncio.create_task(_summarize_history(session_id, state, api_key))
+    state.jobs.add(summary_job)
+    summary_job.add_done_callback(state.jobs.discard)
+
+async def _summarize_history(session_id, state: SessionState, api_key):
+    await asyncio.sleep(HISTORY_SUMMARY_DELAY_SECONDS)
+    reply_epoch = state.reply_epoch
+    overflow = session_store.take_history_overflow(session_id)
+    if not overflow:
+        return
+    previous_summary = session_store.get_settings(session_id).get('history_summary') or ""
+    try:
+        summary = await asyncio.to_thread(rag.summarize_history, api_key, previous_summary, _flatten_history(overflow))
+    except Exception as e:
+        print(f"ASGI_SUMMARY: Summary for {session_id} failed: {e}")
+        return
+    if state.reply_epoch != reply_epoch:
+        return # Reset meanwhile: the summary is of the old chat
+    session_store.update_settings(session_id, history_summary=summary)
+    print(f"ASGI_SUMMARY: Folded {len(overflow)} old turns into the summary for {session_id}.")
+
+
+@app.before_serving
+async def warm_up():
+    # Load NLTK punkt, the text splitter and caches now, not on the first user's request.
+    await asyncio.to_thread(rag.warm_up)
+
+@app.before_serving
+async def start_session_sweeper():
+    global _sweeper_task
+    _sweeper_task = asyncio.create_task(_sweep_idle_sessions())
+
+@app.after_serving
+async def stop_session_sweeper():
+    if _sweeper_task is not None:
+        _sweeper_task.cancel()
+
+
+# --- Routes ---
+@app.route('/')
+async def index():
+    session_id = _ensure_session_id()
+    get_session_state(session_id)
+    return await render_template('index.html', chat_history=session_store.get_history(session_id))
+
+@app.route('/chat', methods=['POST'])
+async def chat_api():
+    session_id = _ensure_session_id()
+    state = get_session_state(session_id)
+    data = await request.get_json()
+    user_message = data.get('message')
+
+    if state.burst_task is None and _pending_burst_count() >= MAX_PENDING_BURSTS:
+        _stats["rejected"] += 1
+        print(f"ASGI_CHAT_API: Too many pending bursts, refusing message for {session_id}")
+        return jsonify({'status': 'busy', 'error': 'Flow is busy right now, please try again shortly.'}), 503
+
+    if state.burst_task is not None:
+        state.burst_task.cancel() # Restart the burst window; buffered messages are kept
+    if not state.burst_buffer:
+        # Taken once per burst: the burst's own messages may push old turns out of the bounded
+        # history, so a later snapshot would no longer match the speculative run's.
+        state.burst_history = session_store.get_history(session_id)
+    state.burst_buffer.append(user_message)
+    state.burst_timing = burst_window.observe(state.burst_timing)
+    delay, delay_reason = burst_window.choose_delay(state.burst_timing, user_message)
+    api_key, profile, persona = data.get('api_key') or "", data.get('user_profile') or "", data.get('user_persona') or ""
+    state.burst_task = asyncio.create_task(_run_burst(
+        session_id, state, api_key, profile, persona, delay, delay_reason))
+    # The history snapshot and combined message the burst will see if nothing else arrives.
+    _start_speculation(state, _speculation_inputs(session_id, api_key, profile, persona, state.burst_history,
+                                                  " ".join(state.burst_buffer)))
+    print(f"ASGI_CHAT_API: Msg added for {session_id}. Burst: {state.burst_buffer}, window {delay:.1f}s ({delay_reason})")
+
+    session_store.append_history(session_id, [{"role": "user", "content": user_message}])
+    return jsonify({'status': 'message_received_buffering'})
+
+@app.route('/reset_session', methods=['POST'])
+async def reset_session_api():
+    session_id = session.get('session_id')
+    if not session_id:
+        return jsonify({'error': 'No active session to reset.'}), 400
+    state = get_session_state(session_id)
+    if state.burst_task is not None:
+        state.burst_task.cancel()
+        state.burst_task = None
+    _cancel_speculation(state)
+    # Running bursts and summaries belong to the old chat; the epoch catches any bubble a
+    # job still manages to publish before its cancellation lands.
+    for job in list(state.jobs):
+        job.cancel()
+    state.reply_epoch += 1
+    state.burst_buffer, state.burst_history = [], []
+    async with state.condition:
+        state.pending.clear()
+    session_store.reset(session_id)
+    session_store.update_settings(session_id, history_summary="")
+
+    data = await request.get_json()
+    new_api_key = data.get('api_key')
+    new_user_profile = data.get('user_profile')
+    if new_api_key and new_user_profile:
+        init_state = rag.FlowState(
+            user_api_key=new_api_key, user_profile_content=new_user_profile,
+            user_persona_description=data.get('user_persona') or "", incoming_message="", chat_history=[],
+            retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None,
+            _stage_timings=None, burst_parts=None, history_summary=None, _query_vector=None
+        )
+        result_state = await rag.ainitialize_models_node(init_state)
+        if result_state.get("error_message"):
+            print(f"ASGI_RESET_API: Error re-initializing RAG: {result_state['error_message']}")
+    return jsonify({'message': f'Session reset and RAG re-initialized for persona {data.get("new_persona_id", "N/A")}.'})
+
+@app.route('/get_bot_response', methods=['GET'])
+async def get_bot_response_api():
+    session_id = session.get('session_id')
+    if not session_id: return jsonify({}), 204
+    state = get_session_state(session_id)
+
+    wait_seconds = min(max(request.args.get('wait', default=0.0, type=float), 0.0), LONG_POLL_MAX_WAIT_SECONDS)
+    taken = await take_bot_responses(state, max_items=1, timeout=wait_seconds)
+    if not taken:
+        return jsonify({}), 204
+    session_store.append_history(session_id, [{"role": "assistant", "content": taken[0]}])
+    return jsonify({'role': 'assistant', 'content': taken[0]})
+
+@app.route('/stream_bot_responses', methods=['GET'])
+async def stream_bot_responses_api():
+    session_id = session.get('session_id')
+    if not session_id: return jsonify({}), 204
+    state = get_session_state(session_id)
+
+    async def event_stream():
+        yield "retry: 3000\n\n"
+        while True:
+            session_manager.touch(session_id) # An open stream keeps its session alive
+            parts = await take_bot_responses(state, timeout=SSE_KEEPALIVE_SECONDS)
+            if not parts:
+                yield ": keep-alive\n\n"
+                continue
+            session_store.append_history(session_id, [{"role": "assistant", "content": part} for part in parts])
+            for part in parts:
+                yield f"data: {json.dumps({'role': 'assistant', 'content': part})}\n\n"
+
+    response = Response(event_stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None # Event streams stay open for the life of the page
+    return response
+
+@app.route('/session_stats', methods=['GET'])
+async def session_stats_api():
+    # Bubbles wait in SessionState here, not in the store, so they are counted in process.
+    states = list(_sessions.values())
+    in_process_bytes = sum(len(text.encode("utf-8")) for state in states for text in (*state.burst_buffer, *state.pending))
+    stats = session_manager.stats()
+    return jsonify({**stats, "in_process_sessions": len(states), "busy": sum(1 for state in states if state.is_busy()),
+                    "queued_bubbles": sum(len(state.pending) for state in states), "bytes": stats["bytes"] + in_process_bytes})
+
+@app.route('/scheduler_stats', methods=['GET'])
+async def scheduler_stats_api():
+    return jsonify({**_stats, "sessions": len(_sessions), "pending_bursts": _pending_burst_count(),
+                    "running": sum(len(state.jobs) for state in _sessions.values()),
+                    "max_concurrency": RAG_MAX_CONCURRENCY, "speculation_mode": SPECULATION_MODE, "reply_cache": rag.get_reply_cache_stats(),
+                    "burst_window": burst_window.stats()})
+
+if __name__ == '__main__':
+    port = int(os.environ.get("PORT", 5000))
+    app.run(host='0.0.0.0', port=port, use_reloader=False)
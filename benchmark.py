@@ -0,0 +1,279 @@
+# benchmark.py
+# Micro-benchmarks for the retrieval path. Runs fully offline: vectors are random
+# unit vectors fed through a lookup "embedding", so only the store itself is measured.
+#
+#   python benchmark.py                 # all benchmarks
+#   python benchmark.py retrieval       # retriever backends only
+#   python benchmark.py prompts         # prompt/chain construction overhead
+#   python benchmark.py burst_window    # fixed vs adaptive burst window on simulated senders
+#   python benchmark.py bursts          # burst aggregation: pipeline runs per burst, interleaved sessions
+#   FLOW_PROVIDER=fake FLOW_FAKE_LLM_LATENCY=2 python benchmark.py session_lock
+#                                       # /chat and /get_bot_response latency while a reply is generating
+
+import argparse
+import statistics
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+import rag
+from burst_aggregator import BurstAggregator
+from burst_window import AdaptiveBurstWindow
+from latency_stats import percentile
+from numpy_store import NumpyVectorStore
+import providers
+from providers import EchoChatModel
+from scheduler import BurstScheduler
+from session_store import InMemorySessionStore
+
+EMBEDDING_DIM = 768 # models/embedding-001 output size
+
+
+class LookupEmbeddings(Embeddings):
+    """Returns precomputed vectors for known texts; no model involved."""
+
+    def __init__(self, vectors_by_text: Dict[str, List[float]]):
+        self.vectors_by_text = vectors_by_text
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vectors_by_text[text] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vectors_by_text[text]
+
+
+def time_calls(fn: Callable[[int], object], iterations: int) -> List[float]:
+    timings_ms = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        timings_ms.append((time.perf_counter() - start) * 1000.0)
+    return timings_ms
+
+
+def _random_unit_vectors(rng: np.random.Generator, n: int) -> np.ndarray:
+    vectors = rng.standard_normal((n, EMBEDDING_DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark_retrieval_backends(sizes=(10, 1_000, 100_000), queries: int = 200, k: int = 3) -> List[dict]:
+    rng = np.random.default_rng(0)
+    results = []
+    for n in sizes:
+        texts = [f"chunk {i}" for i in range(n)]
+        chunk_vectors = _random_unit_vectors(rng, n)
+        query_vectors = _random_unit_vectors(rng, queries).tolist()
+        embeddings = LookupEmbeddings(dict(zip(texts, chunk_vectors.tolist())))
+        ids = [str(i) for i in range(n)]
+
+        numpy_store = NumpyVectorStore.from_texts(texts, embeddings, ids=ids)
+        chroma_store = Chroma.from_texts(texts, embeddings, ids=ids, collection_name=f"bench-{n}")
+        try:
+            for backend, store in (("numpy", numpy_store), ("chroma", chroma_store)):
+                store.similarity_search_by_vector(query_vectors[0], k=k)  # warm-up
+                timings = time_calls(lambda i: store.similarity_search_by_vector(query_vectors[i], k=k), queries)
+                results.append({"backend": backend, "chunks": n, "queries": queries,
+                                "p50_ms": statistics.median(timings), "p99_ms": percentile(timings, 99)})
+        finally:
+            chroma_store.delete_collection()
+    return results
+
+
+def benchmark_prompt_chains(iterations: int = 2000) -> List[dict]:
+    """Per-call cost of composing prompt | llm | parser vs reusing the cached chain.
+
+    Uses the offline echo model with no latency, so build+invoke is pure local overhead.
+    """
+    model = EchoChatModel(latency_seconds=0.0)
+    format_templates = [("system", rag.BURST_FORMAT_PROMPT.messages[0].prompt.template),
+                        ("human", rag.BURST_FORMAT_PROMPT.messages[1].prompt.template)]
+    variants = {
+        "generation": (
+            lambda: rag._generation_prompt(rag.GENERATION_SYSTEM_PROMPT + rag.BURST_GENERATION_INSTRUCTIONS) | model | StrOutputParser(),
+            lambda: rag.get_chain(model, rag.BURST_GENERATION_PROMPT),
+            {"user_persona": "Busy student.", "retrieved_context": "Alice likes hiking.", "history_summary": "None.",
+             "chat_history": "Sender: hey", "incoming_message": "are you free on Saturday?"}),
+        "burst_format": (
+            lambda: ChatPromptTemplate.from_messages(format_templates) | model | StrOutputParser(),
+            lambda: rag.get_chain(model, rag.BURST_FORMAT_PROMPT),
+            {"input_persona": "Busy student.", "input_original_query": "are you free on Saturday?",
+             "input_full_thought": "I'm swamped with exams, but Saturday morning could work. Let me know!"}),
+    }
+    results = []
+    for prompt_name, (rebuild, cached, inputs) in variants.items():
+        for variant, build in (("rebuild", rebuild), ("cached", cached)):
+            build().invoke(inputs)  # warm-up
+            build_ms = time_calls(lambda i: build(), iterations)
+            total_ms = time_calls(lambda i: build().invoke(inputs), iterations // 4)
+            results.append({"prompt": prompt_name, "variant": variant,
+                            "build_p50_us": statistics.median(build_ms) * 1000.0,
+                            "build+invoke_p50_us": statistics.median(total_ms) * 1000.0})
+    return results
+
+
+def _simulated_bursts(rng: np.random.Generator, senders: int, bursts_per_sender: int):
+    """Yields (sender, [(gap before message, text), ...]) for made-up multi-part bursts."""
+    for sender in range(senders):
+        typing_gap = rng.uniform(0.4, 2.5) # Each sender has their own rhythm
+        for _ in range(bursts_per_sender):
+            parts = int(rng.integers(1, 5))
+            messages = []
+            for i in range(parts):
+                gap = 60.0 if i == 0 else min(float(rng.exponential(typing_gap)), 4.5)
+                last = i == parts - 1
+                ending = "?" if last and rng.random() < 0.6 else ("," if not last and rng.random() < 0.3 else "")
+                messages.append((gap, f"part {i}{ending}"))
+            yield sender, messages
+
+
+def benchmark_burst_window(senders: int = 200, bursts_per_sender: int = 20) -> List[dict]:
+    """Reply wait after the sender's last message, and how often a burst gets split, fixed vs adaptive."""
+    results = []
+    variants = {"fixed_5s": AdaptiveBurstWindow(min_delay=5.0, max_delay=5.0, default_delay=5.0),
+                "adaptive": AdaptiveBurstWindow()}
+    for name, window in variants.items():
+        rng = np.random.default_rng(0)
+        timings: Dict[int, dict] = {}
+        waits, runs, bursts, split_bursts = [], 0, 0, 0
+        clock = 0.0
+        for sender, messages in _simulated_bursts(rng, senders, bursts_per_sender):
+            bursts += 1
+            burst_runs = 0
+            for i, (gap, text) in enumerate(messages):
+                clock += gap
+                timings[sender] = window.observe(timings.get(sender), clock)
+                delay, _ = window.choose_delay(timings[sender], text)
+                next_gap = messages[i + 1][0] if i + 1 < len(messages) else None
+                if next_gap is None or next_gap > delay: # The window closes before the next message
+                    burst_runs += 1
+                    if next_gap is None:
+                        waits.append(delay)
+            runs += burst_runs
+            split_bursts += burst_runs > 1
+        results.append({"window": name, "wait_p50_s": statistics.median(waits), "wait_p90_s": percentile(waits, 90),
+                        "runs_per_burst": runs / bursts, "split_bursts_%": 100.0 * split_bursts / bursts})
+    return results
+
+
+def benchmark_burst_aggregation(sessions: int = 50, bursts_per_session: int = 3, window: float = 0.2) -> List[dict]:
+    """Interleaves multi-part bursts from many sessions and counts pipeline runs per burst.
+
+    Every message of a burst arrives well inside the window, so each burst must reach the
+    (counting) pipeline exactly once, with all of its messages in order.
+    """
+    import threading
+    store = InMemorySessionStore(max_history=10)
+    scheduler = BurstScheduler(workers=4, max_queue=sessions * 2, max_pending=sessions * 2, name="bench")
+    runs: Dict[str, List[List[str]]] = {}
+    runs_lock = threading.Lock()
+
+    def on_burst(session_id, messages, delay, reason, history):
+        with runs_lock:
+            runs.setdefault(session_id, []).append(messages)
+
+    aggregator = BurstAggregator(store, scheduler, on_burst)
+    rng = np.random.default_rng(0)
+    expected: Dict[str, List[List[str]]] = {f"s{i}": [] for i in range(sessions)}
+    for burst in range(bursts_per_session):
+        parts = {session_id: [f"{session_id} b{burst} m{j}" for j in range(int(rng.integers(1, 5)))] for session_id in expected}
+        schedule = []
+        for session_id, texts in parts.items():
+            at = 0.0
+            for text in texts:
+                schedule.append((at, session_id, text))
+                at += float(rng.uniform(0, window * 0.5)) # Gaps stay well below the window
+        schedule.sort(key=lambda item: item[0])
+        start = time.perf_counter()
+        for at, session_id, text in schedule:
+            time.sleep(max(0.0, at - (time.perf_counter() - start)))
+            aggregator.add(session_id, text, window)
+        for session_id, texts in parts.items():
+            expected[session_id].append(texts)
+        time.sleep(window * 4)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        scheduler_stats = scheduler.stats()
+        if not (scheduler_stats["pending_deadlines"] or scheduler_stats["queue_depth"] or scheduler_stats["running"]):
+            break
+        time.sleep(0.01)
+    scheduler.shutdown()
+    bursts = sessions * bursts_per_session
+    total_runs = sum(len(session_runs) for session_runs in runs.values())
+    mismatched = sum(runs.get(session_id, []) != session_bursts for session_id, session_bursts in expected.items())
+    return [{"sessions": sessions, "bursts": bursts, "messages": aggregator.stats()["messages"],
+             "pipeline_runs": total_runs, "runs_per_burst": total_runs / bursts, "mismatched_sessions": mismatched}]
+
+
+def benchmark_session_lock(requests_per_endpoint: int = 20, threads: int = 4) -> List[dict]:
+    """Request latency for one session while its reply is being generated (app.py, offline provider).
+
+    Each client thread fires /chat and /get_bot_response for the same session while the slow
+    echo model is generating; none of them should wait for the generation. A reset halfway
+    through must drop the reply generated for the old chat.
+    """
+    if not providers.is_offline() or providers.FAKE_LLM_LATENCY_SECONDS <= 0:
+        print("session_lock: needs FLOW_PROVIDER=fake and FLOW_FAKE_LLM_LATENCY > 0, skipped.")
+        return []
+    import threading
+    import app as flask_app
+    client = flask_app.app.test_client()
+    client.get('/')
+    payload = {'api_key': 'bench', 'user_profile': "I am Sam. I like hiking and coffee.", 'user_persona': 'casual'}
+    client.post('/chat', json={**payload, 'message': 'are you free tonight?'})
+    time.sleep(flask_app.burst_window.min_delay + 0.2) # The burst is now generating
+
+    latencies: Dict[str, List[float]] = {"/chat": [], "/get_bot_response": []}
+    latencies_lock = threading.Lock()
+
+    def hammer(worker: int):
+        for i in range(requests_per_endpoint // threads):
+            for endpoint, call in (("/chat", lambda: client.post('/chat', json={**payload, 'message': f'and {worker}-{i}'})),
+                                   ("/get_bot_response", lambda: client.get('/get_bot_response?wait=0'))):
+                start = time.perf_counter()
+                call()
+                with latencies_lock:
+                    latencies[endpoint].append((time.perf_counter() - start) * 1000.0)
+
+    workers = [threading.Thread(target=hammer, args=(worker,)) for worker in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    client.post('/reset_session', json=payload) # Replies still generating for the old chat are now stale
+    time.sleep(providers.FAKE_LLM_LATENCY_SECONDS + flask_app.burst_window.max_delay + 0.5)
+    rows = [{"endpoint": endpoint, "requests": len(samples), "p50_ms": statistics.median(samples),
+             "p95_ms": percentile(samples, 95), "max_ms": max(samples)} for endpoint, samples in latencies.items()]
+    print(f"replies: {flask_app._reply_stats}")
+    return rows
+
+
+def print_table(title: str, rows: List[dict]) -> None:
+    print(f"\n--- {title} ---")
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    print("  ".join(f"{c:>12}" for c in columns))
+    for row in rows:
+        print("  ".join(f"{row[c]:>12.3f}" if isinstance(row[c], float) else f"{row[c]:>12}" for c in columns))
+
+
+BENCHMARKS = {
+    "retrieval": ("Retriever backends: per-query latency (similarity_search_by_vector, k=3)", benchmark_retrieval_backends),
+    "prompts": ("Prompt/chain construction per call: rebuilt vs cached (offline echo model)", benchmark_prompt_chains),
+    "burst_window": ("Burst window on simulated senders: reply wait after the last message, bursts split", benchmark_burst_window),
+    "bursts": ("Burst aggregation, interleaved sessions: pipeline runs per burst (expected 1.0, 0 mismatched)", benchmark_burst_aggregation),
+    "session_lock": ("Same-session request latency while a reply is generating (offline provider)", benchmark_session_lock),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks for Flow.")
+    parser.add_argument("benchmarks", nargs="*", choices=sorted(BENCHMARKS), help="Benchmarks to run (default: all).")
+    args = parser.parse_args()
+    for name in args.benchmarks or list(BENCHMARKS):
+        title, fn = BENCHMARKS[name]
+        print_table(title, fn())
@@ -0,0 +1,75 @@
+# burst_aggregator.py
+# Collects a session's messages until its burst window closes, then hands the whole burst
+# to the RAG job exactly once.
+#
+# Messages are appended to the session store's burst buffer; each one (re)schedules the
+# session's deadline on the BurstScheduler. Only the job that fires takes (and clears) the
+# buffer, so every message of the window reaches the same run. Taking is atomic in both
+# stores: a job that finds the buffer already taken (by a reset, or by another worker
+# process sharing a SQLite store) does nothing.
+#
+# The chat history as of the burst's first message is kept with the buffer and handed to the
+# job, so the speculative run (started on arrival) and the real run see the same snapshot
+# even after the burst's own messages have pushed old turns out of the bounded history.
+import threading
+from typing import Callable, List, Optional
+
+from scheduler import BurstScheduler
+from session_store import SessionStore
+
+
+class BurstAggregator:
+    def __init__(self, store: SessionStore, scheduler: BurstScheduler,
+                 on_burst: Callable[[str, List[str], float, str, Optional[List[dict]]], None]):
+        self.store = store
+        self.scheduler = scheduler
+        self.on_burst = on_burst # on_burst(session_id, messages, window delay, delay reason, history before the burst)
+        self._stats_lock = threading.Lock()
+        self.messages = 0
+        self.bursts = 0
+        self.empty_fires = 0
+        self.rejected = 0
+
+    def add(self, session_id: str, message: str, delay: float, delay_reason: str = "",
+            history: Optional[List[dict]] = None) -> Optional[List[str]]:
+        """Buffers message and restarts the session's window.
+
+        `history` is the chat history without this message; it is kept if the message opens
+        a burst. The store's get_burst_history() returns what the job will receive.
+
+        Returns the burst so far, or None if the scheduler refused a new burst (the message
+        is then dropped from the buffer again; earlier messages still belong to the burst
+        whose job is already queued, which takes them when it runs).
+        """
+        burst = self.store.append_burst_message(session_id, message, history)
+        if not self.scheduler.schedule(session_id, delay, self._fire, session_id, delay, delay_reason):
+            self.store.drop_last_burst_message(session_id, message)
+            with self._stats_lock:
+                self.rejected += 1
+            return None
+        with self._stats_lock:
+            self.messages += 1
+        return burst
+
+    def cancel(self, session_id: str) -> bool:
+        """Drops the pending window and its buffered messages."""
+        cancelled = self.scheduler.cancel(session_id)
+        self.store.take_burst_buffer(session_id)
+        return cancelled
+
+    def is_pending(self, session_id: str) -> bool:
+        return self.scheduler.is_pending(session_id)
+
+    def _fire(self, session_id: str, delay: float, delay_reason: str) -> None:
+        messages, history = self.store.take_burst(session_id)
+        with self._stats_lock:
+            if not messages:
+                self.empty_fires += 1
+                return
+            self.bursts += 1
+        self.on_burst(session_id, messages, delay, delay_reason, history)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {"messages": self.messages, "bursts": self.bursts, "empty_fires": self.empty_fires,
+                    "rejected": self.rejected, "messages_per_burst": (self.messages / self.bursts) if self.bursts else 0.0}
@@ -0,0 +1,90 @@
+# burst_window.py
+# Adaptive burst window: how long to wait after a message before answering the burst.
+#
+# A fixed 5 s window makes every reply at least 5 s late, even after "ok thanks!". Instead:
+#   - a message that ends a thought (terminal punctuation, a question mark, a sign-off) closes
+#     the window after a short cue delay,
+#   - a message that clearly continues ("so...", "and", a trailing comma) waits the maximum,
+#   - otherwise the wait follows the sender's own typing rhythm: an exponentially weighted
+#     average of the gaps between their messages, times a slack factor,
+# always clamped to [min_delay, max_delay]. The per-sender timing is a small JSON-able dict,
+# so callers keep it with the rest of the session (session_store settings / SessionState).
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from typing import Optional, Tuple
+
+from latency_stats import percentile
+
+_TERMINAL_PATTERN = re.compile(r"([.!?]|[☀-➿\U0001f300-\U0001faff])\s*$")
+_CONTINUATION_PATTERN = re.compile(r"(\.\.\.|…|,|:|-)\s*$|\b(and|but|so|or|because|also|then|like)\s*$", re.IGNORECASE)
+# The whole message must be sign-offs ("ok thanks!"); "ok so about tomorrow..." is not one.
+_SIGN_OFF_PATTERN = re.compile(r"^\s*(?:(?:ok(?:ay)?|k|thanks|thank you|thx|ty|bye|cya|see you|sure|cool|got it)\b\W*)+$", re.IGNORECASE)
+
+
+class AdaptiveBurstWindow:
+    def __init__(self, min_delay: float = 1.0, max_delay: float = 5.0, default_delay: float = 3.0,
+                 slack: float = 3.0, smoothing: float = 0.3, min_samples: int = 2):
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.default_delay = self._clamp(default_delay)
+        self.slack = slack # Wait this many average gaps before assuming the sender is done
+        self.smoothing = smoothing # EWMA weight of the newest gap
+        self.min_samples = min_samples
+        self._stats_lock = threading.Lock()
+        self._recent_delays: deque = deque(maxlen=1000)
+        self._reasons: Counter = Counter()
+
+    def _clamp(self, delay: float) -> float:
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def observe(self, timing: Optional[dict], now: Optional[float] = None) -> dict:
+        """Returns the sender's timing updated with a message arriving at `now` (wall clock)."""
+        now = time.time() if now is None else now
+        timing = dict(timing or {})
+        last_message_at = timing.get("last_message_at")
+        if last_message_at is not None:
+            gap = now - last_message_at
+            # Gaps longer than the window are pauses between bursts, not typing rhythm.
+            if 0 <= gap <= self.max_delay:
+                average = timing.get("gap_ewma")
+                timing["gap_ewma"] = gap if average is None else (1 - self.smoothing) * average + self.smoothing * gap
+                timing["samples"] = timing.get("samples", 0) + 1
+        timing["last_message_at"] = now
+        return timing
+
+    def choose_delay(self, timing: Optional[dict], message: str) -> Tuple[float, str]:
+        """Returns (delay in seconds, reason) for the window that `message` (re)opens."""
+        text = (message or "").strip()
+        if _CONTINUATION_PATTERN.search(text):
+            return self.max_delay, "continuation"
+        if _TERMINAL_PATTERN.search(text) or _SIGN_OFF_PATTERN.match(text):
+            return self.min_delay, "end_of_thought"
+        timing = timing or {}
+        if timing.get("samples", 0) >= self.min_samples and timing.get("gap_ewma") is not None:
+            return self._clamp(timing["gap_ewma"] * self.slack), "learned"
+        return self.default_delay, "default"
+
+    def record(self, delay: float, reason: str) -> None:
+        """Records the delay that actually closed a burst."""
+        with self._stats_lock:
+            self._recent_delays.append(delay)
+            self._reasons[reason] += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            delays = list(self._recent_delays)
+            return {"min_delay": self.min_delay, "max_delay": self.max_delay, "default_delay": self.default_delay,
+                    "bursts": sum(self._reasons.values()), "reasons": dict(self._reasons),
+                    "delay_p50": percentile(delays, 50), "delay_p90": percentile(delays, 90),
+                    "delay_mean": (sum(delays) / len(delays)) if delays else 0.0}
+
+
+def create_burst_window() -> AdaptiveBurstWindow:
+    return AdaptiveBurstWindow(
+        min_delay=float(os.environ.get("FLOW_BURST_MIN_DELAY", "1.0")),
+        max_delay=float(os.environ.get("FLOW_BURST_MAX_DELAY", "5.0")),
+        default_delay=float(os.environ.get("FLOW_BURST_DEFAULT_DELAY", "3.0")),
+    )
@@ -0,0 +1,127 @@
+# embedding_cache.py
+# Content-addressed, on-disk cache of document embeddings.
+#
+# Profile chunks are mostly byte-identical between restarts and between small profile
+# edits, so their vectors are stored in SQLite keyed by (embedding model, sha256(chunk)).
+# Only chunks that were never embedded before cost a remote embedding call.
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from typing import Dict, List, Optional, Sequence
+
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_EMBEDDING_CACHE_PATH = os.environ.get(
+    "FLOW_EMBEDDING_CACHE_PATH", os.path.join(".flow_cache", "embeddings.sqlite3"))
+
+
+def chunk_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _pack_vector(vector: Sequence[float]) -> bytes:
+    return array("f", vector).tobytes()  # float32, native byte order
+
+
+def _unpack_vector(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """SQLite store mapping (model name, chunk digest) -> float32 vector."""
+
+    def __init__(self, path: str = DEFAULT_EMBEDDING_CACHE_PATH):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " model TEXT NOT NULL, digest TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL,"
+                " PRIMARY KEY (model, digest))")
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model: str, digests: Sequence[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        unique_digests = list(dict.fromkeys(digests))
+        with self._lock:
+            # Stay well below SQLite's host-parameter limit.
+            for start in range(0, len(unique_digests), 500):
+                batch = unique_digests[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT digest, vector FROM embeddings WHERE model = ? AND digest IN ({placeholders})",
+                    [model, *batch]).fetchall()
+                for digest, blob in rows:
+                    found[digest] = _unpack_vector(blob)
+            self.hits += len(found)
+            self.misses += len(unique_digests) - len(found)
+        return found
+
+    def put_many(self, model: str, items: Dict[str, Sequence[float]]) -> None:
+        if not items:
+            return
+        rows = [(model, digest, len(vector), _pack_vector(vector)) for digest, vector in items.items()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, digest, dim, vector) VALUES (?, ?, ?, ?)", rows)
+
+    def stats(self) -> dict:
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            lookups = self.hits + self.misses
+            return {"path": self.path, "entries": entries, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": (self.hits / lookups) if lookups else 0.0}
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings client so embed_documents only sends uncached texts upstream.
+
+    Queries are passed straight through: they are rarely repeated verbatim and some
+    providers embed queries with a different task type than documents.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, cache: EmbeddingCache):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        digests = [chunk_digest(text) for text in texts]
+        vectors = self.cache.get_many(self.model_name, digests)
+        missing: Dict[str, str] = {}
+        for digest, text in zip(digests, texts):
+            if digest not in vectors:
+                missing.setdefault(digest, text)
+        if missing:
+            new_vectors = self.underlying.embed_documents(list(missing.values()))
+            fresh = {digest: [float(x) for x in vector] for digest, vector in zip(missing.keys(), new_vectors)}
+            self.cache.put_many(self.model_name, fresh)
+            vectors.update(fresh)
+        return [vectors[digest] for digest in digests]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.underlying.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.underlying.aembed_query(text)
+
+
+_default_cache: Optional[EmbeddingCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_embedding_cache() -> EmbeddingCache:
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+        return _default_cache
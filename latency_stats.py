@@ -0,0 +1,14 @@
+# latency_stats.py
+# Percentiles for the latency figures reported by the scheduler, the burst window, the
+# evaluation harness and the benchmarks, so they all use the same definition.
+import math
+from typing import Iterable
+
+
+def percentile(samples: Iterable[float], pct: float) -> float:
+    """Nearest-rank percentile: the smallest sample with at least pct% of samples at or below it."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = math.ceil(pct / 100.0 * len(ordered))
+    return ordered[min(len(ordered), max(1, rank)) - 1]
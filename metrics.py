@@ -1,17 +1,32 @@
 # evaluate_retrieval.py
 
+import argparse
 import json
+import statistics
+import subprocess
+import threading
 import time
-from typing import List, Dict, Any, Set, Optional # Added Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Set, Optional, Tuple # Added Optional
 
 # Import the main function and FlowState from your RAG module
-from rag import run_rag_pipeline, FlowState # Make sure FlowState is accessible if needed for type hints
+from rag import run_rag_pipeline, run_retrieval_pipeline, retrieve_batch, FlowState # Make sure FlowState is accessible if needed for type hints
 
 # For splitting text to get chunks consistently
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from latency_stats import percentile
+import providers
+
 # --- Configuration for Evaluation ---
 EVAL_API_KEY = "YOUR_GEMINI_API_KEY" # <<< REPLACE WITH YOUR ACTUAL API KEY
+# Only the retrieved chunks are scored, so by default the LLM generation step is skipped.
+# Set to False to run the full RAG pipeline (retrieval + generation) for every query.
+EVAL_RETRIEVAL_ONLY = True
+# Set to True to embed all queries in one round-trip and search them in one batch
+# (rag.retrieve_batch) instead of running the retrieval pipeline once per query. Faster, but
+# only batch-level timings exist then: the report has no per-query latency distribution.
+EVAL_BATCHED_RETRIEVAL = False
 
 # LONGER AND MORE DIVERSE USER PROFILE FOR EVALUATION
 EVAL_USER_PROFILE_CONTENT = """
@@ -227,8 +242,12 @@ def calculate_hit_miss(retrieved_docs: List[str], ground_truth_docs: Set[str]) -
     return any(doc in ground_truth_docs for doc in retrieved_docs)
 
 # --- Main Evaluation Loop ---
+def eval_api_key_missing() -> bool:
+    # Offline (FLOW_PROVIDER=fake) runs accept any key, including the placeholder.
+    return EVAL_API_KEY in ("YOUR_GEMINI_API_KEY", "YOUR_GOOGLE_API_KEY_HERE") and not providers.is_offline()
+
 def run_evaluation():
-    if EVAL_API_KEY == "YOUR_GOOGLE_API_KEY_HERE":
+    if eval_api_key_missing():
         print("FATAL ERROR: Please set your actual Google API Key in EVAL_API_KEY at the top of this script.")
         return
 
@@ -249,7 +268,8 @@ def run_evaluation():
         print("WARNING: TEST_DATASET is empty. No queries to evaluate. This might be due to an unexpected number of chunks from the profile.")
         return
 
-    print(f"Starting retrieval evaluation with K={K_FOR_EVALUATION} using {len(ACTUAL_CHUNKS_FROM_PROFILE)} total profile chunks...\n")
+    mode = "retrieval only" if EVAL_RETRIEVAL_ONLY else "full RAG pipeline"
+    print(f"Starting retrieval evaluation ({mode}) with K={K_FOR_EVALUATION} using {len(ACTUAL_CHUNKS_FROM_PROFILE)} total profile chunks...\n")
 
     all_precisions_at_k: List[float] = []
     all_recalls_at_k: List[float] = []
@@ -257,6 +277,12 @@ def run_evaluation():
     hit_count = 0
     total_queries = len(TEST_DATASET)
     dummy_chat_history: List[str] = []
+    batched_docs: Optional[List[List[str]]] = None
+    if EVAL_RETRIEVAL_ONLY and EVAL_BATCHED_RETRIEVAL:
+        try:
+            batched_docs = retrieve_batch([test_case["query"] for test_case in TEST_DATASET], EVAL_USER_PROFILE_CONTENT, EVAL_API_KEY, k=K_FOR_EVALUATION)
+        except Exception as e:
+            print(f"ERROR running batched retrieval, falling back to one query at a time: {e}")
 
     for i, test_case in enumerate(TEST_DATASET):
         query = test_case["query"]
@@ -268,13 +294,22 @@ def run_evaluation():
         # if best_chunk: print(f"Best Ground Truth Chunk: \"{best_chunk[:100]}...\"")
 
         try:
-            result_state: Dict[str, Any] = run_rag_pipeline(
-                api_key=EVAL_API_KEY,
-                profile_content=EVAL_USER_PROFILE_CONTENT,
-                persona_description=EVAL_USER_PERSONA_DESCRIPTION,
-                combined_message=query,
-                chat_history_for_rag=dummy_chat_history
-            )
+            if batched_docs is not None:
+                result_state: Dict[str, Any] = {"_raw_retrieved_docs_content": batched_docs[i]}
+            elif EVAL_RETRIEVAL_ONLY:
+                result_state = run_retrieval_pipeline(
+                    api_key=EVAL_API_KEY,
+                    profile_content=EVAL_USER_PROFILE_CONTENT,
+                    combined_message=query
+                )
+            else:
+                result_state = run_rag_pipeline(
+                    api_key=EVAL_API_KEY,
+                    profile_content=EVAL_USER_PROFILE_CONTENT,
+                    persona_description=EVAL_USER_PERSONA_DESCRIPTION,
+                    combined_message=query,
+                    chat_history_for_rag=dummy_chat_history
+                )
         except Exception as e:
             print(f"ERROR running RAG pipeline for query '{query}': {e}")
             all_precisions_at_k.append(0.0)
@@ -323,8 +358,186 @@ def run_evaluation():
     print(f"Hit Rate (at least one relevant doc retrieved): {hit_rate:.4f} ({hit_count}/{total_queries})")
     print("------------------------------------------")
 
+# --- Parallel Evaluation Runner ---
+EVAL_DEFAULT_WORKERS = 4
+EVAL_RESULTS_PATH = "eval_results.json"
+
+class RateLimiter:
+    """Spaces call starts at least 1/rate seconds apart across all worker threads."""
+    def __init__(self, rate_per_second: Optional[float]):
+        self.interval = 1.0 / rate_per_second if rate_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def _evaluate_test_case(index: int, test_case: Dict[str, Any], retrieval_only: bool, limiter: RateLimiter) -> Dict[str, Any]:
+    query = test_case["query"]
+    limiter.wait()
+    start = time.perf_counter()
+    try:
+        if retrieval_only:
+            result_state: Dict[str, Any] = run_retrieval_pipeline(EVAL_API_KEY, EVAL_USER_PROFILE_CONTENT, query)
+        else:
+            result_state = run_rag_pipeline(EVAL_API_KEY, EVAL_USER_PROFILE_CONTENT, EVAL_USER_PERSONA_DESCRIPTION, query, [])
+    except Exception as e:
+        result_state = {"error_message": f"Exception: {e}"}
+    latency_ms = (time.perf_counter() - start) * 1000.0
+    retrieved_docs_content = result_state.get("_raw_retrieved_docs_content") or []
+    if result_state.get("error_message") or not isinstance(retrieved_docs_content, list):
+        retrieved_docs_content = []
+    return _score_test_case(index, test_case, retrieved_docs_content, latency_ms,
+                            result_state.get("_stage_timings") or {}, result_state.get("error_message"))
+
+def _evaluate_batched(test_cases: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Retrieval for all test cases in one batch.
+
+    Returns the per-query scores, which carry no latency (the queries were not timed one by
+    one), and the batch's own timings: total wall time and the embed/search stages.
+    """
+    stage_timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    try:
+        docs_per_query = retrieve_batch([test_case["query"] for test_case in test_cases], EVAL_USER_PROFILE_CONTENT, EVAL_API_KEY,
+                                        k=K_FOR_EVALUATION, stage_timings=stage_timings)
+        error = None
+    except Exception as e:
+        docs_per_query, error = [[] for _ in test_cases], f"Exception: {e}"
+    batch = {"queries": len(test_cases), "wall_ms": (time.perf_counter() - start) * 1000.0, "stage_timings_ms": stage_timings}
+    return [_score_test_case(i, test_case, docs, None, {}, error)
+            for i, (test_case, docs) in enumerate(zip(test_cases, docs_per_query))], batch
+
+def _score_test_case(index: int, test_case: Dict[str, Any], retrieved_docs_content: List[str], latency_ms: Optional[float],
+                     stage_timings: Dict[str, float], error: Optional[str]) -> Dict[str, Any]:
+    ground_truth_chunks = test_case.get("ground_truth_chunks", set())
+    best_chunk = test_case.get("best_chunk")
+    return {
+        "index": index,
+        "query": test_case["query"],
+        "error": error,
+        "latency_ms": latency_ms,
+        "stage_timings_ms": stage_timings,
+        "precision_at_k": calculate_precision_at_k(retrieved_docs_content, ground_truth_chunks, K_FOR_EVALUATION),
+        "recall_at_k": calculate_recall_at_k(retrieved_docs_content, ground_truth_chunks, K_FOR_EVALUATION),
+        "reciprocal_rank": calculate_mrr(retrieved_docs_content, best_chunk),
+        "hit": calculate_hit_miss(retrieved_docs_content, ground_truth_chunks),
+    }
+
+def _latency_summary(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0}
+    return {"count": len(samples), "mean_ms": statistics.fmean(samples), "p50_ms": percentile(samples, 50),
+            "p95_ms": percentile(samples, 95), "p99_ms": percentile(samples, 99), "max_ms": max(samples)}
+
+def _current_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run_parallel_evaluation(workers: int = EVAL_DEFAULT_WORKERS, rate_limit: Optional[float] = None,
+                            retrieval_only: bool = EVAL_RETRIEVAL_ONLY,
+                            output_path: Optional[str] = EVAL_RESULTS_PATH,
+                            batched: bool = EVAL_BATCHED_RETRIEVAL) -> Dict[str, Any]:
+    """Runs TEST_DATASET on a thread pool and reports quality metrics plus latency/throughput.
+
+    rate_limit caps query starts per second across all workers (None = unlimited).
+    With retrieval_only and batched, all queries go through one batched retrieval call
+    instead (workers and rate_limit do not apply); the report then has batch-level timings
+    under performance.batch and no per-query latencies.
+    The report is written as JSON to output_path so runs can be compared across commits.
+    """
+    batched = batched and retrieval_only
+    limiter = RateLimiter(rate_limit)
+    wall_start = time.perf_counter()
+    batch = None
+    if batched:
+        per_query, batch = _evaluate_batched(TEST_DATASET)
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(_evaluate_test_case, i, test_case, retrieval_only, limiter)
+                       for i, test_case in enumerate(TEST_DATASET)]
+            per_query = [future.result() for future in futures]
+    wall_seconds = time.perf_counter() - wall_start
+
+    total_queries = len(per_query)
+    stage_names = sorted({stage for result in per_query for stage in result["stage_timings_ms"]})
+    report = {
+        "commit": _current_git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {"workers": workers, "rate_limit_qps": rate_limit, "retrieval_only": retrieval_only, "batched": batched,
+                   "k": K_FOR_EVALUATION, "chunks": len(ACTUAL_CHUNKS_FROM_PROFILE)},
+        "quality": {
+            f"precision_at_{K_FOR_EVALUATION}": statistics.fmean(r["precision_at_k"] for r in per_query) if per_query else 0.0,
+            f"recall_at_{K_FOR_EVALUATION}": statistics.fmean(r["recall_at_k"] for r in per_query) if per_query else 0.0,
+            "mrr": statistics.fmean(r["reciprocal_rank"] for r in per_query) if per_query else 0.0,
+            "hit_rate": (sum(1 for r in per_query if r["hit"]) / total_queries) if total_queries else 0.0,
+            "errors": sum(1 for r in per_query if r["error"]),
+        },
+        "performance": {
+            "total_queries": total_queries,
+            "wall_time_s": wall_seconds,
+            "throughput_qps": (total_queries / wall_seconds) if wall_seconds > 0 else 0.0,
+            "latency": _latency_summary([r["latency_ms"] for r in per_query if r["latency_ms"] is not None]),
+            "stages": {stage: _latency_summary([r["stage_timings_ms"][stage] for r in per_query if stage in r["stage_timings_ms"]])
+                       for stage in stage_names},
+            "batch": batch,
+        },
+        "queries": per_query,
+    }
+
+    quality, performance = report["quality"], report["performance"]
+    print("\n--- Parallel Evaluation Summary ---")
+    if batched:
+        print(f"Queries: {total_queries} | Batched retrieval (one round-trip) | Errors: {quality['errors']}")
+        stages = " | ".join(f"{stage} {ms:.1f} ms" for stage, ms in batch["stage_timings_ms"].items())
+        print(f"Batch: {batch['wall_ms']:.1f} ms for all queries ({stages or 'no stage timings'}); no per-query latencies")
+    else:
+        print(f"Queries: {total_queries} | Workers: {workers} | Rate limit: {rate_limit or 'none'} qps | Errors: {quality['errors']}")
+    print(f"Average Precision@{K_FOR_EVALUATION}: {quality[f'precision_at_{K_FOR_EVALUATION}']:.4f}")
+    print(f"Average Recall@{K_FOR_EVALUATION}: {quality[f'recall_at_{K_FOR_EVALUATION}']:.4f}")
+    print(f"Mean Reciprocal Rank (MRR): {quality['mrr']:.4f}")
+    print(f"Hit Rate: {quality['hit_rate']:.4f}")
+    print(f"Throughput: {performance['throughput_qps']:.2f} queries/s over {wall_seconds:.2f}s")
+    for name, summary in [("total", performance["latency"])] + list(performance["stages"].items()):
+        if summary.get("count"):
+            print(f"Latency [{name}]: p50 {summary['p50_ms']:.1f} ms | p95 {summary['p95_ms']:.1f} ms | p99 {summary['p99_ms']:.1f} ms")
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output_path}")
+    print("------------------------------------------")
+    return report
+
 if __name__ == "__main__":
-    if EVAL_API_KEY == "YOUR_GOOGLE_API_KEY_HERE":
+    parser = argparse.ArgumentParser(description="Evaluate Flow's profile retrieval quality and speed.")
+    parser.add_argument("--workers", type=int, default=EVAL_DEFAULT_WORKERS, help="Concurrent queries (default: %(default)s).")
+    parser.add_argument("--rate-limit", type=float, default=None, help="Max query starts per second across workers.")
+    parser.add_argument("--output", default=EVAL_RESULTS_PATH, help="JSON report path (default: %(default)s).")
+    parser.add_argument("--full-pipeline", action="store_true", help="Also run LLM generation for every query.")
+    parser.add_argument("--batched", action="store_true", help="Retrieve all queries in one batch (batch-level timings only).")
+    parser.add_argument("--sequential", action="store_true", help="Run the original verbose one-by-one evaluation.")
+    parser.add_argument("--offline", action="store_true", help="Use the fake embedding/LLM providers (no network, no API key).")
+    args = parser.parse_args()
+    if args.offline:
+        providers.PROVIDER = "fake"
+    if args.batched:
+        EVAL_BATCHED_RETRIEVAL = True
+    if eval_api_key_missing():
         print("FATAL ERROR: Please set your actual Google API Key in EVAL_API_KEY at the top of this script before running.")
+    elif args.sequential:
+        if args.full_pipeline:
+            EVAL_RETRIEVAL_ONLY = False
+        run_evaluation()
     else:
-        run_evaluation()
\ No newline at end of file
+        run_parallel_evaluation(workers=args.workers, rate_limit=args.rate_limit,
+                                retrieval_only=not args.full_pipeline, output_path=args.output,
+                                batched=EVAL_BATCHED_RETRIEVAL)
\ No newline at end of file
@@ -0,0 +1,158 @@
+# numpy_store.py
+# In-process brute-force vector store for small profiles.
+#
+# A profile is typically 5-20 chunks. For that size a single matrix-vector product over a
+# contiguous float32 matrix beats Chroma's per-collection SQLite/HNSW machinery, and it has
+# no import/startup cost beyond NumPy. Rows are L2-normalised on insert, so the dot
+# product is the cosine similarity.
+import threading
+import uuid
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores along the last axis, best first."""
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(np.arange(n), scores.shape[:-1] + (n,))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=-1)
+    order = np.argsort(-candidate_scores, axis=-1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
+class NumpyVectorStore(VectorStore):
+    """Exact cosine-similarity search over a contiguous float32 matrix."""
+
+    def __init__(self, embedding: Embeddings):
+        self._embedding_function = embedding
+        self._lock = threading.Lock()
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._ids: List[str] = []
+        self._texts: List[str] = []
+        self._metadatas: List[dict] = []
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids is not None else [uuid.uuid4().hex for _ in texts]
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        vectors = np.asarray(self._embedding_function.embed_documents(texts), dtype=np.float32)
+        self.add_vectors(vectors, texts, ids, metadatas)
+        return ids
+
+    def add_vectors(self, vectors: np.ndarray, texts: Sequence[str], ids: Sequence[str],
+                    metadatas: Optional[Sequence[dict]] = None) -> None:
+        rows = _normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1))
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        with self._lock:
+            # Re-adding an existing ID replaces it, matching Chroma's upsert semantics.
+            self._delete_locked(set(ids))
+            matrix = rows if self._matrix.size == 0 else np.vstack([self._matrix, rows])
+            self._matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+            self._ids.extend(ids)
+            self._texts.extend(texts)
+            self._metadatas.extend(metadatas)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        with self._lock:
+            return self._delete_locked(set(ids))
+
+    def _delete_locked(self, ids_to_delete: set) -> bool:
+        keep = [i for i, chunk_id in enumerate(self._ids) if chunk_id not in ids_to_delete]
+        if len(keep) == len(self._ids):
+            return False
+        self._matrix = np.ascontiguousarray(self._matrix[keep]) if keep else np.empty((0, 0), dtype=np.float32)
+        self._ids = [self._ids[i] for i in keep]
+        self._texts = [self._texts[i] for i in keep]
+        self._metadatas = [self._metadatas[i] for i in keep]
+        return True
+
+    def copy(self, ids: Sequence[str], embedding: Optional[Embeddings] = None) -> "NumpyVectorStore":
+        """A new store holding the rows of `ids` (vectors copied, not re-embedded); this one is unchanged."""
+        store = NumpyVectorStore(embedding or self._embedding_function)
+        with self._lock:
+            position = {chunk_id: i for i, chunk_id in enumerate(self._ids)}
+            rows = [position[chunk_id] for chunk_id in ids if chunk_id in position]
+            if rows:
+                store._matrix = np.ascontiguousarray(self._matrix[rows])
+                store._ids = [self._ids[i] for i in rows]
+                store._texts = [self._texts[i] for i in rows]
+                store._metadatas = [dict(self._metadatas[i]) for i in rows]
+        return store
+
+    def delete_collection(self) -> None:
+        with self._lock:
+            self._matrix = np.empty((0, 0), dtype=np.float32)
+            self._ids, self._texts, self._metadatas = [], [], []
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(query))
+        if norm:
+            query = query / norm
+        with self._lock:
+            if not self._ids:
+                return []
+            scores = self._matrix @ query
+            best = top_k_indices(scores, k)
+            return [(Document(id=self._ids[i], page_content=self._texts[i], metadata=self._metadatas[i]), float(scores[i]))
+                    for i in best]
+
+    def search_batch(self, query_vectors: Sequence[Sequence[float]], k: int = 4) -> List[List[Document]]:
+        """Top-k documents for many queries with one (m x d) @ (d x n) product."""
+        if len(query_vectors) == 0:
+            return []
+        queries = _normalize_rows(np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), -1))
+        with self._lock:
+            if not self._ids:
+                return [[] for _ in range(len(queries))]
+            scores = queries @ self._matrix.T
+            best = top_k_indices(scores, k)
+            return [[Document(id=self._ids[i], page_content=self._texts[i], metadata=self._metadatas[i]) for i in row]
+                    for row in best]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding_function.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return lambda score: (score + 1.0) / 2.0  # cosine in [-1, 1] -> [0, 1]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
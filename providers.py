@@ -0,0 +1,150 @@
+# providers.py
+# Model provider layer: builds the embedding and chat clients used by rag.py.
+#
+# FLOW_PROVIDER=google (default) uses Gemini. FLOW_PROVIDER=fake swaps in deterministic,
+# network-free stand-ins so the whole pipeline (Flask app, RAG graph, evaluation harness)
+# runs offline and our own overhead can be benchmarked separately from provider latency.
+import asyncio
+import hashlib
+import math
+import os
+import re
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+
+PROVIDER = os.environ.get("FLOW_PROVIDER", "google").lower()
+
+GOOGLE_EMBEDDING_MODEL = "models/embedding-001"
+GOOGLE_CHAT_MODEL = "gemini-1.5-flash-latest"
+
+FAKE_EMBEDDING_MODEL = "fake/hashed-bow-768"
+FAKE_EMBEDDING_DIM = 768
+# Artificial latency for the fake clients, to mimic (or rule out) network round-trips.
+FAKE_EMBEDDING_LATENCY_SECONDS = float(os.environ.get("FLOW_FAKE_EMBEDDING_LATENCY", "0"))
+FAKE_LLM_LATENCY_SECONDS = float(os.environ.get("FLOW_FAKE_LLM_LATENCY", "0"))
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def is_offline() -> bool:
+    return PROVIDER == "fake"
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic hashed bag-of-words embeddings.
+
+    Each lower-cased token is hashed into one of `dim` buckets with a +/-1 sign, and the
+    result is L2-normalised. Texts sharing words get similar vectors, so retrieval results
+    are stable and still loosely meaningful without any model.
+    """
+
+    def __init__(self, dim: int = FAKE_EMBEDDING_DIM, latency_seconds: float = FAKE_EMBEDDING_LATENCY_SECONDS):
+        self.dim = dim
+        self.latency_seconds = latency_seconds
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for token in _TOKEN_PATTERN.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector))
+        return [x / norm for x in vector] if norm else vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)  # one simulated round-trip per batch
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return self._embed(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        return self._embed(text)
+
+
+class EchoChatModel(BaseChatModel):
+    """Offline chat model: answers with a fixed template around the last human message."""
+
+    reply_template: str = "Thanks for the message! (offline reply to: {message})"
+    latency_seconds: float = FAKE_LLM_LATENCY_SECONDS
+    max_echo_chars: int = 120
+
+    @property
+    def _llm_type(self) -> str:
+        return "flow-echo"
+
+    def _reply_for(self, messages: List[BaseMessage]) -> str:
+        human_messages = [message for message in messages if isinstance(message, HumanMessage)]
+        source = human_messages[-1] if human_messages else (messages[-1] if messages else None)
+        last_text = str(source.content) if source is not None else ""
+        last_text = " ".join(last_text.split())[:self.max_echo_chars]
+        return self.reply_template.format(message=last_text)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply_for(messages)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        # Word-sized chunks, with the artificial latency spread across them.
+        words = self._reply_for(messages).split(" ")
+        for i, word in enumerate(words):
+            if self.latency_seconds:
+                time.sleep(self.latency_seconds / len(words))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    # Native async variants, so the simulated latency does not occupy a thread under asgi.py.
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply_for(messages)))])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        words = self._reply_for(messages).split(" ")
+        for i, word in enumerate(words):
+            if self.latency_seconds:
+                await asyncio.sleep(self.latency_seconds / len(words))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+def chat_model_name() -> str:
+    return "fake/echo" if is_offline() else GOOGLE_CHAT_MODEL
+
+
+def embedding_model_name() -> str:
+    # Part of the embedding-cache and store-cache keys, so fake and real vectors never mix.
+    return FAKE_EMBEDDING_MODEL if is_offline() else GOOGLE_EMBEDDING_MODEL
+
+
+def create_embeddings(api_key: str) -> Embeddings:
+    if is_offline():
+        return HashEmbeddings()
+    return GoogleGenerativeAIEmbeddings(model=GOOGLE_EMBEDDING_MODEL, google_api_key=api_key)
+
+
+def create_chat_model(api_key: str, temperature: float = 0.7) -> BaseChatModel:
+    if is_offline():
+        return EchoChatModel()
+    return ChatGoogleGenerativeAI(model=GOOGLE_CHAT_MODEL, google_api_key=api_key, temperature=temperature)
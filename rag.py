@@ -1,15 +1,32 @@
+import asyncio
 import os
-from typing import TypedDict, List, Optional, cast
+import hashlib
+import re
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter, OrderedDict
+from typing import TypedDict, AsyncIterator, Dict, Iterator, List, Optional, Tuple, cast
 
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableConfig
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langgraph.graph import StateGraph, END
 import nltk
 
+from embedding_cache import CachedEmbeddings, chunk_digest, get_default_embedding_cache
+from numpy_store import NumpyVectorStore
+from reply_cache import ReplyCache
+import providers
+
 # --- FlowState and Global Variables (no change from your last correct version) ---
 class FlowState(TypedDict):
     user_api_key: str
@@ -21,104 +38,403 @@ class FlowState(TypedDict):
     generated_response: str
     error_message: Optional[str]
     _raw_retrieved_docs_content: Optional[List[str]]
+    _stage_timings: Optional[Dict[str, float]] # Wall time per pipeline stage, in milliseconds
+    burst_parts: Optional[List[str]] # Reply already split into message bubbles (single-call burst mode)
+    history_summary: Optional[str] # Rolling summary of turns older than the verbatim history window
+    _query_vector: Optional[List[float]] # Query embedding, if already computed by the reply-cache lookup
+
+# Chat/embedding clients and compiled graphs live in model_registry (per API key); vector
+# stores live in vector_store_cache (per profile). There is no mutable per-request global.
+
+
+# --- Per-profile vector store cache ---
+# Several sessions with different profiles can be active at once. Instead of a single
+# store that is thrown away (and fully re-embedded) whenever another profile comes in,
+# we keep a small LRU of stores keyed by a stable digest of profile text + embedding model.
+VECTOR_STORE_CACHE_MAX_ENTRIES = int(os.environ.get("FLOW_VECTOR_STORE_CACHE_SIZE", "8"))
+# Fraction of the new chunk set that must already be indexed in a cached store before
+# the new store is built from that store's vectors rather than embedded from scratch.
+REINDEX_MIN_CHUNK_OVERLAP = 0.5
+# Retriever backend: "numpy" (in-process brute force), "chroma", or "auto", which uses
+# NumPy up to NUMPY_BACKEND_MAX_CHUNKS chunks and Chroma above that.
+RETRIEVER_BACKEND = os.environ.get("FLOW_RETRIEVER_BACKEND", "auto").lower()
+NUMPY_BACKEND_MAX_CHUNKS = int(os.environ.get("FLOW_NUMPY_BACKEND_MAX_CHUNKS", "5000"))
+
+def select_retriever_backend(num_chunks: int) -> str:
+    if RETRIEVER_BACKEND in ("numpy", "chroma"):
+        return RETRIEVER_BACKEND
+    return "numpy" if num_chunks <= NUMPY_BACKEND_MAX_CHUNKS else "chroma"
+
+def profile_digest(user_profile_content: str, embedding_model_name: Optional[str] = None) -> str:
+    # Unlike hash(), this is stable across processes (no PYTHONHASHSEED randomisation).
+    if embedding_model_name is None:
+        embedding_model_name = providers.embedding_model_name()
+    hasher = hashlib.sha256()
+    hasher.update(embedding_model_name.encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(user_profile_content.encode("utf-8"))
+    return hasher.hexdigest()
+
+class VectorStoreCache:
+    """Bounded LRU cache of vector stores, one per (profile, embedding model) digest."""
+
+    def __init__(self, max_entries: int = VECTOR_STORE_CACHE_MAX_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self._stores: "OrderedDict[str, VectorStore]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reindexes = 0
+        self.chunks_added = 0
+        self.chunks_removed = 0
+        self.chunks_kept = 0
+        # Striped locks so concurrent misses for the same profile build its store only once.
+        self._build_locks = [threading.Lock() for _ in range(16)]
+
+    def build_lock(self, key: str) -> threading.Lock:
+        return self._build_locks[int(key[:8], 16) % len(self._build_locks)]
+
+    def peek(self, key: str) -> Optional[VectorStore]:
+        with self._lock:
+            return self._stores.get(key)
+
+    def get(self, key: str) -> Optional[VectorStore]:
+        with self._lock:
+            store = self._stores.get(key)
+            if store is None:
+                self.misses += 1
+                return None
+            self._stores.move_to_end(key)
+            self.hits += 1
+            return store
+
+    def put(self, key: str, store: VectorStore) -> None:
+        # Evicted stores are only dereferenced: a request that fetched one just before keeps
+        # searching it, and it is freed (see _drop_collection_when_unused) once that is done.
+        with self._lock:
+            self._stores.pop(key, None)
+            self._stores[key] = store
+            while len(self._stores) > self.max_entries:
+                self._stores.popitem(last=False)
+                self.evictions += 1
+
+    def closest(self, chunk_ids: List[str], min_overlap: float, store_type: type) -> Optional[VectorStore]:
+        """Returns the cached store sharing the most chunk IDs with `chunk_ids`.
+
+        Used to build an edited profile's store from a similar one instead of embedding it
+        from scratch. The store stays cached: it is copied from, never changed.
+        """
+        wanted = set(chunk_ids)
+        if not wanted:
+            return None
+        with self._lock:
+            best_key, best_overlap = None, 0
+            for key, store in self._stores.items():
+                if not isinstance(store, store_type):
+                    continue
+                overlap = len(wanted & set(getattr(store, '_chunk_ids', ())))
+                if overlap > best_overlap:
+                    best_key, best_overlap = key, overlap
+            if best_key is None or best_overlap < min_overlap * len(wanted):
+                return None
+            return self._stores[best_key]
+
+    def record_reindex(self, added: int, removed: int, kept: int) -> None:
+        with self._lock:
+            self.reindexes += 1
+            self.chunks_added += added
+            self.chunks_removed += removed
+            self.chunks_kept += kept
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._stores.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stores.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._stores), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                    "reindexes": self.reindexes, "chunks_added": self.chunks_added,
+                    "chunks_removed": self.chunks_removed, "chunks_kept": self.chunks_kept}
+
+def _drop_collection_when_unused(store: Chroma) -> None:
+    # Every Chroma store lives in its own collection of the shared in-process client, which
+    # keeps the collection alive after the store object is gone. Drop it when the store is
+    # garbage-collected, i.e. once neither the cache nor any in-flight request holds it.
+    weakref.finalize(store, _delete_collection, store._client, store._collection.name)
+
+def _delete_collection(client, collection_name: str) -> None:
+    try:
+        client.delete_collection(collection_name)
+    except Exception as e:
+        print(f"RAG_MODULE (vector store cache): Failed to drop unused collection {collection_name}: {e}")
+
+vector_store_cache = VectorStoreCache()
+
+def get_vector_store_cache_stats() -> dict:
+    return vector_store_cache.stats()
 
-vector_store: Optional[Chroma] = None
-llm: Optional[ChatGoogleGenerativeAI] = None
-embeddings_model: Optional[GoogleGenerativeAIEmbeddings] = None
-app_graph: Optional[StateGraph] = None
-_global_current_api_key: Optional[str] = None # Module-level global
-_global_current_profile_hash: Optional[int] = None # Module-level global
 
+PROFILE_TEXT_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50, length_function=len, is_separator_regex=False)
 
-# --- get_vector_store (no change from your last correct version) ---
-def get_vector_store(user_profile_content: str, api_key: str, force_recreate: bool = False) -> Optional[Chroma]:
-    global vector_store, embeddings_model # These are modified directly
-    # ... (rest of the function as it was)
-    # print(f"RAG_MODULE_DEBUG (get_vector_store): Called. API Key: {api_key[:5]}..., force_recreate={force_recreate}")
+def get_vector_store(user_profile_content: str, api_key: str, force_recreate: bool = False) -> Optional[VectorStore]:
     if not api_key:
         raise ValueError("Google API Key is required for get_vector_store.")
-    current_embeddings_api_key_attr = getattr(embeddings_model, 'google_api_key', None) if embeddings_model else None
-    if embeddings_model is None or force_recreate or (current_embeddings_api_key_attr != api_key):
-        try:
-            embeddings_model = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=api_key)
-            setattr(embeddings_model, 'google_api_key', api_key)
-        except Exception as e:
-            embeddings_model = None
-            raise ValueError(f"Failed to initialize embeddings. Error: {e}")
-    current_profile_hash = hash(user_profile_content)
-    if force_recreate or vector_store is None or \
-       getattr(vector_store, '_profile_hash', None) != current_profile_hash or \
-       getattr(vector_store, '_embedding_api_key', None) != api_key:
-        if not user_profile_content.strip():
-            vector_store = None
-            return None
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50, length_function=len, is_separator_regex=False)
-        profile_chunks = text_splitter.split_text(user_profile_content)
+    if not user_profile_content.strip():
+        return None
+    # Chunk vectors go through the on-disk cache, so only never-seen chunks are sent upstream.
+    document_embeddings = model_registry.get(api_key).document_embeddings
+    current_profile_hash = profile_digest(user_profile_content)
+    if force_recreate:
+        vector_store_cache.discard(current_profile_hash)
+    cached_store = vector_store_cache.get(current_profile_hash)
+    if cached_store is not None:
+        # Stored vectors only depend on the embedding model, not on the key, so a store built
+        # under another key is shared as is: queries are embedded with the caller's own client
+        # (ModelClients.document_embeddings), never through the store.
+        return cached_store
+    with vector_store_cache.build_lock(current_profile_hash):
+        # Another thread may have built this profile's store while we waited for the lock.
+        built_meanwhile = vector_store_cache.peek(current_profile_hash)
+        if built_meanwhile is not None:
+            return built_meanwhile
+        profile_chunks = PROFILE_TEXT_SPLITTER.split_text(user_profile_content)
         if not profile_chunks:
-            vector_store = None
             return None
-        documents = [Document(page_content=chunk) for chunk in profile_chunks]
-        if embeddings_model is None:
-            raise ValueError("Embeddings model somehow became None before Chroma.from_documents call.")
-        try:
-            new_vector_store = Chroma.from_documents(documents=documents, embedding=embeddings_model)
-            vector_store = new_vector_store
-            setattr(vector_store, '_profile_hash', current_profile_hash)
-            setattr(vector_store, '_embedding_api_key', api_key)
-        except Exception as e:
-            vector_store = None
-            raise
-    return vector_store
+        chunks_by_id = dict(zip(profile_chunk_ids(profile_chunks), profile_chunks))
+        store_type = NumpyVectorStore if select_retriever_backend(len(chunks_by_id)) == "numpy" else Chroma
+        # An edited profile usually shares most chunks with a store we already have: copy the
+        # shared chunks' vectors from it and only embed the changed chunks.
+        similar_store = vector_store_cache.closest(list(chunks_by_id), REINDEX_MIN_CHUNK_OVERLAP, store_type)
+        if similar_store is not None:
+            try:
+                new_vector_store = reindex_vector_store(similar_store, chunks_by_id, document_embeddings)
+            except Exception as e:
+                print(f"RAG_MODULE (get_vector_store): Incremental re-index failed, rebuilding: {e}")
+                new_vector_store = None
+        else:
+            new_vector_store = None
+        if new_vector_store is None and store_type is NumpyVectorStore:
+            new_vector_store = NumpyVectorStore.from_texts(list(chunks_by_id.values()), document_embeddings, ids=list(chunks_by_id))
+            setattr(new_vector_store, '_chunk_ids', set(chunks_by_id))
+        elif new_vector_store is None:
+            documents = [Document(page_content=chunk) for chunk in chunks_by_id.values()]
+            # A dedicated collection per store; the default "langchain" collection is shared by
+            # every Chroma instance in the process and would mix chunks from different profiles.
+            new_vector_store = Chroma.from_documents(documents=documents, embedding=document_embeddings,
+                                                     ids=list(chunks_by_id), collection_name=f"profile-{uuid.uuid4().hex}")
+            setattr(new_vector_store, '_chunk_ids', set(chunks_by_id))
+            _drop_collection_when_unused(new_vector_store)
+        setattr(new_vector_store, '_profile_hash', current_profile_hash)
+        vector_store_cache.put(current_profile_hash, new_vector_store)
+        return new_vector_store
 
-# --- initialize_models_node (no significant change from your last correct version) ---
-def initialize_models_node(state: FlowState) -> FlowState:
-    # This function correctly uses and updates module-level globals:
-    # llm, app_graph, embeddings_model, vector_store,
-    # _global_current_api_key, _global_current_profile_hash
-    global llm, app_graph, embeddings_model, vector_store 
-    global _global_current_api_key, _global_current_profile_hash
+def profile_chunk_ids(profile_chunks: List[str]) -> List[str]:
+    # Content-derived IDs, so the same chunk keeps its ID across profile edits.
+    # Repeated identical chunks get an occurrence suffix to keep IDs unique.
+    seen: Counter = Counter()
+    chunk_ids = []
+    for chunk in profile_chunks:
+        digest = chunk_digest(chunk)
+        chunk_ids.append(f"{digest}-{seen[digest]}")
+        seen[digest] += 1
+    return chunk_ids
+
+def reindex_vector_store(similar_store: VectorStore, chunks_by_id: Dict[str, str], document_embeddings: CachedEmbeddings) -> VectorStore:
+    """Builds a new store for chunks_by_id from the vectors of a similar profile's store.
+
+    similar_store is left as is: it stays cached for its own profile and other requests
+    may be searching it.
+    """
+    indexed_ids = set(getattr(similar_store, '_chunk_ids', ()))
+    ids_to_keep = [chunk_id for chunk_id in chunks_by_id if chunk_id in indexed_ids]
+    ids_to_add = [chunk_id for chunk_id in chunks_by_id if chunk_id not in indexed_ids]
+    if isinstance(similar_store, NumpyVectorStore):
+        store = similar_store.copy(ids_to_keep, document_embeddings)
+    else:
+        store = _copy_chroma_store(similar_store, ids_to_keep, document_embeddings)
+    if ids_to_add:
+        store.add_texts(texts=[chunks_by_id[chunk_id] for chunk_id in ids_to_add], ids=ids_to_add)
+    setattr(store, '_chunk_ids', set(chunks_by_id))
+    stats = {"added": len(ids_to_add), "removed": len(indexed_ids) - len(ids_to_keep), "kept": len(ids_to_keep)}
+    setattr(store, '_reindex_stats', stats)
+    vector_store_cache.record_reindex(**stats)
+    print(f"RAG_MODULE (get_vector_store): Re-indexed profile incrementally: "
+          f"{stats['added']} added, {stats['removed']} removed, {stats['kept']} kept.")
+    return store
+
+def _copy_chroma_store(store: Chroma, chunk_ids: List[str], document_embeddings: CachedEmbeddings) -> Chroma:
+    new_store = Chroma(collection_name=f"profile-{uuid.uuid4().hex}", embedding_function=document_embeddings)
+    _drop_collection_when_unused(new_store)
+    if chunk_ids:
+        kept = store._collection.get(ids=chunk_ids, include=["embeddings", "documents"])
+        new_store._collection.add(ids=kept["ids"], embeddings=kept["embeddings"], documents=kept["documents"])
+    return new_store
+
+# --- Batched retrieval ---
+# One embeddings round-trip and one vectorised search for many queries against the same
+# profile (evaluation runs, or several sessions that share a profile).
+def embed_queries(embeddings: Embeddings, queries: List[str]) -> List[List[float]]:
+    underlying = getattr(embeddings, 'underlying', embeddings)
+    if isinstance(underlying, GoogleGenerativeAIEmbeddings):
+        # batchEmbedContents with the query task type, i.e. what embed_query does per text.
+        return underlying.embed_documents(queries, task_type="retrieval_query")
+    if isinstance(underlying, providers.HashEmbeddings):
+        return underlying.embed_documents(queries) # Queries and documents embed alike
+    return [embeddings.embed_query(query) for query in queries]
+
+def search_batch(store: VectorStore, query_vectors: List[List[float]], k: int) -> List[List[str]]:
+    if isinstance(store, NumpyVectorStore):
+        return [[doc.page_content for doc in docs] for docs in store.search_batch(query_vectors, k)]
+    if isinstance(store, Chroma):
+        n_results = min(k, store._collection.count())
+        if n_results == 0:
+            return [[] for _ in query_vectors]
+        result = store._collection.query(query_embeddings=query_vectors, n_results=n_results, include=["documents"])
+        return [list(docs) for docs in result["documents"]]
+    return [[doc.page_content for doc in store.similarity_search_by_vector(vector, k=k)] for vector in query_vectors]
+
+def retrieve_batch(queries: List[str], profile_content: str, api_key: str, k: int = 3,
+                   stage_timings: Optional[Dict[str, float]] = None) -> List[List[str]]:
+    """Returns the top-k profile chunks for each query, best first, in query order.
+
+    If given, stage_timings receives the wall time (ms) of the batch's "embed" and "search"
+    stages; they cover all queries together, not one query each.
+    """
+    if not queries:
+        return []
+    store = get_vector_store(profile_content, api_key)
+    if store is None:
+        return [[] for _ in queries]
+    embed_start = time.perf_counter()
+    query_vectors = embed_queries(model_registry.get(api_key).document_embeddings, queries)
+    search_start = time.perf_counter()
+    docs_per_query = search_batch(store, query_vectors, k)
+    if stage_timings is not None:
+        stage_timings.update(embed=(search_start - embed_start) * 1000.0, search=(time.perf_counter() - search_start) * 1000.0)
+    return docs_per_query
+
+def compile_graph(retrieve_fn, generate_fn):
+    workflow = StateGraph(FlowState) # Node names are relied on by the streaming pipelines
+    workflow.add_node("retrieve_context_internal", retrieve_fn)
+    workflow.add_node("generate_response_internal", generate_fn)
+    workflow.set_entry_point("retrieve_context_internal")
+    workflow.add_edge("retrieve_context_internal", "generate_response_internal")
+    workflow.add_edge("generate_response_internal", END)
+    return workflow.compile()
+
+# --- Model registry ---
+# One entry per (provider, chat model, temperature, API key), holding that key's chat and
+# embedding clients. The graphs are compiled once (see "Compiled graphs") and receive the
+# entry through config["configurable"]["clients"], so one user's key never re-creates the
+# LLM under everyone else. Entries are LRU-bounded and built at most once per key concurrently.
+MODEL_REGISTRY_MAX_ENTRIES = int(os.environ.get("FLOW_MODEL_REGISTRY_SIZE", "32"))
+DEFAULT_TEMPERATURE = 0.7
+
+class ModelClients:
+    def __init__(self, api_key: str, temperature: float = DEFAULT_TEMPERATURE):
+        self.llm: BaseChatModel = providers.create_chat_model(api_key, temperature=temperature)
+        self.embeddings: Embeddings = providers.create_embeddings(api_key)
+        # Chunk embeddings go through the on-disk cache; queries pass straight through.
+        self.document_embeddings = CachedEmbeddings(self.embeddings, providers.embedding_model_name(), get_default_embedding_cache())
+
+    def config(self) -> RunnableConfig:
+        return {"configurable": {"clients": self}}
 
+class ModelRegistry:
+    def __init__(self, max_entries: int = MODEL_REGISTRY_MAX_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, ModelClients]" = OrderedDict()
+        self._build_locks = [threading.Lock() for _ in range(16)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(api_key: str, temperature: float = DEFAULT_TEMPERATURE) -> str:
+        # Hashed, so raw API keys are not kept as dict keys or shown in stats.
+        config = "\0".join([providers.PROVIDER, providers.chat_model_name(), providers.embedding_model_name(), repr(temperature), api_key])
+        return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+    def get(self, api_key: str, temperature: float = DEFAULT_TEMPERATURE) -> ModelClients:
+        """Returns the clients for api_key, creating them on first use. Raises on failure."""
+        key = self.key(api_key, temperature)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        with self._build_locks[hash(key) % len(self._build_locks)]:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry
+            entry = ModelClients(api_key, temperature)
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False) # In-flight users keep their reference
+                    self.evictions += 1
+            return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": (self.hits / lookups) if lookups else 0.0}
+
+model_registry = ModelRegistry()
+
+def clients_from_config(state: FlowState, config: Optional[RunnableConfig]) -> ModelClients:
+    clients = ((config or {}).get("configurable") or {}).get("clients")
+    return clients if clients is not None else model_registry.get(state.get("user_api_key", ""))
+
+def get_model_registry_stats() -> dict:
+    return model_registry.stats()
+
+# --- initialize_models_node ---
+# Makes sure this key's clients and this profile's vector store exist (both cached).
+def initialize_models_node(state: FlowState) -> FlowState:
     api_key = state.get("user_api_key")
     user_profile_content = state.get("user_profile_content", "")
     if not api_key: return {**state, "error_message": "Google API Key is missing."}
-    force_reinit_major_components = False
-    if llm is None or _global_current_api_key != api_key: # Compare with module-level global
-        # print(f"RAG_MODULE (initialize_models_node): LLM or API key changed...")
-        force_reinit_major_components = True
     try:
-        if force_reinit_major_components:
-            # print(f"RAG_MODULE (initialize_models_node): Initializing/Re-initializing LLM ...")
-            llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash-latest", google_api_key=api_key, temperature=0.7)
-            _global_current_api_key = api_key # Update module-level global
-        # print(f"RAG_MODULE (initialize_models_node): Calling get_vector_store...")
-        get_vector_store(user_profile_content, api_key, force_recreate=force_reinit_major_components)
-        if vector_store and hasattr(vector_store, '_profile_hash'):
-            _global_current_profile_hash = getattr(vector_store, '_profile_hash') # Update module-level global
-        elif not user_profile_content.strip():
-            _global_current_profile_hash = hash("")
-        if app_graph is None or force_reinit_major_components:
-            # print("RAG_MODULE (initialize_models_node): Compiling/Re-compiling LangGraph ...")
-            workflow = StateGraph(FlowState) # ... (rest of graph compilation)
-            workflow.add_node("retrieve_context_internal", retrieve_context_node)
-            workflow.add_node("generate_response_internal", generate_response_node)
-            workflow.set_entry_point("retrieve_context_internal")
-            workflow.add_edge("retrieve_context_internal", "generate_response_internal")
-            workflow.add_edge("generate_response_internal", END)
-            app_graph = workflow.compile()
-        # print("RAG_MODULE (initialize_models_node): Initialization complete.")
+        model_registry.get(api_key)
+        get_vector_store(user_profile_content, api_key)
         return {**state, "error_message": None}
     except Exception as e:
-        # print(f"RAG_MODULE (initialize_models_node): ERROR during initialization: {e}")
-        llm,app_graph,vector_store,embeddings_model = None,None,None,None
-        _global_current_api_key,_global_current_profile_hash = None,None
         return {**state, "error_message": f"Failed to initialize models: {str(e)}"}
 
 
 # --- retrieve_context_node, generate_response_node, run_rag_pipeline (no changes from your last correct versions) ---
-def retrieve_context_node(state: FlowState) -> FlowState:
-    # ... (as before) ...
-    global vector_store
-    if state.get("error_message"): return state
+def _retrieval_result(state: FlowState, retrieved_docs: List[Document], query_vector: List[float], embed_start: float, search_start: float) -> FlowState:
+    search_end = time.perf_counter()
+    stage_timings = {**(state.get("_stage_timings") or {}),
+                     "embed": (search_start - embed_start) * 1000.0, "search": (search_end - search_start) * 1000.0}
+    raw_docs_content = [doc.page_content for doc in retrieved_docs]
+    retrieved_context_str = "\n\n".join(raw_docs_content)
+    # print(f"RAG_MODULE_DEBUG (retrieve_context_node): Raw docs content being put into state: {raw_docs_content}")
+    if not retrieved_context_str: retrieved_context_str = "No specific relevant information found."
+    return {**state, "retrieved_context": retrieved_context_str, "_raw_retrieved_docs_content": raw_docs_content, "_stage_timings": stage_timings, "_query_vector": list(query_vector)}
+
+def retrieve_context_node(state: FlowState, config: Optional[RunnableConfig] = None) -> FlowState:
+    if state.get("error_message") or state.get("_raw_retrieved_docs_content") is not None: return state # Failed, or prefetched
     user_profile_content = state.get("user_profile_content", "")
     api_key = state.get("user_api_key", "")
     incoming_message = state.get("incoming_message", "")
@@ -128,49 +444,183 @@ def retrieve_context_node(state: FlowState) -> FlowState:
         current_vector_store = get_vector_store(user_profile_content, api_key, force_recreate=False)
         if current_vector_store is None:
             return {**state, "retrieved_context": "Vector store not available for retrieval.", "_raw_retrieved_docs_content": []}
-        retriever = current_vector_store.as_retriever(search_kwargs={"k": 3})
-        retrieved_docs: List[Document] = retriever.invoke(incoming_message)
-        raw_docs_content = [doc.page_content for doc in retrieved_docs]
-        retrieved_context_str = "\n\n".join(raw_docs_content)
-        # print(f"RAG_MODULE_DEBUG (retrieve_context_node): Raw docs content being put into state: {raw_docs_content}")
-        if not retrieved_context_str: retrieved_context_str = "No specific relevant information found."
-        return {**state, "retrieved_context": retrieved_context_str, "_raw_retrieved_docs_content": raw_docs_content}
+        # Equivalent to as_retriever(k=3).invoke(), split so embed and search are timed separately.
+        embed_start = time.perf_counter()
+        query_vector = state.get("_query_vector") or clients_from_config(state, config).document_embeddings.embed_query(incoming_message)
+        search_start = time.perf_counter()
+        retrieved_docs: List[Document] = current_vector_store.similarity_search_by_vector(query_vector, k=3)
+        return _retrieval_result(state, retrieved_docs, query_vector, embed_start, search_start)
     except Exception as e:
         return {**state, "error_message": f"Error retrieving context: {str(e)}", "_raw_retrieved_docs_content": []}
 
-def generate_response_node(state: FlowState) -> FlowState:
-    # ... (as before) ...
-    global llm
-    if state.get("error_message"): return state
-    if llm is None: return {**state, "error_message": "LLM not initialized."}
+# --- Burst formatting mode ---
+# "single_call": the generation prompt asks for separator-delimited bubbles directly and the
+# reply is split locally, i.e. one LLM round-trip per reply.
+# "two_call": generate the full thought, then ask the LLM again to split it
+# (format_response_as_burst_by_llm).
+BURST_FORMAT_MODE = os.environ.get("FLOW_BURST_FORMAT_MODE", "single_call").lower()
+BURST_SEPARATOR = "||NEXT_MESSAGE||"
+# Most recent history lines passed verbatim; older turns arrive via history_summary. Also the
+# size of the session store's verbatim history window (app.py / asgi.py).
+HISTORY_PROMPT_TURNS = int(os.environ.get("FLOW_HISTORY_WINDOW", "10"))
+
+GENERATION_SYSTEM_PROMPT = "You are 'Flow', an intelligent AI assistant ... Keep the reply concise and human-like.\n\nUSER'S PERSONA & STYLE:\n{user_persona}\n\nRELEVANT INFORMATION FROM USER'S PROFILE (use this to craft the reply):\n{retrieved_context}\n\nSUMMARY OF EARLIER CONVERSATION (if any):\n{history_summary}\n\nRECENT CHAT HISTORY (for overall context, if available):\n{chat_history}"
+BURST_GENERATION_INSTRUCTIONS = """
+
+FORMAT YOUR REPLY AS 1 TO 4 SHORT MESSAGE BUBBLES, LIKE A HUMAN TEXTING:
+- Separate bubbles with the exact separator: ||NEXT_MESSAGE||
+- Do not add any text before the first bubble or after the last one.
+- If the reply is very short (less than ~15 words), send a single bubble WITHOUT any separators.
+Example: Hey, I'm super busy with exams right now!||NEXT_MESSAGE||But I can probably do Sat morning before 11?||NEXT_MESSAGE||If that works for you, let me know!"""
+
+def _generation_prompt(system_prompt: str) -> ChatPromptTemplate:
+    return ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        ("human", "Incoming message (potentially a burst combined): {incoming_message}"),
+        ("ai", "Generated reply as the user:")])
+
+GENERATION_PROMPT = _generation_prompt(GENERATION_SYSTEM_PROMPT)
+BURST_GENERATION_PROMPT = _generation_prompt(GENERATION_SYSTEM_PROMPT + BURST_GENERATION_INSTRUCTIONS)
+
+# --- Compiled chains ---
+# Prompt templates are module constants; the prompt | llm | parser runnables are composed
+# once per (chat model instance, prompt) and reused, instead of on every call.
+CHAIN_CACHE_MAX_ENTRIES = 4 * MODEL_REGISTRY_MAX_ENTRIES # ~4 prompts per registered chat model
+_chain_cache: "OrderedDict[Tuple[int, int], tuple]" = OrderedDict()
+_chain_cache_lock = threading.Lock()
+
+def get_chain(model: BaseChatModel, prompt: ChatPromptTemplate):
+    """Returns the cached `prompt | model | StrOutputParser()` runnable."""
+    key = (id(model), id(prompt))
+    with _chain_cache_lock:
+        entry = _chain_cache.get(key)
+        # ids can be reused after garbage collection, so check identity too.
+        if entry is not None and entry[0] is model and entry[1] is prompt:
+            _chain_cache.move_to_end(key)
+            return entry[2]
+    chain = prompt | model | StrOutputParser()
+    with _chain_cache_lock:
+        _chain_cache[key] = (model, prompt, chain)
+        _chain_cache.move_to_end(key)
+        while len(_chain_cache) > CHAIN_CACHE_MAX_ENTRIES:
+            _chain_cache.popitem(last=False)
+    return chain
+
+def _generation_chain_and_inputs(state: FlowState, clients: ModelClients):
     user_persona = state.get("user_persona_description", "A helpful assistant.")
     retrieved_context = state.get("retrieved_context", "No context provided.")
     incoming_message = state.get("incoming_message", "")
     chat_history_list = state.get("chat_history", [])
-    chat_history_str = "\n".join(chat_history_list[-10:])
-    prompt_template_str = ChatPromptTemplate.from_messages([
-        ("system", "You are 'Flow', an intelligent AI assistant ... Keep the reply concise and human-like.\n\nUSER'S PERSONA & STYLE:\n{user_persona}\n\nRELEVANT INFORMATION FROM USER'S PROFILE (use this to craft the reply):\n{retrieved_context}\n\nRECENT CHAT HISTORY (for overall context, if available):\n{chat_history}"),
-        ("human", "Incoming message (potentially a burst combined): {incoming_message}"),
-        ("ai", "Generated reply as the user:")])
-    chain = prompt_template_str | llm | StrOutputParser()
+    chat_history_str = "\n".join(chat_history_list[-HISTORY_PROMPT_TURNS:])
+    prompt = BURST_GENERATION_PROMPT if BURST_FORMAT_MODE == "single_call" else GENERATION_PROMPT
+    chain = get_chain(clients.llm, prompt)
+    history_summary = state.get("history_summary") or "None."
+    return chain, {"user_persona": user_persona, "retrieved_context": retrieved_context, "history_summary": history_summary, "chat_history": chat_history_str, "incoming_message": incoming_message}
+
+def _generation_result(state: FlowState, response: str, generate_start: float) -> FlowState:
+    stage_timings = {**(state.get("_stage_timings") or {}), "generate": (time.perf_counter() - generate_start) * 1000.0}
+    if BURST_FORMAT_MODE == "single_call":
+        burst_parts = split_burst_response(response)
+        return {**state, "generated_response": " ".join(burst_parts), "burst_parts": burst_parts, "_stage_timings": stage_timings}
+    return {**state, "generated_response": response, "_stage_timings": stage_timings}
+
+def _generation_error(state: FlowState, e: Exception) -> FlowState:
+    err_str = str(e).lower()
+    if "api key" in err_str or "permission" in err_str or "quota" in err_str: return {**state, "error_message": f"LLM API Error: {str(e)}."}
+    return {**state, "error_message": f"Error generating response: {str(e)}"}
+
+def generate_response_node(state: FlowState, config: Optional[RunnableConfig] = None) -> FlowState:
+    if state.get("error_message"): return state
+    chain, chain_inputs = _generation_chain_and_inputs(state, clients_from_config(state, config))
     try:
-        response = chain.invoke({"user_persona": user_persona, "retrieved_context": retrieved_context, "chat_history": chat_history_str, "incoming_message": incoming_message})
-        return {**state, "generated_response": response}
+        generate_start = time.perf_counter()
+        response = chain.invoke(chain_inputs)
+        return _generation_result(state, response, generate_start)
     except Exception as e:
-        err_str = str(e).lower()
-        if "api key" in err_str or "permission" in err_str or "quota" in err_str: return {**state, "error_message": f"LLM API Error: {str(e)}."}
-        return {**state, "error_message": f"Error generating response: {str(e)}"}
+        return _generation_error(state, e)
+
+# --- Reply cache ---
+# Repeated or near-duplicate bursts ("are you free?", "Are you free??") for the same profile
+# and persona get the earlier reply back without retrieval or an LLM call. Exact matches are
+# keyed on the normalised message. With FLOW_REPLY_CACHE_SIMILARITY set (e.g. 0.95), an exact
+# miss falls back to the nearest cached query embedding; that embedding is then reused by
+# the retrieval node, so a semantic miss costs nothing extra. The scope includes the last
+# FLOW_REPLY_CACHE_HISTORY_TURNS history lines and the summary, so "ok" or "yes" only
+# reuses a reply given at the same point of the same conversation. The cache is per process.
+REPLY_CACHE_ENABLED = os.environ.get("FLOW_REPLY_CACHE", "1") != "0"
+REPLY_CACHE_FIELDS = ("retrieved_context", "generated_response", "burst_parts", "_raw_retrieved_docs_content")
+reply_cache = ReplyCache(
+    max_entries=int(os.environ.get("FLOW_REPLY_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.environ.get("FLOW_REPLY_CACHE_TTL", "600")),
+    similarity_threshold=float(os.environ.get("FLOW_REPLY_CACHE_SIMILARITY", "0")),
+    history_turns=int(os.environ.get("FLOW_REPLY_CACHE_HISTORY_TURNS", "2")), # Recent lines that must also match
+)
+
+def get_reply_cache_stats() -> dict:
+    return {"enabled": REPLY_CACHE_ENABLED, **reply_cache.stats()}
+
+def _reply_cache_scope(state: FlowState) -> Optional[str]:
+    return reply_cache.scope(profile_digest(state.get("user_profile_content", "")), state.get("user_persona_description", ""),
+                             state.get("chat_history") or [], state.get("history_summary") or "")
+
+def _cached_reply_state(state: FlowState, cached: Optional[dict], lookup_start: float) -> Optional[dict]:
+    if cached is None:
+        reply_cache.record_miss()
+        return None
+    return {**state, **cached, "error_message": None,
+            "_stage_timings": {"reply_cache": (time.perf_counter() - lookup_start) * 1000.0}}
+
+def lookup_cached_reply(state: FlowState) -> Tuple[Optional[dict], FlowState]:
+    """Returns (final state from the cache or None, state to run the graph with on a miss)."""
+    if not REPLY_CACHE_ENABLED: return None, state
+    lookup_start = time.perf_counter()
+    scope = _reply_cache_scope(state)
+    if scope is None: return None, state
+    cached = reply_cache.get(scope, state["incoming_message"], lookup_start)
+    if cached is None and reply_cache.semantic_enabled:
+        query_vector = state.get("_query_vector") or model_registry.get(state["user_api_key"]).document_embeddings.embed_query(state["incoming_message"])
+        state = {**state, "_query_vector": query_vector}
+        cached = reply_cache.get_similar(scope, query_vector, lookup_start)
+    return _cached_reply_state(state, cached, lookup_start), state
+
+async def alookup_cached_reply(state: FlowState) -> Tuple[Optional[dict], FlowState]:
+    if not REPLY_CACHE_ENABLED: return None, state
+    lookup_start = time.perf_counter()
+    scope = _reply_cache_scope(state)
+    if scope is None: return None, state
+    cached = reply_cache.get(scope, state["incoming_message"], lookup_start)
+    if cached is None and reply_cache.semantic_enabled:
+        query_vector = state.get("_query_vector") or await model_registry.get(state["user_api_key"]).document_embeddings.aembed_query(state["incoming_message"])
+        state = {**state, "_query_vector": query_vector}
+        cached = reply_cache.get_similar(scope, query_vector, lookup_start)
+    return _cached_reply_state(state, cached, lookup_start), state
 
-def run_rag_pipeline(api_key: str, profile_content: str, persona_description: str, combined_message: str, chat_history_for_rag: List[str]) -> dict:
-    # ... (as before) ...
-    global app_graph
+def store_cached_reply(state: FlowState, final_state: dict, pipeline_start: float) -> None:
+    if not REPLY_CACHE_ENABLED or final_state.get("error_message") or not (final_state.get("generated_response") or "").strip():
+        return
+    scope = _reply_cache_scope(state)
+    if scope is None:
+        return
+    reply_cache.put(scope, state["incoming_message"],
+                    {field: final_state.get(field) for field in REPLY_CACHE_FIELDS},
+                    cost_ms=(time.perf_counter() - pipeline_start) * 1000.0, query_vector=final_state.get("_query_vector"))
+
+def _cached_reply_events(cached_state: dict) -> List[dict]:
+    bubbles = list(cached_state.get("burst_parts") or []) or [cached_state["generated_response"]]
+    return [{"bubble": bubble} for bubble in bubbles] + [{"done": True, **cached_state}]
+
+def run_rag_pipeline(api_key: str, profile_content: str, persona_description: str, combined_message: str, chat_history_for_rag: List[str], history_summary: str = "", prefetched_retrieval: Optional[dict] = None) -> dict:
     if not api_key: return {"error_message": "API Key is required."}
-    initial_flow_state = FlowState(user_api_key=api_key, user_profile_content=profile_content, user_persona_description=persona_description, incoming_message=combined_message, chat_history=chat_history_for_rag, retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None)
+    initial_flow_state = FlowState(user_api_key=api_key, user_profile_content=profile_content, user_persona_description=persona_description, incoming_message=combined_message, chat_history=chat_history_for_rag, retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None, _stage_timings=None, burst_parts=None, history_summary=history_summary, _query_vector=None)
+    initial_flow_state = with_prefetched_retrieval(initial_flow_state, prefetched_retrieval)
+    pipeline_start = time.perf_counter()
     try:
         current_state_after_init = initialize_models_node(initial_flow_state)
         if current_state_after_init.get("error_message"): return cast(dict, current_state_after_init)
-        if app_graph is None: return {"error_message": "Critical internal error: LangGraph application not compiled."}
-        final_state = app_graph.invoke(current_state_after_init)
+        cached_state, current_state_after_init = lookup_cached_reply(current_state_after_init)
+        if cached_state is not None: return cached_state
+        final_state = app_graph.invoke(current_state_after_init, config=model_registry.get(api_key).config())
+        store_cached_reply(current_state_after_init, final_state, pipeline_start)
         # raw_content_from_final_state = final_state.get("_raw_retrieved_docs_content")
         # print(f"RAG_MODULE_DEBUG (run_rag_pipeline): final_state from graph invoke: {final_state.keys()}")
         # print(f"RAG_MODULE_DEBUG (run_rag_pipeline): _raw_retrieved_docs_content from final_state: {raw_content_from_final_state}")
@@ -179,42 +629,242 @@ def run_rag_pipeline(api_key: str, profile_content: str, persona_description: st
         return {"error_message": f"Critical RAG pipeline failure: {str(e)}", "generated_response": ""}
 
 
-# --- REVISED FUNCTION: Format response into a burst using LLM ---
-def format_response_as_burst_by_llm(api_key: str,
-                                   full_response_content: str,
-                                   persona_description: str,
-                                   original_user_query: str) -> List[str]:
-    global llm, _global_current_api_key # Added _global_current_api_key for check
+# --- Streaming pipeline ---
+# Runs the same graph, but streams the generation node's tokens (LangGraph "messages" mode)
+# and emits each bubble as soon as its ||NEXT_MESSAGE|| boundary arrives, so the first
+# bubble can be shown while the rest of the reply is still being generated.
+# Yields {"bubble": str} events, then one final {"done": True, **final_state}; failures
+# are reported as {"done": True, "error_message": str}. Requires single-call burst mode.
+class _BubbleStream:
+    """Turns graph stream events into bubble events; shared by the sync and async pipelines."""
 
-    # print(f"RAG_MODULE_FORMAT_BURST: Entered. Original full response length: {len(full_response_content)}")
-    # print(f"RAG_MODULE_FORMAT_BURST: Full response to format: '{full_response_content}'")
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.pending_text = ""
+        self.emitted = 0
+        self.first_bubble_ms: Optional[float] = None
+        self.final_state: dict = {}
 
-    if not full_response_content.strip():
-        # print("RAG_MODULE_FORMAT_BURST: Full response is empty, returning empty list.")
-        return []
+    def _bubble(self, text: str) -> dict:
+        if self.first_bubble_ms is None:
+            self.first_bubble_ms = (time.perf_counter() - self.start) * 1000.0
+        self.emitted += 1
+        return {"bubble": text}
 
-    # Check LLM initialization and API key consistency
-    if llm is None or _global_current_api_key != api_key:
-        # print(f"RAG_MODULE_FORMAT_BURST: LLM is None or API key mismatch (LLM key: {_global_current_api_key}, Expected key: {api_key}). Calling full initialization.")
-        temp_init_state = FlowState(user_api_key=api_key, user_profile_content="", 
-                                   user_persona_description=persona_description, # Pass current persona
-                                   incoming_message=original_user_query, # Pass current query
-                                   chat_history=[], retrieved_context="",
-                                   generated_response="", error_message=None, _raw_retrieved_docs_content=None)
-        init_result = initialize_models_node(temp_init_state) # This updates global llm and _global_current_api_key
-        if init_result.get("error_message") or llm is None:
-            print(f"RAG_MODULE_FORMAT_BURST: LLM re-initialization failed: {init_result.get('error_message')}. Returning original response.")
-            return [full_response_content]
-        # print("RAG_MODULE_FORMAT_BURST: LLM (re-)initialized successfully for formatting.")
-
-    # Define the prompt template with explicit placeholders
-    # DO NOT use f-strings to embed variables directly into the template strings here
-    prompt_template = ChatPromptTemplate.from_messages([
-        ("system",
-         """You are an AI assistant that reformats a single text response into a series of 1 to 4 short, natural-sounding message bubbles, like a human texting.
-The original response was generated by 'Flow' on behalf of a busy user with the following persona: '{input_persona}'.
-Flow was responding to the query: "{input_original_query}"
-The complete thought Flow wants to convey is: "{input_full_thought}"
+    def feed(self, mode: str, payload) -> List[dict]:
+        if mode == "values":
+            self.final_state = payload
+            return []
+        chunk, metadata = payload
+        if metadata.get("langgraph_node") != "generate_response_internal":
+            return []
+        self.pending_text += str(getattr(chunk, "content", "") or "")
+        events = []
+        while BURST_SEPARATOR in self.pending_text:
+            bubble, self.pending_text = self.pending_text.split(BURST_SEPARATOR, 1)
+            if bubble.strip():
+                events.append(self._bubble(bubble.strip()))
+        return events
+
+    def finish(self) -> List[dict]:
+        final_state = self.final_state
+        if final_state.get("error_message"):
+            return [{"done": True, **final_state}]
+        # Without any separator the reply goes through the usual fallback splitting.
+        if self.emitted:
+            remaining = [self.pending_text.strip()] if self.pending_text.strip() else []
+        else:
+            remaining = list(final_state.get("burst_parts") or [])
+        events = [self._bubble(bubble) for bubble in remaining]
+        stage_timings = dict(final_state.get("_stage_timings") or {})
+        if self.first_bubble_ms is not None:
+            stage_timings["first_bubble"] = self.first_bubble_ms
+        events.append({"done": True, **final_state, "_stage_timings": stage_timings})
+        return events
+
+def stream_rag_pipeline(api_key: str, profile_content: str, persona_description: str, combined_message: str, chat_history_for_rag: List[str], history_summary: str = "", prefetched_retrieval: Optional[dict] = None) -> Iterator[dict]:
+    if not api_key:
+        yield {"done": True, "error_message": "API Key is required."}
+        return
+    initial_flow_state = FlowState(user_api_key=api_key, user_profile_content=profile_content, user_persona_description=persona_description, incoming_message=combined_message, chat_history=chat_history_for_rag, retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None, _stage_timings=None, burst_parts=None, history_summary=history_summary, _query_vector=None)
+    initial_flow_state = with_prefetched_retrieval(initial_flow_state, prefetched_retrieval)
+    bubble_stream = _BubbleStream()
+    try:
+        current_state_after_init = initialize_models_node(initial_flow_state)
+        if current_state_after_init.get("error_message"):
+            yield {"done": True, **current_state_after_init}
+            return
+        cached_state, current_state_after_init = lookup_cached_reply(current_state_after_init)
+        if cached_state is not None:
+            yield from _cached_reply_events(cached_state)
+            return
+        clients = model_registry.get(api_key)
+        for mode, payload in app_graph.stream(current_state_after_init, config=clients.config(), stream_mode=["messages", "values"]):
+            yield from bubble_stream.feed(mode, payload)
+        store_cached_reply(current_state_after_init, bubble_stream.final_state, bubble_stream.start)
+        yield from bubble_stream.finish()
+    except Exception as e:
+        yield {"done": True, "error_message": f"Critical RAG pipeline failure: {str(e)}", "generated_response": ""}
+
+# --- Async pipeline ---
+# Same graph with async nodes: the query embedding, the vector search and the LLM call are
+# awaited (aembed_query / ainvoke), so a request waiting on the providers holds no thread and
+# many sessions can share one event loop (see asgi.py). Model and store initialisation stays
+# synchronous and runs in a worker thread; it is cached and only does real work on a cold
+# profile or a new API key.
+async def ainitialize_models_node(state: FlowState) -> FlowState:
+    return await asyncio.to_thread(initialize_models_node, state)
+
+async def aretrieve_context_node(state: FlowState, config: Optional[RunnableConfig] = None) -> FlowState:
+    if state.get("error_message") or state.get("_raw_retrieved_docs_content") is not None: return state # Failed, or prefetched
+    user_profile_content = state.get("user_profile_content", "")
+    api_key = state.get("user_api_key", "")
+    incoming_message = state.get("incoming_message", "")
+    if not user_profile_content.strip():
+        return {**state, "retrieved_context": "User profile is not provided.", "_raw_retrieved_docs_content": []}
+    try:
+        current_vector_store = await asyncio.to_thread(get_vector_store, user_profile_content, api_key)
+        if current_vector_store is None:
+            return {**state, "retrieved_context": "Vector store not available for retrieval.", "_raw_retrieved_docs_content": []}
+        embed_start = time.perf_counter()
+        query_vector = state.get("_query_vector") or await clients_from_config(state, config).document_embeddings.aembed_query(incoming_message)
+        search_start = time.perf_counter()
+        if isinstance(current_vector_store, NumpyVectorStore):
+            # Sub-millisecond in-process search; a thread hop would cost more than it saves.
+            retrieved_docs = current_vector_store.similarity_search_by_vector(query_vector, k=3)
+        else:
+            retrieved_docs = await current_vector_store.asimilarity_search_by_vector(query_vector, k=3)
+        return _retrieval_result(state, retrieved_docs, query_vector, embed_start, search_start)
+    except Exception as e:
+        return {**state, "error_message": f"Error retrieving context: {str(e)}", "_raw_retrieved_docs_content": []}
+
+async def agenerate_response_node(state: FlowState, config: Optional[RunnableConfig] = None) -> FlowState:
+    if state.get("error_message"): return state
+    chain, chain_inputs = _generation_chain_and_inputs(state, clients_from_config(state, config))
+    try:
+        generate_start = time.perf_counter()
+        response = await chain.ainvoke(chain_inputs)
+        return _generation_result(state, response, generate_start)
+    except Exception as e:
+        return _generation_error(state, e)
+
+# --- Compiled graphs ---
+# The topology never changes, only the clients do, so both graphs are compiled exactly once
+# at import; the per-key clients are passed in the run config.
+app_graph = compile_graph(retrieve_context_node, generate_response_node)
+async_app_graph = compile_graph(aretrieve_context_node, agenerate_response_node)
+
+async def arun_rag_pipeline(api_key: str, profile_content: str, persona_description: str, combined_message: str, chat_history_for_rag: List[str], history_summary: str = "", prefetched_retrieval: Optional[dict] = None) -> dict:
+    if not api_key: return {"error_message": "API Key is required."}
+    initial_flow_state = FlowState(user_api_key=api_key, user_profile_content=profile_content, user_persona_description=persona_description, incoming_message=combined_message, chat_history=chat_history_for_rag, retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None, _stage_timings=None, burst_parts=None, history_summary=history_summary, _query_vector=None)
+    initial_flow_state = with_prefetched_retrieval(initial_flow_state, prefetched_retrieval)
+    pipeline_start = time.perf_counter()
+    try:
+        current_state_after_init = await ainitialize_models_node(initial_flow_state)
+        if current_state_after_init.get("error_message"): return cast(dict, current_state_after_init)
+        cached_state, current_state_after_init = await alookup_cached_reply(current_state_after_init)
+        if cached_state is not None: return cached_state
+        final_state = await async_app_graph.ainvoke(current_state_after_init, config=model_registry.get(api_key).config())
+        store_cached_reply(current_state_after_init, final_state, pipeline_start)
+        return cast(dict, final_state)
+    except Exception as e:
+        return {"error_message": f"Critical RAG pipeline failure: {str(e)}", "generated_response": ""}
+
+async def astream_rag_pipeline(api_key: str, profile_content: str, persona_description: str, combined_message: str, chat_history_for_rag: List[str], history_summary: str = "", prefetched_retrieval: Optional[dict] = None) -> AsyncIterator[dict]:
+    """Async counterpart of stream_rag_pipeline, with the same events."""
+    if not api_key:
+        yield {"done": True, "error_message": "API Key is required."}
+        return
+    initial_flow_state = FlowState(user_api_key=api_key, user_profile_content=profile_content, user_persona_description=persona_description, incoming_message=combined_message, chat_history=chat_history_for_rag, retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None, _stage_timings=None, burst_parts=None, history_summary=history_summary, _query_vector=None)
+    initial_flow_state = with_prefetched_retrieval(initial_flow_state, prefetched_retrieval)
+    bubble_stream = _BubbleStream()
+    try:
+        current_state_after_init = await ainitialize_models_node(initial_flow_state)
+        if current_state_after_init.get("error_message"):
+            yield {"done": True, **current_state_after_init}
+            return
+        cached_state, current_state_after_init = await alookup_cached_reply(current_state_after_init)
+        if cached_state is not None:
+            for event in _cached_reply_events(cached_state):
+                yield event
+            return
+        clients = model_registry.get(api_key)
+        async for mode, payload in async_app_graph.astream(current_state_after_init, config=clients.config(), stream_mode=["messages", "values"]):
+            for event in bubble_stream.feed(mode, payload):
+                yield event
+        store_cached_reply(current_state_after_init, bubble_stream.final_state, bubble_stream.start)
+        for event in bubble_stream.finish():
+            yield event
+    except Exception as e:
+        yield {"done": True, "error_message": f"Critical RAG pipeline failure: {str(e)}", "generated_response": ""}
+
+# --- Retrieval-only pipeline ---
+# Same retrieval step as run_rag_pipeline, but without initialising the chat model or
+# calling generation: used by the evaluation harness, which only scores retrieved chunks.
+def run_retrieval_pipeline(api_key: str, profile_content: str, combined_message: str) -> dict:
+    if not api_key: return {"error_message": "API Key is required."}
+    initial_flow_state = FlowState(user_api_key=api_key, user_profile_content=profile_content, user_persona_description="", incoming_message=combined_message, chat_history=[], retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None, _stage_timings=None, burst_parts=None, history_summary=None, _query_vector=None)
+    try:
+        return cast(dict, retrieve_context_node(initial_flow_state, model_registry.get(api_key).config()))
+    except Exception as e:
+        return {"error_message": f"Critical retrieval pipeline failure: {str(e)}", "_raw_retrieved_docs_content": []}
+
+async def arun_retrieval_pipeline(api_key: str, profile_content: str, combined_message: str) -> dict:
+    if not api_key: return {"error_message": "API Key is required."}
+    initial_flow_state = FlowState(user_api_key=api_key, user_profile_content=profile_content, user_persona_description="", incoming_message=combined_message, chat_history=[], retrieved_context="", generated_response="", error_message=None, _raw_retrieved_docs_content=None, _stage_timings=None, burst_parts=None, history_summary=None, _query_vector=None)
+    try:
+        state_after_init = await ainitialize_models_node(initial_flow_state)
+        if state_after_init.get("error_message"): return cast(dict, state_after_init)
+        return cast(dict, await aretrieve_context_node(state_after_init, model_registry.get(api_key).config()))
+    except Exception as e:
+        return {"error_message": f"Critical retrieval pipeline failure: {str(e)}", "_raw_retrieved_docs_content": []}
+
+# Fields of a retrieval-only result that let the full pipeline skip its retrieval node, e.g.
+# when retrieval already ran speculatively while the burst window was still open.
+PREFETCHED_RETRIEVAL_FIELDS = ("retrieved_context", "_raw_retrieved_docs_content", "_query_vector")
+
+def with_prefetched_retrieval(state: FlowState, prefetched_retrieval: Optional[dict]) -> FlowState:
+    if not prefetched_retrieval or prefetched_retrieval.get("error_message") or prefetched_retrieval.get("_raw_retrieved_docs_content") is None:
+        return state
+    stage_timings = {f"prefetched_{stage}": ms for stage, ms in (prefetched_retrieval.get("_stage_timings") or {}).items()}
+    return {**state, **{field: prefetched_retrieval.get(field) for field in PREFETCHED_RETRIEVAL_FIELDS},
+            "_stage_timings": stage_timings or None}
+
+# --- Rolling history summary ---
+# Turns that fall out of the verbatim history window are folded into a short running
+# summary. Called from a background job after the reply has been delivered, never on the
+# reply path, so it costs no user-facing latency.
+HISTORY_SUMMARY_MAX_CHARS = 1200
+
+HISTORY_SUMMARY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You maintain a running summary of a chat between a 'Sender' and 'Flow' (an assistant replying on behalf of a busy user). "
+               "Update the summary with the new lines. Keep facts, plans, commitments and open questions; drop small talk. "
+               "Reply with the updated summary only, at most 120 words."),
+    ("human", "CURRENT SUMMARY:\n{previous_summary}\n\nNEW LINES:\n{new_lines}")])
+
+def summarize_history(api_key: str, previous_summary: str, new_lines: List[str]) -> str:
+    """Returns previous_summary updated with new_lines (flattened "Sender: ..."/"Flow: ..." turns)."""
+    if not new_lines:
+        return previous_summary
+    try:
+        chain = get_chain(model_registry.get(api_key).llm, HISTORY_SUMMARY_PROMPT)
+        summary = chain.invoke({"previous_summary": previous_summary or "None.", "new_lines": "\n".join(new_lines)}).strip()
+    except Exception as e:
+        print(f"RAG_MODULE_SUMMARY: Summarisation failed, keeping an extractive summary: {e}")
+        summary = " ".join(part for part in [previous_summary, *new_lines] if part)
+    if len(summary) > HISTORY_SUMMARY_MAX_CHARS:
+        summary = "..." + summary[-(HISTORY_SUMMARY_MAX_CHARS - 3):]
+    return summary
+
+# --- Burst formatter prompt (two-call mode) ---
+# The instructions and few-shot examples form a static prefix and the per-request values
+# come last, in the human message, so providers that cache repeated prompt prefixes can
+# reuse it. Gemini's explicit context caching needs a far larger minimum prompt than this
+# (~500 tokens), so an explicit cache would not pay off here.
+BURST_FORMAT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system",
+     """You are an AI assistant that reformats a single text response into a series of 1 to 4 short, natural-sounding message bubbles, like a human texting.
+You will be given the persona of the busy user that 'Flow' replied on behalf of, the query Flow was responding to, and the complete thought Flow wants to convey.
 
 Your ONLY task is to break the "complete thought" into 1-4 short message bubbles.
 - Each bubble should be concise.
@@ -236,10 +886,38 @@ Example 3 (Needs splitting):
 Complete thought: "I saw your message about the project. I'm really swamped this week with the Athena report and my conference prep, but I definitely want to sync up. Could we aim for early next week, maybe Monday or Tuesday afternoon? That would give me some breathing room."
 Your output: Saw your message about the project!||NEXT_MESSAGE||Definitely want to sync up.||NEXT_MESSAGE||I'm super swamped this week with Athena & conference prep tho. 😅||NEXT_MESSAGE||Could we aim for early next week, like Mon/Tues afternoon?
 """),
-        # No explicit "human" message needed if all info is in system prompt for this specific task
-    ])
+    ("human",
+     """Persona of the user: '{input_persona}'
+Flow was responding to the query: "{input_original_query}"
+Complete thought: "{input_full_thought}"
+Your output:"""),
+])
+
+# --- REVISED FUNCTION: Format response into a burst using LLM ---
+def format_response_as_burst_by_llm(api_key: str,
+                                   full_response_content: str,
+                                   persona_description: str,
+                                   original_user_query: str) -> List[str]:
+    # print(f"RAG_MODULE_FORMAT_BURST: Entered. Original full response length: {len(full_response_content)}")
+    # print(f"RAG_MODULE_FORMAT_BURST: Full response to format: '{full_response_content}'")
+
+    if not full_response_content.strip():
+        # print("RAG_MODULE_FORMAT_BURST: Full response is empty, returning empty list.")
+        return []
+
+    # Short or already well-formed replies are split locally; no second LLM round-trip.
+    local_parts = split_burst_locally(full_response_content)
+    if local_parts is not None:
+        return local_parts
+    _count_burst_split("llm")
 
-    chain = prompt_template | llm | StrOutputParser()
+    try:
+        clients = model_registry.get(api_key)
+    except Exception as e:
+        print(f"RAG_MODULE_FORMAT_BURST: LLM initialization failed: {e}. Returning original response.")
+        return [full_response_content]
+
+    chain = get_chain(clients.llm, BURST_FORMAT_PROMPT)
     
     try:
         # print(f"RAG_MODULE_FORMAT_BURST: Calling LLM for formatting. Full thought: '{full_response_content[:100]}...'")
@@ -254,23 +932,7 @@ Your output: Saw your message about the project!||NEXT_MESSAGE||Definitely want
         
         # print(f"RAG_MODULE_FORMAT_BURST: LLM output for formatting: '{formatted_string}'")
         
-        parts = []
-        if "||NEXT_MESSAGE||" in formatted_string:
-            parts = [msg.strip() for msg in formatted_string.split("||NEXT_MESSAGE||") if msg.strip()]
-        
-        if not parts: # Fallback logic
-            if len(full_response_content) > 60 and ('.' in full_response_content or '?' in full_response_content or '!' in full_response_content) :
-                try:
-                    try: nltk.data.find('tokenizers/punkt')
-                    except nltk.downloader.DownloadError: nltk.download('punkt', quiet=True)
-                    sentences = nltk.sent_tokenize(full_response_content)
-                    if 1 < len(sentences) <= 4:
-                        parts = [s.strip() for s in sentences if s.strip()]
-                except Exception as e_nltk:
-                    print(f"RAG_MODULE_FORMAT_BURST: NLTK fallback error: {e_nltk}.")
-            if not parts and full_response_content.strip():
-                 parts = [full_response_content.strip()]
-        return parts if parts else []
+        return split_burst_response(formatted_string, full_response_content)
 
     except Exception as e:
         print(f"RAG_MODULE_FORMAT_BURST: General error formatting response: {e}")
@@ -278,3 +940,120 @@ Your output: Saw your message about the project!||NEXT_MESSAGE||Definitely want
         if "contents is not specified" in str(e).lower():
             print("RAG_MODULE_FORMAT_BURST: DEBUG - The 'contents not specified' error occurred. Input to invoke was:", input_data_for_formatter)
         return [full_response_content] if full_response_content.strip() else []
+
+
+def split_burst_response(formatted_string: str, full_response_content: Optional[str] = None) -> List[str]:
+    """Splits separator-delimited LLM output into bubbles.
+
+    Falls back to NLTK sentence splitting of the full response (or of the output itself
+    when no separate full response exists) when the model did not use the separator.
+    """
+    if full_response_content is None:
+        full_response_content = formatted_string
+    parts = []
+    if BURST_SEPARATOR in formatted_string:
+        parts = [msg.strip() for msg in formatted_string.split(BURST_SEPARATOR) if msg.strip()]
+
+    if not parts: # Fallback logic
+        if len(full_response_content) > 60 and ('.' in full_response_content or '?' in full_response_content or '!' in full_response_content) :
+            sentences = split_sentences(full_response_content)
+            if 1 < len(sentences) <= 4:
+                parts = sentences
+        if not parts and full_response_content.strip():
+             parts = [full_response_content.strip()]
+    return parts if parts else []
+
+
+# --- Local burst splitting ---
+# Most replies are either short acknowledgements (which the formatter prompt itself says to
+# return unchanged) or a few short sentences that map one-to-one onto bubbles. Those are
+# split here; only long or run-on replies still go to the LLM formatter.
+SHORT_REPLY_MAX_WORDS = 15
+LOCAL_BUBBLE_MAX_WORDS = 25
+MAX_BUBBLES = 4
+
+_burst_split_stats = {"local_short": 0, "local_sentences": 0, "llm": 0}
+_burst_split_stats_lock = threading.Lock()
+_punkt_available: Optional[bool] = None # None = not checked yet
+_SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+def _count_burst_split(outcome: str) -> None:
+    with _burst_split_stats_lock:
+        _burst_split_stats[outcome] += 1
+
+def get_burst_split_stats() -> dict:
+    with _burst_split_stats_lock:
+        stats = dict(_burst_split_stats)
+    total = sum(stats.values())
+    stats["llm_calls_avoided"] = stats["local_short"] + stats["local_sentences"]
+    stats["llm_avoided_rate"] = (stats["llm_calls_avoided"] / total) if total else 0.0
+    return stats
+
+def _ensure_punkt() -> bool:
+    # nltk>=3.9 tokenizes with "punkt_tab"; older releases use "punkt". Downloading is
+    # attempted once; without network we fall back to a punctuation regex for good.
+    global _punkt_available
+    if _punkt_available is None:
+        for resource in ("tokenizers/punkt_tab/english/", "tokenizers/punkt"):
+            try:
+                nltk.data.find(resource)
+                _punkt_available = True
+                break
+            except LookupError:
+                continue
+        else:
+            try:
+                _punkt_available = nltk.download("punkt_tab", quiet=True) or nltk.download("punkt", quiet=True)
+            except Exception as e_download:
+                print(f"RAG_MODULE_FORMAT_BURST: Could not download NLTK punkt: {e_download}.")
+                _punkt_available = False
+    return bool(_punkt_available)
+
+def split_sentences(text: str) -> List[str]:
+    if _ensure_punkt():
+        try:
+            return [s.strip() for s in nltk.sent_tokenize(text) if s.strip()]
+        except Exception as e_nltk:
+            print(f"RAG_MODULE_FORMAT_BURST: NLTK sentence split error: {e_nltk}.")
+    return [s.strip() for s in _SENTENCE_END_PATTERN.split(text) if s.strip()]
+
+def split_burst_locally(full_response_content: str) -> Optional[List[str]]:
+    """Returns bubbles for replies that need no LLM formatting, or None if they do."""
+    text = full_response_content.strip()
+    if not text:
+        return []
+    if len(text.split()) < SHORT_REPLY_MAX_WORDS:
+        _count_burst_split("local_short")
+        return [text]
+    sentences = split_sentences(text)
+    if 1 <= len(sentences) <= MAX_BUBBLES and all(len(s.split()) <= LOCAL_BUBBLE_MAX_WORDS for s in sentences):
+        _count_burst_split("local_sentences")
+        return sentences
+    return None
+
+
+# --- Warm-up ---
+# One-off costs that would otherwise land on the first user request: NLTK punkt lookup or
+# download and tokenizer load, the embedding-cache database, and (with FLOW_WARMUP_API_KEY)
+# that key's model clients.
+def warm_up(api_key: Optional[str] = None) -> Dict[str, float]:
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    split_sentences("Warm-up sentence one. Warm-up sentence two.")
+    timings["nltk_punkt"] = (time.perf_counter() - start) * 1000.0
+    start = time.perf_counter()
+    PROFILE_TEXT_SPLITTER.split_text("Warm-up profile text.")
+    timings["text_splitter"] = (time.perf_counter() - start) * 1000.0
+    start = time.perf_counter()
+    get_default_embedding_cache()
+    timings["embedding_cache"] = (time.perf_counter() - start) * 1000.0
+    api_key = api_key or os.environ.get("FLOW_WARMUP_API_KEY")
+    if api_key:
+        start = time.perf_counter()
+        try:
+            model_registry.get(api_key)
+        except Exception as e:
+            print(f"RAG_MODULE_WARMUP: Could not create model clients: {e}")
+        timings["model_clients"] = (time.perf_counter() - start) * 1000.0
+    print("RAG_MODULE_WARMUP: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in timings.items()))
+    return timings
@@ -0,0 +1,176 @@
+# reply_cache.py
+# In-process cache of finished replies for repeated or near-duplicate incoming bursts.
+#
+# Many incoming messages are the same few phrases ("are you free?", "call me", "you there?").
+# A reply is keyed on (scope, normalised message), where the scope is the profile digest, a
+# persona digest, the last few history lines and the history summary. A short message like
+# "ok" or "yes" only makes sense in its conversation, so a burst whose conversation is not
+# part of the scope is never cached (scope() returns None). Entries expire after a TTL and
+# the cache is LRU-bounded. With a similarity threshold set, a miss on the exact key falls
+# back to the closest cached query embedding within the same scope.
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+_NON_WORD_PATTERN = re.compile(r"[^\w\s]+", re.UNICODE)
+
+
+def normalize_message(text: str) -> str:
+    """Lower-cases, drops punctuation and collapses whitespace: "You there??" -> "you there"."""
+    return " ".join(_NON_WORD_PATTERN.sub(" ", text.lower()).split())
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("scope", "value", "cost_ms", "expires_at", "vector")
+
+    def __init__(self, scope: str, value: dict, cost_ms: float, expires_at: float, vector: Optional[np.ndarray]):
+        self.scope = scope
+        self.value = value
+        self.cost_ms = cost_ms
+        self.expires_at = expires_at
+        self.vector = vector
+
+
+class ReplyCache:
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 600.0, similarity_threshold: float = 0.0,
+                 history_turns: int = 2):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold # 0 disables the semantic lookup
+        self.history_turns = max(0, history_turns)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._keys_by_scope: Dict[str, set] = {}
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.saved_ms = 0.0
+        self.bypassed = 0 # Bursts whose conversation the scope cannot capture
+
+    @property
+    def semantic_enabled(self) -> bool:
+        return self.similarity_threshold > 0
+
+    def scope(self, profile_digest: str, persona: str, history: Sequence[str], history_summary: str = "") -> Optional[str]:
+        """The cache scope of a burst, or None if it must not be cached.
+
+        With history_turns = 0 only the first burst of a conversation (no history, no
+        summary) is cacheable.
+        """
+        if not self.history_turns and (history or history_summary):
+            with self._lock:
+                self.bypassed += 1
+            return None
+        recent_history = list(history)[-self.history_turns:] if self.history_turns else []
+        return _digest("\0".join([profile_digest, _digest(persona), _digest(history_summary), *recent_history]))
+
+    def _key(self, scope: str, message: str) -> str:
+        return f"{scope}:{_digest(normalize_message(message))}"
+
+    def _remove_locked(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            scope_keys = self._keys_by_scope.get(entry.scope)
+            if scope_keys is not None:
+                scope_keys.discard(key)
+                if not scope_keys:
+                    del self._keys_by_scope[entry.scope]
+
+    def _live_locked(self, key: str, now: float) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._remove_locked(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _hit_locked(self, key: str, entry: _Entry, lookup_start: float) -> dict:
+        self._entries.move_to_end(key)
+        self.saved_ms += max(0.0, entry.cost_ms - (time.perf_counter() - lookup_start) * 1000.0)
+        return dict(entry.value)
+
+    def get(self, scope: str, message: str, lookup_start: Optional[float] = None) -> Optional[dict]:
+        """Exact lookup on the normalised message; returns a copy of the cached reply or None.
+
+        Misses are not counted here, since a semantic lookup may follow: call record_miss().
+        lookup_start (perf_counter) lets the saved-latency figure include the caller's overhead.
+        """
+        lookup_start = time.perf_counter() if lookup_start is None else lookup_start
+        key = self._key(scope, message)
+        with self._lock:
+            entry = self._live_locked(key, time.monotonic())
+            if entry is None:
+                return None
+            self.exact_hits += 1
+            return self._hit_locked(key, entry, lookup_start)
+
+    def get_similar(self, scope: str, query_vector: Sequence[float], lookup_start: Optional[float] = None) -> Optional[dict]:
+        """Returns the reply whose cached query is most similar (cosine >= threshold) in scope."""
+        if not self.semantic_enabled:
+            return None
+        lookup_start = time.perf_counter() if lookup_start is None else lookup_start
+        query = _unit(query_vector)
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_entry, best_score = None, None, self.similarity_threshold
+            for candidate_key in list(self._keys_by_scope.get(scope, ())):
+                candidate = self._live_locked(candidate_key, now)
+                if candidate is None or candidate.vector is None or candidate.vector.shape != query.shape:
+                    continue
+                score = float(candidate.vector @ query)
+                if score >= best_score:
+                    best_key, best_entry, best_score = candidate_key, candidate, score
+            if best_entry is None:
+                return None
+            self.semantic_hits += 1
+            return self._hit_locked(best_key, best_entry, lookup_start)
+
+    def record_miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    def put(self, scope: str, message: str, value: dict, cost_ms: float,
+            query_vector: Optional[Sequence[float]] = None) -> None:
+        key = self._key(scope, message)
+        vector = _unit(query_vector) if self.semantic_enabled and query_vector is not None else None
+        with self._lock:
+            self._remove_locked(key)
+            self._entries[key] = _Entry(scope, dict(value), cost_ms, time.monotonic() + self.ttl_seconds, vector)
+            self._keys_by_scope.setdefault(scope, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove_locked(oldest_key)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_scope.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "ttl_seconds": self.ttl_seconds,
+                    "similarity_threshold": self.similarity_threshold, "exact_hits": self.exact_hits,
+                    "semantic_hits": self.semantic_hits, "misses": self.misses,
+                    "hit_rate": (hits / lookups) if lookups else 0.0, "expirations": self.expirations,
+                    "evictions": self.evictions, "saved_ms": self.saved_ms, "bypassed": self.bypassed,
+                    "avg_saved_ms_per_hit": (self.saved_ms / hits) if hits else 0.0}
+
+
+def _unit(vector: Sequence[float]) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(array))
+    return array / norm if norm else array
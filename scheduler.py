@@ -0,0 +1,155 @@
+# scheduler.py
+# Central scheduler for RAG jobs.
+#
+# Replaces one threading.Timer thread per message per session with:
+#   - a single timer thread holding a heap of burst deadlines (one pending deadline per key;
+#     rescheduling a key replaces its deadline),
+#   - a bounded job queue, filled as deadlines expire,
+#   - a fixed pool of worker threads that run the jobs,
+#   - admission control: new bursts are refused while the system is saturated, so callers
+#     can answer "busy" instead of piling up threads and concurrent LLM calls.
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Tuple
+
+from latency_stats import percentile
+
+
+class BurstScheduler:
+    def __init__(self, workers: int = 4, max_queue: int = 32, max_pending: int = 1000, name: str = "rag"):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.max_pending = max(1, max_pending)
+        self._jobs: "queue.Queue[Tuple[float, Any, Callable, tuple]]" = queue.Queue(maxsize=self.max_queue)
+        self._condition = threading.Condition()
+        self._deadlines: list = []  # heap of (deadline, seq, key); stale entries skipped lazily
+        self._pending: Dict[Any, Tuple[float, int, Callable, tuple]] = {}
+        self._seq = itertools.count()
+        self._stopped = False
+        self._stats_lock = threading.Lock()
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._deferred = 0
+        self._recent_waits_ms: deque = deque(maxlen=1000)
+        self._timer_thread = threading.Thread(target=self._timer_loop, name=f"{name}-timer", daemon=True)
+        self._timer_thread.start()
+        self._worker_threads = [threading.Thread(target=self._worker_loop, name=f"{name}-worker-{i}", daemon=True)
+                                for i in range(self.workers)]
+        for thread in self._worker_threads:
+            thread.start()
+
+    # --- Public API ---
+    def schedule(self, key: Any, delay: float, fn: Callable, *args: Any) -> bool:
+        """Runs fn(*args) on a worker after `delay` seconds, replacing any pending run for key.
+
+        Returns False (and schedules nothing) when the scheduler is saturated. Replacing an
+        already pending deadline is always accepted, since it adds no load.
+        """
+        with self._condition:
+            if self._stopped:
+                return False
+            is_replacement = key in self._pending
+            if not is_replacement and (self._jobs.full() or len(self._pending) >= self.max_pending):
+                with self._stats_lock:
+                    self._rejected += 1
+                return False
+            seq = next(self._seq)
+            deadline = time.monotonic() + max(0.0, delay)
+            self._pending[key] = (deadline, seq, fn, args)
+            heapq.heappush(self._deadlines, (deadline, seq, key))
+            self._condition.notify()
+            return True
+
+    def cancel(self, key: Any) -> bool:
+        """Drops key's pending deadline. Jobs already handed to the workers still run."""
+        with self._condition:
+            return self._pending.pop(key, None) is not None
+
+    def is_pending(self, key: Any) -> bool:
+        with self._condition:
+            return key in self._pending
+
+    def stats(self) -> dict:
+        with self._condition:
+            pending = len(self._pending)
+        with self._stats_lock:
+            waits = list(self._recent_waits_ms)
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queue_depth": self._jobs.qsize(),
+                "pending_deadlines": pending,
+                "running": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "deferred": self._deferred,
+                "queue_wait_ms": {"samples": len(waits), "p50": percentile(waits, 50),
+                                  "p95": percentile(waits, 95), "max": max(waits) if waits else 0.0},
+            }
+
+    def shutdown(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._pending.clear()
+            self._condition.notify_all()
+        for _ in self._worker_threads:
+            self._jobs.put((0.0, None, None, ()))  # one stop marker per worker
+
+    # --- Threads ---
+    def _timer_loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    now = time.monotonic()
+                    # Discard heap entries that were cancelled or superseded by a reschedule.
+                    while self._deadlines:
+                        deadline, seq, key = self._deadlines[0]
+                        entry = self._pending.get(key)
+                        if entry is not None and entry[1] == seq:
+                            break
+                        heapq.heappop(self._deadlines)
+                    if self._deadlines and self._deadlines[0][0] <= now:
+                        break
+                    timeout = (self._deadlines[0][0] - now) if self._deadlines else None
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+                deadline, seq, key = heapq.heappop(self._deadlines)
+                _, _, fn, args = self._pending.pop(key)
+                try:
+                    self._jobs.put_nowait((time.monotonic(), key, fn, args))
+                except queue.Full:
+                    # Workers are saturated: retry shortly rather than blocking the timer.
+                    retry_at = time.monotonic() + 0.1
+                    self._pending[key] = (retry_at, seq, fn, args)
+                    heapq.heappush(self._deadlines, (retry_at, seq, key))
+                    with self._stats_lock:
+                        self._deferred += 1
+
+    def _worker_loop(self) -> None:
+        while True:
+            enqueued_at, key, fn, args = self._jobs.get()
+            if fn is None:
+                return
+            with self._stats_lock:
+                self._recent_waits_ms.append((time.monotonic() - enqueued_at) * 1000.0)
+                self._running += 1
+            try:
+                fn(*args)
+                failed = False
+            except Exception as e:
+                failed = True
+                print(f"SCHEDULER: Job for {key} failed: {e}")
+            with self._stats_lock:
+                self._running -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
@@ -0,0 +1,138 @@
+# session_manager.py
+# Lifecycle of per-session server state: activity tracking, idle-TTL eviction and memory
+# accounting.
+#
+# Every request touches its session. A background sweeper evicts sessions idle for longer
+# than the TTL: their rows in the session store, their per-session lock and whatever else
+# the app registered as an eviction hook (pending burst deadlines, speculative runs). A
+# session whose lock is held at sweep time, or that a registered busy check reports busy,
+# is left alone entirely (store rows included) and retried on the next sweep, so memory
+# stays flat however many session ids a long-running server has seen.
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+from session_store import SessionStore
+
+
+class SessionManager:
+    def __init__(self, store: SessionStore, idle_ttl_seconds: float = 1800.0, sweep_interval_seconds: float = 60.0):
+        self.store = store
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        # Long-polls and event streams touch often; the store only needs to hear about it
+        # a few times per TTL (a row write on SQLite).
+        self.store_touch_interval_seconds = min(60.0, idle_ttl_seconds / 10.0)
+        self._lock = threading.Lock()
+        self._session_locks: Dict[str, threading.Lock] = {}
+        self._last_seen: Dict[str, float] = {} # monotonic time of the last touch in this process
+        self._evict_hooks: List[Callable[[str], None]] = []
+        self._busy_checks: List[Callable[[str], bool]] = []
+        self._stopped = threading.Event()
+        self._sweeper = None
+        self.sweeps = 0
+        self.evicted = 0
+        self.last_sweep_ms = 0.0
+
+    def touch(self, session_id: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            previous = self._last_seen.get(session_id)
+            self._last_seen[session_id] = now
+        if previous is None or now - previous >= self.store_touch_interval_seconds:
+            self.store.touch(session_id)
+
+    def lock(self, session_id: str) -> threading.Lock:
+        with self._lock:
+            session_lock = self._session_locks.get(session_id)
+            if session_lock is None:
+                session_lock = self._session_locks[session_id] = threading.Lock()
+            return session_lock
+
+    def add_evict_hook(self, hook: Callable[[str], None]) -> None:
+        """hook(session_id) runs for every evicted session, e.g. to cancel its pending work."""
+        self._evict_hooks.append(hook)
+
+    def add_busy_check(self, check: Callable[[str], bool]) -> None:
+        """check(session_id) returning True keeps the session through this sweep, e.g. while a burst is pending."""
+        self._busy_checks.append(check)
+
+    def _is_busy(self, session_id: str) -> bool:
+        return any(check(session_id) for check in self._busy_checks)
+
+    def sweep(self) -> List[str]:
+        start = time.perf_counter()
+        # The store's activity lags by up to one touch interval; allow for it so a session is
+        # never dropped from the store early (and leaves the store and this process together).
+        store_idle_seconds = self.idle_ttl_seconds + self.store_touch_interval_seconds
+        cutoff = time.monotonic() - store_idle_seconds
+        with self._lock:
+            candidates = {session_id for session_id, seen in self._last_seen.items() if seen < cutoff}
+            # Locks of sessions never touched here (e.g. created by a background job) age out too.
+            candidates.update(session_id for session_id in self._session_locks if session_id not in self._last_seen)
+        candidates.update(self.store.idle_sessions(store_idle_seconds))
+        # Decide first, then delete: the store rows of a busy session are never touched.
+        evicted, held_locks = [], []
+        try:
+            for session_id in candidates:
+                with self._lock:
+                    if self._last_seen.get(session_id, cutoff) > cutoff:
+                        continue # Touched again since the scan
+                    session_lock = self._session_locks.get(session_id)
+                    if session_lock is not None and not session_lock.acquire(blocking=False):
+                        continue # Busy right now; next sweep
+                if session_lock is not None:
+                    held_locks.append(session_lock) # Held until the rows are gone
+                if not self._is_busy(session_id):
+                    evicted.append(session_id)
+            self.store.evict(evicted, store_idle_seconds)
+            with self._lock:
+                for session_id in evicted:
+                    self._session_locks.pop(session_id, None)
+                    self._last_seen.pop(session_id, None)
+        finally:
+            for session_lock in held_locks:
+                session_lock.release()
+        for session_id in evicted:
+            for hook in self._evict_hooks:
+                try:
+                    hook(session_id)
+                except Exception as e:
+                    print(f"SESSION_MANAGER: Evict hook failed for {session_id}: {e}")
+        with self._lock:
+            self.sweeps += 1
+            self.evicted += len(evicted)
+            self.last_sweep_ms = (time.perf_counter() - start) * 1000.0
+        if evicted:
+            print(f"SESSION_MANAGER: Evicted {len(evicted)} idle sessions in {self.last_sweep_ms:.1f} ms.")
+        return evicted
+
+    def _sweep_loop(self) -> None:
+        while not self._stopped.wait(self.sweep_interval_seconds):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"SESSION_MANAGER: Sweep failed: {e}")
+
+    def start(self) -> None:
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+
+    def stats(self) -> dict:
+        store_stats = self.store.stats()
+        with self._lock:
+            return {"sessions": store_stats.get("sessions", 0), "active_in_process": len(self._last_seen),
+                    "session_locks": len(self._session_locks), "queued_bubbles": store_stats.get("queued_bubbles", 0),
+                    "bytes": store_stats.get("bytes", 0), "idle_ttl_seconds": self.idle_ttl_seconds,
+                    "sweep_interval_seconds": self.sweep_interval_seconds, "sweeps": self.sweeps,
+                    "evicted": self.evicted, "last_sweep_ms": self.last_sweep_ms, "store": store_stats}
+
+
+def create_session_manager(store: SessionStore) -> SessionManager:
+    return SessionManager(store, idle_ttl_seconds=float(os.environ.get("FLOW_SESSION_IDLE_TTL", "1800")),
+                          sweep_interval_seconds=float(os.environ.get("FLOW_SESSION_SWEEP_INTERVAL", "60")))
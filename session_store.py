@@ -0,0 +1,454 @@
+# session_store.py
+# Server-side per-session state: chat history, the burst buffer, queued bot bubbles and
+# the RAG settings (API key, profile, persona) last sent by the browser.
+#
+# The cookie session only carries the session id. Two backends:
+#   - InMemorySessionStore: process-local dicts; a single-process deployment (default).
+#   - SQLiteSessionStore: one SQLite file shared by every worker process on the host. Every
+#     write is atomic across processes (queue pops are single DELETE ... RETURNING
+#     statements, settings merges run under BEGIN IMMEDIATE), so two workers never deliver
+#     the same bubble or lose each other's settings. The burst scheduler, session locks and
+#     reply ordering stay per process, though: see the README on multiple workers.
+#
+# FLOW_SESSION_STORE=memory|sqlite selects the backend; FLOW_SESSION_STORE_PATH sets the
+# SQLite file.
+#
+# History is bounded: only the last `max_history` entries are kept verbatim. Older entries
+# move to an overflow list that the app folds into a rolling summary off the request path
+# (take_history_overflow + the "history_summary" setting), so reading, appending and
+# storing history costs the same at turn 10 and at turn 10,000.
+#
+# Sessions are not kept forever: requests touch() their session, and the app's session
+# sweeper (session_manager.py) lists idle_sessions() and evict()s those it finds unused.
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_SESSION_STORE_PATH = os.environ.get(
+    "FLOW_SESSION_STORE_PATH", os.path.join(".flow_cache", "sessions.sqlite3"))
+# Verbatim history entries per session. The servers pass rag.HISTORY_PROMPT_TURNS
+# (FLOW_HISTORY_WINDOW), so the store keeps exactly what the prompt uses.
+DEFAULT_MAX_HISTORY = 10
+MAX_HISTORY_OVERFLOW = 200 # Oldest unsummarised entries are dropped beyond this
+
+
+class SessionStore:
+    """Interface shared by the backends. History entries are {"role": ..., "content": ...}."""
+
+    def get_history(self, session_id: str) -> List[dict]:
+        raise NotImplementedError
+
+    def append_history(self, session_id: str, entries: List[dict]) -> None:
+        """Appends entries; entries pushed out of the verbatim window go to the overflow."""
+        raise NotImplementedError
+
+    def take_history_overflow(self, session_id: str) -> List[dict]:
+        """Returns and clears the entries that left the verbatim window, oldest first."""
+        raise NotImplementedError
+
+    def append_burst_message(self, session_id: str, message: str, history: Optional[List[dict]] = None) -> List[str]:
+        """Adds a user message to the burst buffer and returns the whole buffer.
+
+        `history` (the chat history before the burst) is kept with the burst if this message
+        opens it, and ignored otherwise.
+        """
+        raise NotImplementedError
+
+    def get_burst_history(self, session_id: str) -> Optional[List[dict]]:
+        """The history kept with the current burst, or None."""
+        raise NotImplementedError
+
+    def take_burst(self, session_id: str) -> Tuple[List[str], Optional[List[dict]]]:
+        """Returns and clears the burst buffer and the history kept with it."""
+        raise NotImplementedError
+
+    def take_burst_buffer(self, session_id: str) -> List[str]:
+        """Returns and clears the burst buffer."""
+        return self.take_burst(session_id)[0]
+
+    def drop_last_burst_message(self, session_id: str, message: str) -> bool:
+        """Removes the newest buffered message if it is `message`; the rest of the buffer is kept."""
+        raise NotImplementedError
+
+    def push_bot_responses(self, session_id: str, parts: List[str]) -> None:
+        raise NotImplementedError
+
+    def pop_bot_responses(self, session_id: str, max_items: Optional[int] = None, timeout: float = 0.0) -> List[str]:
+        """Pops up to max_items queued bubbles, waiting up to `timeout` seconds for the first one."""
+        raise NotImplementedError
+
+    def get_settings(self, session_id: str) -> dict:
+        raise NotImplementedError
+
+    def update_settings(self, session_id: str, **values) -> None:
+        raise NotImplementedError
+
+    def reset(self, session_id: str) -> None:
+        """Clears history, burst buffer and queued bubbles; settings are kept."""
+        raise NotImplementedError
+
+    def touch(self, session_id: str) -> None:
+        """Marks the session as active now."""
+        raise NotImplementedError
+
+    def idle_sessions(self, idle_seconds: float) -> List[str]:
+        """Ids of the sessions not touched for idle_seconds."""
+        raise NotImplementedError
+
+    def evict(self, session_ids: List[str], idle_seconds: float) -> List[str]:
+        """Deletes all state of those session_ids still not touched for idle_seconds; returns their ids."""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Session count, stored entries, queued bubbles and the bytes of stored text."""
+        raise NotImplementedError
+
+
+def _text_bytes(texts) -> int:
+    return sum(len(text.encode("utf-8")) for text in texts)
+
+
+class _MemorySession:
+    def __init__(self, max_history: int):
+        self.history = deque(maxlen=max_history)
+        self.history_overflow = deque(maxlen=MAX_HISTORY_OVERFLOW)
+        self.burst_buffer: List[str] = []
+        self.burst_history: Optional[List[dict]] = None
+        self.pending = deque()
+        self.settings: dict = {}
+        self.condition = threading.Condition()
+        self.last_active = time.time()
+
+    def text_bytes(self) -> int:
+        return (_text_bytes(entry["content"] for entry in self.history)
+                + _text_bytes(entry["content"] for entry in self.history_overflow)
+                + _text_bytes(self.burst_buffer) + _text_bytes(self.pending) + len(json.dumps(self.settings))
+                + (len(json.dumps(self.burst_history)) if self.burst_history is not None else 0))
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(self, max_history: int = DEFAULT_MAX_HISTORY):
+        self.max_history = max(1, max_history)
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, _MemorySession] = {}
+
+    def _session(self, session_id: str) -> _MemorySession:
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is None:
+                state = self._sessions[session_id] = _MemorySession(self.max_history)
+            return state
+
+    def get_history(self, session_id: str) -> List[dict]:
+        state = self._session(session_id)
+        with state.condition:
+            return list(state.history)
+
+    def append_history(self, session_id: str, entries: List[dict]) -> None:
+        state = self._session(session_id)
+        with state.condition:
+            for entry in entries:
+                if len(state.history) == state.history.maxlen:
+                    state.history_overflow.append(state.history[0])
+                state.history.append(entry)
+
+    def take_history_overflow(self, session_id: str) -> List[dict]:
+        state = self._session(session_id)
+        with state.condition:
+            taken = list(state.history_overflow)
+            state.history_overflow.clear()
+            return taken
+
+    def append_burst_message(self, session_id: str, message: str, history: Optional[List[dict]] = None) -> List[str]:
+        state = self._session(session_id)
+        with state.condition:
+            if not state.burst_buffer and history is not None:
+                state.burst_history = list(history)
+            state.burst_buffer.append(message)
+            return list(state.burst_buffer)
+
+    def get_burst_history(self, session_id: str) -> Optional[List[dict]]:
+        state = self._session(session_id)
+        with state.condition:
+            return None if state.burst_history is None else list(state.burst_history)
+
+    def take_burst(self, session_id: str) -> Tuple[List[str], Optional[List[dict]]]:
+        state = self._session(session_id)
+        with state.condition:
+            taken = (state.burst_buffer, state.burst_history)
+            state.burst_buffer, state.burst_history = [], None
+            return taken
+
+    def drop_last_burst_message(self, session_id: str, message: str) -> bool:
+        state = self._session(session_id)
+        with state.condition:
+            if state.burst_buffer and state.burst_buffer[-1] == message:
+                state.burst_buffer.pop()
+                if not state.burst_buffer:
+                    state.burst_history = None
+                return True
+            return False
+
+    def push_bot_responses(self, session_id: str, parts: List[str]) -> None:
+        state = self._session(session_id)
+        with state.condition:
+            state.pending.extend(parts)
+            state.condition.notify_all()
+
+    def pop_bot_responses(self, session_id: str, max_items: Optional[int] = None, timeout: float = 0.0) -> List[str]:
+        state = self._session(session_id)
+        with state.condition:
+            if timeout > 0:
+                state.condition.wait_for(lambda: len(state.pending) > 0, timeout=timeout)
+            taken = []
+            while state.pending and (max_items is None or len(taken) < max_items):
+                taken.append(state.pending.popleft())
+            return taken
+
+    def get_settings(self, session_id: str) -> dict:
+        state = self._session(session_id)
+        with state.condition:
+            return dict(state.settings)
+
+    def update_settings(self, session_id: str, **values) -> None:
+        state = self._session(session_id)
+        with state.condition:
+            state.settings.update(values)
+
+    def reset(self, session_id: str) -> None:
+        state = self._session(session_id)
+        with state.condition:
+            state.history.clear()
+            state.history_overflow.clear()
+            state.burst_buffer, state.burst_history = [], None
+            state.pending.clear()
+
+    def touch(self, session_id: str) -> None:
+        self._session(session_id).last_active = time.time()
+
+    def idle_sessions(self, idle_seconds: float) -> List[str]:
+        cutoff = time.time() - idle_seconds
+        with self._lock:
+            return [session_id for session_id, state in self._sessions.items() if state.last_active < cutoff]
+
+    def evict(self, session_ids: List[str], idle_seconds: float) -> List[str]:
+        cutoff = time.time() - idle_seconds
+        evicted = []
+        with self._lock:
+            for session_id in session_ids:
+                state = self._sessions.get(session_id)
+                if state is not None and state.last_active < cutoff:
+                    del self._sessions[session_id]
+                    evicted.append(session_id)
+        return evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        text_bytes = 0
+        for state in sessions:
+            with state.condition:
+                text_bytes += state.text_bytes()
+        return {"backend": "memory", "sessions": len(sessions),
+                "history_entries": sum(len(state.history) for state in sessions),
+                "history_overflow": sum(len(state.history_overflow) for state in sessions),
+                "queued_bubbles": sum(len(state.pending) for state in sessions), "bytes": text_bytes}
+
+
+class SQLiteSessionStore(SessionStore):
+    # Bubbles pushed by another process cannot signal our Condition, so waiters re-check
+    # the table at this interval; pushes from this process still wake them immediately.
+    POLL_INTERVAL_SECONDS = 0.1
+
+    def __init__(self, path: str = DEFAULT_SESSION_STORE_PATH, max_history: int = DEFAULT_MAX_HISTORY):
+        self.path = path
+        self.max_history = max(1, max_history)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._pushed = threading.Condition()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10.0)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            for table in ("history", "history_overflow", "burst_buffer", "bot_responses"):
+                extra = " role TEXT NOT NULL," if table.startswith("history") else ""
+                self._conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    f" seq INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL,{extra} content TEXT NOT NULL)")
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_session ON {table} (session_id, seq)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS settings (session_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS burst_history (session_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS activity (session_id TEXT PRIMARY KEY, last_active REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS activity_last_active ON activity (last_active)")
+
+    def get_history(self, session_id: str) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM history WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def append_history(self, session_id: str, entries: List[dict]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO history (session_id, role, content) VALUES (?, ?, ?)",
+                                   [(session_id, entry["role"], entry["content"]) for entry in entries])
+            evicted = self._conn.execute(
+                "DELETE FROM history WHERE session_id = ? AND seq NOT IN"
+                " (SELECT seq FROM history WHERE session_id = ? ORDER BY seq DESC LIMIT ?) RETURNING seq, role, content",
+                (session_id, session_id, self.max_history)).fetchall()
+            if evicted:
+                self._conn.executemany("INSERT INTO history_overflow (session_id, role, content) VALUES (?, ?, ?)",
+                                       [(session_id, role, content) for _, role, content in sorted(evicted)])
+                self._conn.execute(
+                    "DELETE FROM history_overflow WHERE session_id = ? AND seq NOT IN"
+                    " (SELECT seq FROM history_overflow WHERE session_id = ? ORDER BY seq DESC LIMIT ?)",
+                    (session_id, session_id, MAX_HISTORY_OVERFLOW))
+
+    def take_history_overflow(self, session_id: str) -> List[dict]:
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "DELETE FROM history_overflow WHERE session_id = ? RETURNING seq, role, content", (session_id,)).fetchall()
+        return [{"role": role, "content": content} for _, role, content in sorted(rows)]
+
+    def append_burst_message(self, session_id: str, message: str, history: Optional[List[dict]] = None) -> List[str]:
+        with self._lock, self._conn:
+            if history is not None:
+                # Taking a burst deletes its history row, so the row only exists while the
+                # burst is open and the first message's snapshot wins.
+                self._conn.execute("INSERT OR IGNORE INTO burst_history (session_id, data) VALUES (?, ?)",
+                                   (session_id, json.dumps(history)))
+            self._conn.execute("INSERT INTO burst_buffer (session_id, content) VALUES (?, ?)", (session_id, message))
+            rows = self._conn.execute(
+                "SELECT content FROM burst_buffer WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        return [content for (content,) in rows]
+
+    def _delete_returning(self, table: str, session_id: str, limit: int) -> List[str]:
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                f"DELETE FROM {table} WHERE seq IN"
+                f" (SELECT seq FROM {table} WHERE session_id = ? ORDER BY seq LIMIT ?) RETURNING seq, content",
+                (session_id, limit)).fetchall()
+        return [content for _, content in sorted(rows)]
+
+    def get_burst_history(self, session_id: str) -> Optional[List[dict]]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM burst_history WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def take_burst(self, session_id: str) -> Tuple[List[str], Optional[List[dict]]]:
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "DELETE FROM burst_buffer WHERE session_id = ? RETURNING seq, content", (session_id,)).fetchall()
+            history_row = self._conn.execute(
+                "DELETE FROM burst_history WHERE session_id = ? RETURNING data", (session_id,)).fetchone()
+        return [content for _, content in sorted(rows)], (json.loads(history_row[0]) if history_row else None)
+
+    def drop_last_burst_message(self, session_id: str, message: str) -> bool:
+        with self._lock, self._conn:
+            deleted = self._conn.execute(
+                "DELETE FROM burst_buffer WHERE content = ? AND seq ="
+                " (SELECT MAX(seq) FROM burst_buffer WHERE session_id = ?)", (message, session_id)).rowcount
+            self._conn.execute(
+                "DELETE FROM burst_history WHERE session_id = ?"
+                " AND NOT EXISTS (SELECT 1 FROM burst_buffer WHERE session_id = ?)", (session_id, session_id))
+        return deleted > 0
+
+    def push_bot_responses(self, session_id: str, parts: List[str]) -> None:
+        if not parts:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO bot_responses (session_id, content) VALUES (?, ?)",
+                                   [(session_id, part) for part in parts])
+        with self._pushed:
+            self._pushed.notify_all()
+
+    def pop_bot_responses(self, session_id: str, max_items: Optional[int] = None, timeout: float = 0.0) -> List[str]:
+        limit = -1 if max_items is None else max_items
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            taken = self._delete_returning("bot_responses", session_id, limit)
+            remaining = deadline - time.monotonic()
+            if taken or remaining <= 0:
+                return taken
+            with self._pushed:
+                self._pushed.wait(min(remaining, self.POLL_INTERVAL_SECONDS))
+
+    def get_settings(self, session_id: str) -> dict:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM settings WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def update_settings(self, session_id: str, **values) -> None:
+        with self._lock, self._conn:
+            # Take the write lock before reading, so another process cannot merge into the same
+            # row in between and have its keys overwritten by ours.
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute("SELECT data FROM settings WHERE session_id = ?", (session_id,)).fetchone()
+            data = {**(json.loads(row[0]) if row else {}), **values}
+            self._conn.execute("INSERT OR REPLACE INTO settings (session_id, data) VALUES (?, ?)",
+                               (session_id, json.dumps(data)))
+
+    def reset(self, session_id: str) -> None:
+        with self._lock, self._conn:
+            for table in ("history", "history_overflow", "burst_buffer", "burst_history", "bot_responses"):
+                self._conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+
+    def touch(self, session_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO activity (session_id, last_active) VALUES (?, ?)",
+                               (session_id, time.time()))
+
+    def idle_sessions(self, idle_seconds: float) -> List[str]:
+        with self._lock:
+            return [session_id for (session_id,) in self._conn.execute(
+                "SELECT session_id FROM activity WHERE last_active < ?", (time.time() - idle_seconds,)).fetchall()]
+
+    def evict(self, session_ids: List[str], idle_seconds: float) -> List[str]:
+        # Activity is shared by all worker processes: the idle check is repeated in the DELETE,
+        # so a session touched meanwhile by another worker is kept.
+        cutoff = time.time() - idle_seconds
+        evicted = []
+        with self._lock, self._conn:
+            for start in range(0, len(session_ids), 500):
+                batch = list(session_ids[start:start + 500])
+                placeholders = ",".join("?" * len(batch))
+                batch_evicted = [session_id for (session_id,) in self._conn.execute(
+                    f"DELETE FROM activity WHERE session_id IN ({placeholders}) AND last_active < ? RETURNING session_id",
+                    (*batch, cutoff)).fetchall()]
+                if batch_evicted:
+                    placeholders = ",".join("?" * len(batch_evicted))
+                    for table in ("history", "history_overflow", "burst_buffer", "burst_history", "bot_responses", "settings"):
+                        self._conn.execute(f"DELETE FROM {table} WHERE session_id IN ({placeholders})", batch_evicted)
+                evicted.extend(batch_evicted)
+        return evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            (sessions,) = self._conn.execute(
+                "SELECT COUNT(*) FROM (SELECT session_id FROM activity UNION SELECT session_id FROM settings)").fetchone()
+            (history_entries,) = self._conn.execute("SELECT COUNT(*) FROM history").fetchone()
+            (history_overflow,) = self._conn.execute("SELECT COUNT(*) FROM history_overflow").fetchone()
+            (queued,) = self._conn.execute("SELECT COUNT(*) FROM bot_responses").fetchone()
+            text_bytes = sum(self._conn.execute(f"SELECT COALESCE(SUM(LENGTH(CAST({column} AS BLOB))), 0) FROM {table}").fetchone()[0]
+                             for table, column in (("history", "content"), ("history_overflow", "content"),
+                                                   ("burst_buffer", "content"), ("bot_responses", "content"),
+                                                   ("settings", "data"), ("burst_history", "data")))
+        return {"backend": "sqlite", "path": self.path, "sessions": sessions,
+                "history_entries": history_entries, "history_overflow": history_overflow, "queued_bubbles": queued,
+                "bytes": text_bytes}
+
+
+def create_session_store(backend: Optional[str] = None, max_history: int = DEFAULT_MAX_HISTORY) -> SessionStore:
+    backend = (backend or os.environ.get("FLOW_SESSION_STORE", "memory")).lower()
+    if backend == "sqlite":
+        return SQLiteSessionStore(max_history=max_history)
+    if backend == "memory":
+        return InMemorySessionStore(max_history=max_history)
+    raise ValueError(f"Unknown session store backend: {backend}")
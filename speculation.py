@@ -0,0 +1,117 @@
+# speculation.py
+# Speculative RAG work while a burst window is still open.
+#
+# As soon as a message arrives, the partial burst is handed to a small dedicated thread pool
+# (retrieval only, or the whole pipeline with FLOW_SPECULATE=full). Each session has at most
+# one speculation, tagged with a fingerprint of its inputs. A newer message supersedes it: a
+# run that has not started is cancelled, one already talking to the providers cannot be
+# interrupted and its result is discarded. When the window closes, the burst job takes the
+# speculation whose fingerprint matches what it is about to run, waiting for it to finish
+# if needed, and otherwise runs as usual.
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+SPECULATION_MODES = ("off", "retrieval", "full")
+
+
+def speculation_fingerprint(*inputs: Any) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class Speculator:
+    def __init__(self, mode: str = "retrieval", workers: int = 2, max_in_flight: Optional[int] = None):
+        self.mode = mode if mode in SPECULATION_MODES else "retrieval"
+        self.workers = max(1, workers)
+        # Speculation is best effort: past this many queued or running runs, new ones are skipped
+        # rather than delaying real bursts behind guesses.
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="speculation")
+        # Reentrant: cancelling a queued future runs its done callback (_done) right away, in
+        # the thread that cancels it, which already holds the lock.
+        self._lock = threading.RLock()
+        self._current: Dict[Any, Tuple[str, Future]] = {}
+        self._in_flight = 0
+        self.started = 0
+        self.skipped = 0
+        self.cancelled = 0 # Superseded before starting: no provider calls made
+        self.discarded = 0 # Superseded or unused after running: provider calls wasted
+        self.used = 0
+        self.missed = 0 # Burst closed with no matching speculation
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def _done(self, _future: Future) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def _supersede_locked(self, key: Any) -> None:
+        previous = self._current.pop(key, None)
+        if previous is not None:
+            if previous[1].cancel():
+                self.cancelled += 1
+            else:
+                self.discarded += 1
+
+    def start(self, key: Any, fingerprint: str, fn: Callable, *args: Any) -> bool:
+        """Starts fn(*args) for key, superseding key's previous speculation. Returns False if skipped."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            current = self._current.get(key)
+            if current is not None and current[0] == fingerprint:
+                return True # Same inputs already being computed
+            self._supersede_locked(key)
+            if self._in_flight >= self.max_in_flight:
+                self.skipped += 1
+                return False
+            future = self._executor.submit(fn, *args)
+            self._in_flight += 1
+            self._current[key] = (fingerprint, future)
+            self.started += 1
+        future.add_done_callback(self._done)
+        return True
+
+    def take(self, key: Any, fingerprint: str) -> Optional[Any]:
+        """Returns the result of key's speculation if it was run on exactly these inputs.
+
+        Blocks until a matching run finishes. Returns None when there is no matching run or
+        it failed; the caller then does the work itself.
+        """
+        with self._lock:
+            current = self._current.get(key)
+            if current is None or current[0] != fingerprint:
+                self._supersede_locked(key)
+                self.missed += 1
+                return None
+            del self._current[key]
+        try:
+            result = current[1].result()
+        except Exception as e:
+            print(f"SPECULATION: Speculative run for {key} failed: {e}")
+            with self._lock:
+                self.missed += 1
+            return None
+        with self._lock:
+            self.used += 1
+        return result
+
+    def discard(self, key: Any) -> None:
+        with self._lock:
+            self._supersede_locked(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"mode": self.mode, "workers": self.workers, "in_flight": self._in_flight,
+                    "started": self.started, "skipped": self.skipped, "cancelled": self.cancelled,
+                    "discarded": self.discarded, "used": self.used, "missed": self.missed}
+
+
+def create_speculator() -> Speculator:
+    return Speculator(mode=os.environ.get("FLOW_SPECULATE", "retrieval").lower(),
+                      workers=int(os.environ.get("FLOW_SPECULATION_WORKERS", "2")))
@@ -299,28 +299,52 @@ Preferred food spots when meeting friends: "Bean Theory" (SS15 Subang), "Niko Ne
         }
     });
 
-    // pollForBotResponse function remains the same
-    async function pollForBotResponse() {
-        try {
-            const response = await fetch('/get_bot_response'); // This endpoint remains the same
-            if (!response.ok) return;
-            if (response.status === 204) return;
+    // Bubbles that arrive together are still shown one after another, at least
+    // minDelayBetweenBotMessages apart, so a burst reads like someone typing.
+    function displayBotMessage(data) {
+        if (!data || !data.content) return;
+        const now = Date.now();
+        const displayAt = Math.max(now, lastMessageTimestamp + minDelayBetweenBotMessages);
+        lastMessageTimestamp = displayAt;
+        setTimeout(() => {
+            addMessageToDisplay(data.role || 'assistant', data.content);
+        }, displayAt - now);
+    }
 
-            const data = await response.json();
-            if (data && data.content) {
-                const now = Date.now();
-                const delayNeeded = Math.max(0, minDelayBetweenBotMessages - (now - lastMessageTimestamp));
-                setTimeout(() => {
-                    addMessageToDisplay(data.role || 'assistant', data.content);
-                    lastMessageTimestamp = Date.now();
-                }, delayNeeded);
+    // Bot replies are pushed by the server over Server-Sent Events as soon as they are ready.
+    // Browsers without EventSource fall back to long-polling /get_bot_response.
+    function listenForBotResponses() {
+        const source = new EventSource('/stream_bot_responses');
+        source.onmessage = (event) => {
+            try {
+                displayBotMessage(JSON.parse(event.data));
+            } catch (error) {
+                console.error('Could not parse bot response event:', error);
+            }
+        };
+        // EventSource reconnects on its own after errors (server sends retry: 3000).
+    }
+
+    async function longPollForBotResponses() {
+        while (true) {
+            try {
+                const response = await fetch('/get_bot_response?wait=25');
+                if (response.status === 200) {
+                    displayBotMessage(await response.json());
+                } else if (!response.ok) {
+                    await new Promise(resolve => setTimeout(resolve, 2000));
+                }
+            } catch (error) {
+                await new Promise(resolve => setTimeout(resolve, 2000));
             }
-        } catch (error) {
-            // console.error('Polling error:', error);
         }
     }
 
-    setInterval(pollForBotResponse, 1200);
+    if (window.EventSource) {
+        listenForBotResponses();
+    } else {
+        longPollForBotResponses();
+    }
 
     if (chatDisplayWrapper) {
         chatDisplayWrapper.scrollTop = chatDisplayWrapper.scrollHeight;
@@ -0,0 +1,16 @@
+# tests/conftest.py
+# The suite runs offline: fake providers and throwaway caches. These are read when the
+# modules are imported, so they are set before any test module imports them.
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_CACHE_DIR = tempfile.mkdtemp(prefix="flow-tests-")
+os.environ.setdefault("FLOW_PROVIDER", "fake")
+os.environ.setdefault("FLOW_FAKE_LLM_LATENCY", "1.0")
+os.environ.setdefault("FLOW_EMBEDDING_CACHE_PATH", os.path.join(_CACHE_DIR, "embeddings.sqlite3"))
+os.environ.setdefault("FLOW_SESSION_STORE_PATH", os.path.join(_CACHE_DIR, "sessions.sqlite3"))
+os.environ.setdefault("FLOW_BURST_MIN_DELAY", "0.1")
+os.environ.setdefault("FLOW_BURST_MAX_DELAY", "0.3")
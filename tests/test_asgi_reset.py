@@ -0,0 +1,43 @@
+# tests/test_asgi_reset.py
+# A reset on the async server cancels the session's running work, and a reply of the old
+# chat never reaches the new one.
+import asyncio
+import time
+
+import asgi
+
+MESSAGE = {"message": "what time do you finish today?", "api_key": "test-key", "user_persona": "Casual",
+           "user_profile": "I work at the bakery on Main Street until 6pm. I like hiking on weekends."}
+
+
+async def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        await asyncio.sleep(0.01)
+    return condition()
+
+
+async def _reset_during_generation():
+    async with asgi.app.test_app() as test_app:
+        client = test_app.test_client()
+        await client.get("/")
+        async with client.session_transaction() as quart_session:
+            session_id = quart_session["session_id"]
+        state = asgi._sessions[session_id]
+
+        assert (await client.post("/chat", json=MESSAGE)).status_code == 200
+        assert await wait_for(lambda: state.burst_task is None and state.jobs)
+        jobs = list(state.jobs)
+        assert (await client.post("/reset_session", json={})).status_code == 200
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+        assert all(job.cancelled() or job.done() for job in jobs)
+        assert not state.jobs
+        assert (await client.get("/get_bot_response?wait=1.5")).status_code == 204
+        assert asgi.session_store.get_history(session_id) == []
+
+
+def test_reset_drops_the_running_reply():
+    asyncio.run(_reset_during_generation())
@@ -0,0 +1,122 @@
+# tests/test_burst_aggregator.py
+# Every burst reaches the RAG job exactly once, with all of its messages, including when the
+# scheduler refuses a message.
+import random
+import threading
+import time
+
+import pytest
+
+from burst_aggregator import BurstAggregator
+from scheduler import BurstScheduler
+from session_store import InMemorySessionStore, SQLiteSessionStore
+
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request):
+    return InMemorySessionStore() if request.param == "memory" else SQLiteSessionStore(":memory:")
+
+
+class Recorder:
+    def __init__(self, block_session: str = ""):
+        self.runs = []
+        self.block_session = block_session # This session's run waits for release
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, session_id, messages, delay, delay_reason, history):
+        if session_id == self.block_session:
+            self.started.set()
+            self.release.wait(5.0)
+        with self._lock:
+            self.runs.append((session_id, list(messages)))
+
+    def runs_for(self, session_id):
+        with self._lock:
+            return [messages for run_session, messages in self.runs if run_session == session_id]
+
+
+SESSIONS = [f"s{index}" for index in range(6)]
+SENDERS = 4 # Threads sending concurrently, each to every session
+MESSAGES_PER_SENDER = 3 # Per session and burst
+BURSTS = 3
+WINDOW = 0.3
+
+
+def test_concurrent_interleaved_messages_run_once_per_burst(store):
+    scheduler = BurstScheduler(workers=4, max_queue=len(SESSIONS) * 2, name="test")
+    recorder = Recorder()
+    aggregator = BurstAggregator(store, scheduler, recorder)
+    expected = {session_id: [] for session_id in SESSIONS}
+    try:
+        for burst in range(BURSTS):
+            start = threading.Barrier(SENDERS)
+
+            def send(sender: int) -> None:
+                rng = random.Random(burst * SENDERS + sender)
+                messages = [(session_id, f"{session_id} b{burst} t{sender} m{index}")
+                            for session_id in SESSIONS for index in range(MESSAGES_PER_SENDER)]
+                rng.shuffle(messages)
+                start.wait()
+                for session_id, message in messages:
+                    assert aggregator.add(session_id, message, WINDOW) is not None
+                    time.sleep(rng.uniform(0, 0.003))
+
+            senders = [threading.Thread(target=send, args=(sender,)) for sender in range(SENDERS)]
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                sender.join()
+            for session_id in SESSIONS:
+                expected[session_id].append({f"{session_id} b{burst} t{sender} m{index}"
+                                             for sender in range(SENDERS) for index in range(MESSAGES_PER_SENDER)})
+            # Wait out this burst before the next one opens.
+            assert wait_for(lambda: len(recorder.runs) == len(SESSIONS) * (burst + 1))
+            time.sleep(WINDOW)
+
+        for session_id in SESSIONS:
+            runs = recorder.runs_for(session_id)
+            assert len(runs) == BURSTS
+            for messages, expected_messages in zip(runs, expected[session_id]):
+                assert len(messages) == len(expected_messages) # Each message delivered exactly once
+                assert set(messages) == expected_messages
+        stats = aggregator.stats()
+        assert stats["bursts"] == len(SESSIONS) * BURSTS and stats["empty_fires"] == 0 and stats["rejected"] == 0
+        assert stats["messages"] == len(SESSIONS) * BURSTS * SENDERS * MESSAGES_PER_SENDER
+    finally:
+        scheduler.shutdown()
+
+
+def test_refused_message_keeps_the_queued_burst(store):
+    scheduler = BurstScheduler(workers=1, max_queue=1, name="test")
+    recorder = Recorder(block_session="a")
+    aggregator = BurstAggregator(store, scheduler, recorder)
+    try:
+        # Session a occupies the only worker; session b's burst then fills the queue.
+        aggregator.add("a", "a1", 0.0)
+        assert recorder.started.wait(5.0)
+        aggregator.add("b", "b1", 0.2)
+        aggregator.add("b", "b2", 0.2)
+        assert wait_for(lambda: scheduler.stats()["queue_depth"] == 1 and not aggregator.is_pending("b"))
+        # b's next message starts a new burst, which is refused: only that message is dropped.
+        assert aggregator.add("b", "b3", 0.0) is None
+        assert aggregator.stats()["rejected"] == 1
+        recorder.release.set()
+        assert wait_for(lambda: len(recorder.runs) == 2)
+        assert recorder.runs_for("a") == [["a1"]]
+        assert recorder.runs_for("b") == [["b1", "b2"]]
+        assert aggregator.stats()["empty_fires"] == 0
+        assert store.take_burst_buffer("b") == []
+    finally:
+        recorder.release.set()
+        scheduler.shutdown()
@@ -0,0 +1,33 @@
+# tests/test_metrics.py
+# The evaluation report's latency figures are measured, not derived: per query by default,
+# per batch with batching.
+import metrics
+
+
+def test_default_run_reports_per_query_latencies_and_stages():
+    report = metrics.run_parallel_evaluation(output_path=None)
+    queries = report["queries"]
+    performance = report["performance"]
+
+    assert not report["config"]["batched"]
+    assert queries and report["quality"]["errors"] == 0
+    for result in queries:
+        assert result["latency_ms"] > 0
+        assert {"embed", "search"} <= set(result["stage_timings_ms"])
+    latency = performance["latency"]
+    assert latency["count"] == len(queries)
+    assert latency["p50_ms"] <= latency["p95_ms"] <= latency["p99_ms"] <= latency["max_ms"]
+    for stage in ("embed", "search"):
+        assert performance["stages"][stage]["count"] == len(queries)
+    assert performance["batch"] is None
+
+
+def test_batched_run_reports_batch_timings_only():
+    report = metrics.run_parallel_evaluation(output_path=None, batched=True)
+    performance = report["performance"]
+
+    assert report["config"]["batched"]
+    assert all(result["latency_ms"] is None for result in report["queries"])
+    assert performance["latency"] == {"count": 0}
+    assert performance["batch"]["queries"] == len(report["queries"])
+    assert {"embed", "search"} <= set(performance["batch"]["stage_timings_ms"])
@@ -0,0 +1,110 @@
+# tests/test_session_lock.py
+# The per-session lock is not held while the LLM works: the session's other requests stay
+# fast during a generation, and a reset during one discards its reply.
+import threading
+import time
+
+import pytest
+
+import app as flow_app
+import providers
+
+API_KEY = "test-key"
+PROFILE = "I work at the bakery on Main Street until 6pm. I like hiking on weekends."
+
+
+def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def generation_running() -> bool:
+    return flow_app.burst_scheduler.stats()["running"] > 0
+
+
+def timed(call):
+    start = time.perf_counter()
+    response = call()
+    return response, time.perf_counter() - start
+
+
+@pytest.fixture
+def client():
+    flow_app.app.config["TESTING"] = True
+    flow_app.rag.reply_cache.clear()
+    with flow_app.app.test_client() as client:
+        client.get("/")
+        yield client
+    assert wait_for(lambda: not generation_running())
+
+
+def send(client, message):
+    return client.post("/chat", json={"message": message, "api_key": API_KEY, "user_profile": PROFILE,
+                                      "user_persona": "Casual"})
+
+
+def test_requests_stay_fast_while_a_reply_generates(client):
+    llm_latency = providers.FAKE_LLM_LATENCY_SECONDS
+    assert llm_latency >= 0.5
+    assert send(client, "are you free after work?").status_code == 200
+    assert wait_for(generation_running)
+
+    chat_response, chat_seconds = timed(lambda: send(client, "I can pick you up."))
+    poll_response, poll_seconds = timed(lambda: client.get("/get_bot_response"))
+    assert chat_response.status_code == 200
+    assert poll_response.status_code in (200, 204)
+    assert generation_running() # Both requests were answered before the generation finished
+    assert chat_seconds < llm_latency / 4
+    assert poll_seconds < llm_latency / 4
+
+    # The second burst is answered in the end.
+    session_id = _session_id(client)
+    assert wait_for(lambda: not flow_app.burst_aggregator.is_pending(session_id) and not generation_running())
+    assert client.get("/get_bot_response?wait=5").status_code == 200
+
+
+def test_reply_published_after_reset_is_dropped(client):
+    stale_before = flow_app._reply_stats["stale_dropped"]
+    assert send(client, "what time do you finish today?").status_code == 200
+    assert wait_for(generation_running)
+
+    assert client.post("/reset_session", json={}).status_code == 200
+    assert wait_for(lambda: not generation_running())
+
+    assert flow_app._reply_stats["stale_dropped"] > stale_before
+    assert client.get("/get_bot_response").status_code == 204
+    assert flow_app.session_store.get_history(_session_id(client)) == []
+
+
+def _session_id(client):
+    with client.session_transaction() as flask_session:
+        return flask_session["session_id"]
+
+
+def test_summary_of_a_reset_chat_is_dropped(client, monkeypatch):
+    session_id = _session_id(client)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_summary(api_key, previous_summary, turns):
+        started.set()
+        release.wait(5.0)
+        return "They talked about the old chat."
+
+    monkeypatch.setattr(flow_app.rag, "summarize_history", slow_summary)
+    flow_app.session_store.append_history(session_id, [{"role": "user", "content": f"old message {index}"}
+                                                       for index in range(flow_app.session_store.max_history + 2)])
+    summary_job = threading.Thread(target=flow_app.summarize_history_for_session, args=(session_id, API_KEY))
+    summary_job.start()
+    assert started.wait(5.0)
+    flow_app.burst_scheduler.schedule(("summary", session_id), 60, flow_app.summarize_history_for_session, session_id, API_KEY)
+
+    assert client.post("/reset_session", json={}).status_code == 200
+    release.set()
+    summary_job.join(5.0)
+
+    assert not flow_app.burst_scheduler.is_pending(("summary", session_id))
+    assert not flow_app.session_store.get_settings(session_id).get("history_summary")
@@ -0,0 +1,25 @@
+# tests/test_session_store.py
+# The SQLite store is shared by worker processes: concurrent writes must not lose each other.
+import multiprocessing
+
+from session_store import SQLiteSessionStore
+
+KEYS_PER_PROCESS = 300
+
+
+def _write_settings(path: str, prefix: str) -> None:
+    store = SQLiteSessionStore(path)
+    for index in range(KEYS_PER_PROCESS):
+        store.update_settings("shared", **{f"{prefix}{index}": index})
+
+
+def test_settings_merges_from_two_processes_are_not_lost(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    SQLiteSessionStore(path) # Create the schema before the writers race
+    writers = [multiprocessing.Process(target=_write_settings, args=(path, prefix)) for prefix in ("a", "b")]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join(60)
+        assert writer.exitcode == 0
+    assert len(SQLiteSessionStore(path).get_settings("shared")) == 2 * KEYS_PER_PROCESS
@@ -0,0 +1,58 @@
+# tests/test_speculation.py
+# A full-pipeline speculation is used by its burst even when the history window is full, i.e.
+# when the burst's own messages push old turns out of the bounded history.
+import asyncio
+
+import app as flow_app
+import asgi
+
+MESSAGE = {"api_key": "test-key", "user_persona": "Casual",
+           "user_profile": "I work at the bakery on Main Street until 6pm. I like hiking on weekends."}
+BURST = ["so about tomorrow,", "i was thinking,", "maybe lunch at noon?"]
+
+
+def fill_history(store, session_id):
+    store.append_history(session_id, [{"role": "user" if index % 2 else "assistant", "content": f"earlier turn {index}"}
+                                      for index in range(store.max_history)])
+
+
+def test_full_history_window_speculation_is_used(monkeypatch):
+    monkeypatch.setattr(flow_app.speculator, "mode", "full")
+    flow_app.rag.reply_cache.clear()
+    with flow_app.app.test_client() as client:
+        client.get("/")
+        with client.session_transaction() as flask_session:
+            session_id = flask_session["session_id"]
+        fill_history(flow_app.session_store, session_id)
+        before = flow_app.speculator.stats()
+
+        for message in BURST:
+            assert client.post("/chat", json={**MESSAGE, "message": message}).status_code == 200
+        assert client.get("/get_bot_response?wait=10").status_code == 200
+
+        after = flow_app.speculator.stats()
+        assert after["used"] == before["used"] + 1
+        assert after["missed"] == before["missed"]
+
+
+async def _async_full_history_window_speculation_is_used():
+    async with asgi.app.test_app() as test_app:
+        client = test_app.test_client()
+        await client.get("/")
+        async with client.session_transaction() as quart_session:
+            session_id = quart_session["session_id"]
+        fill_history(asgi.session_store, session_id)
+        before = dict(asgi._stats)
+
+        for message in BURST:
+            assert (await client.post("/chat", json={**MESSAGE, "message": message})).status_code == 200
+        assert (await client.get("/get_bot_response?wait=10")).status_code == 200
+
+        assert asgi._stats["speculation_used"] == before["speculation_used"] + 1
+        assert asgi._stats["speculation_missed"] == before["speculation_missed"]
+
+
+def test_async_full_history_window_speculation_is_used(monkeypatch):
+    monkeypatch.setattr(asgi, "SPECULATION_MODE", "full")
+    asgi.rag.reply_cache.clear()
+    asyncio.run(_async_full_history_window_speculation_is_used())